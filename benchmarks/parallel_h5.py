@@ -0,0 +1,125 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Benchmark chunk-parallel evaluation of H5 transforms.
+
+Transforms random points with 1, 2, 4, ... worker threads (or processes with
+`--pool process`), once with a cold chunk cache (reading and decoding the
+field dominates) and once with a warm one (interpolation dominates). Cold runs
+with processes include starting the workers. Uses a registered H5 transform
+(e.g. the JRC transforms, see `flybrains.download_jrc_transforms`) or, with
+`--synthetic`, a gzip-compressed random field written to a temporary
+directory. Usage:
+
+    python benchmarks/parallel_h5.py --source JRC2018F --target JRCFIB2018Fum
+    python benchmarks/parallel_h5.py --synthetic --pool process
+"""
+
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from flybrains import h5, parallel
+from flybrains.domain import get_domain
+
+from point_order import find_h5
+
+
+def synthetic_h5(fp, shape=(128, 256, 256), seed=0):
+    """Write H5 transform with a random (z, y, x, 3) deformation field."""
+    rng = np.random.default_rng(seed)
+    with h5py.File(fp, "w") as f:
+        ds = f.create_dataset(
+            "0/dfield",
+            shape=tuple(shape) + (3,),
+            dtype=np.int16,
+            chunks=(64, 64, 64, 3),
+            compression="gzip",
+        )
+        # Write slab by slab to keep memory in check
+        for z in range(0, shape[0], 64):
+            n = min(64, shape[0] - z)
+            ds[z : z + n] = rng.integers(-100, 100, (n,) + tuple(shape[1:]) + (3,))
+        ds.attrs["spacing"] = np.ones(3)
+        ds.attrs["quantization_multiplier"] = 0.01
+    return h5.H5transform(str(fp))
+
+
+def time_xform(tr, points, n_workers, cold):
+    """Time transforming points with given number of workers."""
+    if cold:
+        h5.chunk_cache.clear()
+        # Worker processes have their own caches
+        parallel.close_process_pool()
+    parallel.N_WORKERS = n_workers
+    start = time.perf_counter()
+    tr.xform(points)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--source", default="JRC2018F")
+    parser.add_argument("--target", default="JRCFIB2018Fum")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--n-points", type=int, default=1_000_000)
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    parallel.CHUNK_SIZE = args.chunk_size
+    parallel.POOL = args.pool
+    workers = [int(w) for w in args.workers.split(",")]
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        if args.synthetic:
+            tr = synthetic_h5(pathlib.Path(tempdir) / "synthetic.h5")
+            upper = np.array(tr.shape[:3][::-1]) * tr.spacing[::-1]
+            lower = np.zeros(3)
+        else:
+            tr = find_h5(args.source, args.target)
+            bbox = get_domain(args.source).bbox
+            lower, upper = bbox[:, 0], bbox[:, 1]
+        points = rng.uniform(lower, upper, size=(args.n_points, 3))
+
+        # Make sure the chunk cache can hold the whole field
+        h5.chunk_cache.max_bytes = max(h5.chunk_cache.max_bytes, 2**33)
+
+        rows = []
+        for n in workers:
+            for cold in (True, False):
+                if not cold:
+                    # Warm up the cache
+                    time_xform(tr, points, n, cold=False)
+                t = min(
+                    time_xform(tr, points, n, cold) for _ in range(args.repeats)
+                )
+                rows.append(("cold" if cold else "warm", n, t))
+
+    df = pd.DataFrame(rows, columns=["cache", "workers", "seconds"])
+    df["speedup"] = df.groupby("cache").seconds.transform("first") / df.seconds
+    print(f"{len(points):,} points, {os.cpu_count()} CPUs, {args.pool} pool")
+    print(df.sort_values(["cache", "workers"]).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
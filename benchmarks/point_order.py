@@ -0,0 +1,106 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Benchmark sorting points along space-filling curves for JRC H5 transforms.
+
+Requires the JRC transforms (see `flybrains.download_jrc_transforms`). Points
+are random walks ("neurons") inside the source template, shuffled to mimic
+e.g. synapse tables. Usage:
+
+    python benchmarks/point_order.py --source JRC2018F --target JRCFIB2018Fum
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from navis import transforms
+
+from flybrains import h5, order, parallel
+from flybrains.core import _ensure_scanned
+from flybrains.domain import get_domain
+
+
+def fake_neurons(domain, n_points, n_neurons=100, step=1.0, seed=0):
+    """Generate shuffled points of random walks inside domain."""
+    rng = np.random.default_rng(seed)
+    lower, upper = domain.bbox[:, 0], domain.bbox[:, 1]
+    starts = rng.uniform(lower, upper, size=(n_neurons, 3))
+    steps = rng.normal(scale=step, size=(n_neurons, n_points // n_neurons, 3))
+    points = (starts[:, None, :] + np.cumsum(steps, axis=1)).reshape(-1, 3)
+    points = np.clip(points, lower, upper)
+    return points[rng.permutation(len(points))]
+
+
+def find_h5(source, target):
+    """Find registered H5 transform."""
+    _ensure_scanned()
+    for t in transforms.registry.transforms:
+        if not isinstance(t.transform, h5.H5transform):
+            continue
+        if (t.source, t.target) == (source, target):
+            return t.transform
+        if (t.source, t.target) == (target, source):
+            return -t.transform
+    raise ValueError(f'No H5 transform registered between "{source}" and "{target}"')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--source", default="JRC2018F")
+    parser.add_argument("--target", default="JRCFIB2018Fum")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--cache-mb", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    tr = find_h5(args.source, args.target)
+    points = fake_neurons(get_domain(args.source), args.points)
+    print(f"{tr.file} ({tr.direction}) | {len(points):,} points")
+
+    parallel.N_WORKERS = args.workers
+    parallel.CHUNK_SIZE = args.chunk_size
+    h5.chunk_cache.max_bytes = args.cache_mb * 2**20
+
+    data, ref = [], None
+    for curve in (None, "morton", "hilbert"):
+        order.POINT_ORDER = curve
+        for i in range(args.repeats):
+            h5.chunk_cache.clear()
+            start = time.time()
+            xf = tr.xform(points)
+            dur = time.time() - start
+            if ref is None:
+                ref = xf
+            info = h5.chunk_cache.info()
+            data.append(
+                {
+                    "order": curve or "none",
+                    "repeat": i,
+                    "time": dur,
+                    "chunk_misses": info["misses"],
+                    "chunk_hits": info["hits"],
+                    "identical": np.array_equal(xf, ref, equal_nan=True),
+                }
+            )
+
+    df = pd.DataFrame(data)
+    print(df.groupby("order", sort=False).agg("median").drop(columns="repeat"))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,16 @@ from .download import *
 
 from .core import *
 
+from .bulk import *
+
+from .h5 import *
+
+from .repack import *
+
+from .cache import *
+
+from .assets import *
+
 # This registers the transforms
 register_transforms()
 
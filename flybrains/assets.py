@@ -0,0 +1,262 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Memory budget for loaded assets.
+
+Template meshes, lazily constructed transforms, TPS coefficients,
+displacement grids and chunks of H5 deformation fields register with
+`asset_cache`. Once their combined size exceeds the budget, the least
+recently used assets are dropped - they are simply loaded (or computed) again
+the next time they are needed.
+"""
+
+import os
+import threading
+import weakref
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["resident_assets"]
+
+# Byte budget for all assets together
+ASSET_CACHE_BYTES = int(os.environ.get("FLYBRAINS_ASSET_CACHE_BYTES", 4 * 2**30))
+
+
+class _Asset:
+    """Entry in the asset cache."""
+
+    __slots__ = ("owner", "name", "nbytes", "evict", "label", "finalizer")
+
+    def __init__(self, owner, name, nbytes, evict, label, finalizer):
+        self.owner = owner
+        self.name = name
+        self.nbytes = nbytes
+        self.evict = evict
+        self.label = label
+        self.finalizer = finalizer
+
+
+class AssetCache:
+    """Thread-safe LRU of loaded assets with a byte budget.
+
+    The cache does not hold the assets themselves: each asset is registered
+    with a callback that drops it from its owner (e.g. deletes the attribute
+    of a template brain that holds its mesh).
+
+    Parameters
+    ----------
+    max_bytes :     int
+                    Byte budget. Least recently used assets are evicted once
+                    the registered assets exceed this size.
+
+    """
+
+    def __init__(self, max_bytes: int):
+        self._assets = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __repr__(self):
+        return f"AssetCache({self.info()})"
+
+    @property
+    def max_bytes(self) -> int:
+        """Byte budget. Setting a lower budget evicts assets immediately."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int):
+        with self._lock:
+            self._max_bytes = int(value)
+            victims = self._pop_over_budget()
+        self._evict(victims)
+
+    def _pop_over_budget(self) -> list:
+        """Remove least recently used assets until we are within budget."""
+        victims = []
+        while self._assets and self.nbytes > self._max_bytes:
+            _, asset = self._assets.popitem(last=False)
+            self.nbytes -= asset.nbytes
+            victims.append(asset)
+        return victims
+
+    def _evict(self, victims: list):
+        """Drop assets from their owners (outside of the lock)."""
+        for asset in victims:
+            if asset.finalizer is not None:
+                asset.finalizer.detach()
+            owner = asset.owner
+            if isinstance(owner, weakref.ref):
+                owner = owner()
+            if owner is not None:
+                asset.evict(owner)
+        if victims:
+            with self._lock:
+                self.evictions += len(victims)
+
+    def track(self, owner, name, nbytes: int, evict, label: str = None):
+        """Register (or update) an asset and evict assets over the budget.
+
+        Parameters
+        ----------
+        owner :     object
+                    Holds the asset. Only weakly referenced if possible: the
+                    asset is forgotten when its owner is garbage collected.
+        name :      hashable
+                    Identifies the asset within `owner`.
+        nbytes :    int
+                    Size of the asset.
+        evict :     callable
+                    Called with `owner` to drop the asset.
+        label :     str, optional
+                    Description for `resident`.
+
+        """
+        key = (id(owner), name)
+        try:
+            ref = weakref.ref(owner)
+            finalizer = weakref.finalize(owner, self.discard, owner=None, key=key)
+        except TypeError:
+            # Not weak-referenceable (e.g. a dict): keep a strong reference
+            ref, finalizer = owner, None
+
+        with self._lock:
+            old = self._assets.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+                if old.finalizer is not None:
+                    old.finalizer.detach()
+            self._assets[key] = _Asset(ref, name, int(nbytes), evict, label, finalizer)
+            self.nbytes += int(nbytes)
+            victims = self._pop_over_budget()
+        self._evict(victims)
+
+    def touch(self, owner, name):
+        """Mark asset as recently used."""
+        key = (id(owner), name)
+        with self._lock:
+            if key in self._assets:
+                self._assets.move_to_end(key)
+
+    def discard(self, owner, name=None, key=None):
+        """Forget asset without evicting it (e.g. if it was dropped already)."""
+        key = key if key is not None else (id(owner), name)
+        with self._lock:
+            asset = self._assets.pop(key, None)
+            if asset is None:
+                return
+            self.nbytes -= asset.nbytes
+        if asset.finalizer is not None:
+            asset.finalizer.detach()
+
+    def clear(self):
+        """Evict all assets."""
+        with self._lock:
+            victims = list(self._assets.values())
+            self._assets.clear()
+            self.nbytes = 0
+        self._evict(victims)
+
+    def info(self) -> dict:
+        """Summary of cache usage."""
+        with self._lock:
+            return {
+                "assets": len(self._assets),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+    def resident(self) -> pd.DataFrame:
+        """Registered assets, least recently used first."""
+        with self._lock:
+            assets = list(self._assets.values())
+        return pd.DataFrame(
+            [(a.label or str(a.name), a.nbytes) for a in assets],
+            columns=["asset", "nbytes"],
+        )
+
+
+asset_cache = AssetCache(ASSET_CACHE_BYTES)
+
+
+def resident_assets() -> pd.DataFrame:
+    """List assets (meshes, transforms, field data) currently held in memory.
+
+    The combined size of these assets is kept below
+    ``FLYBRAINS_ASSET_CACHE_BYTES`` (default 4 GiB) by dropping the least
+    recently used ones. Change the budget at runtime via
+    ``flybrains.assets.asset_cache.max_bytes`` and drop everything with
+    ``flybrains.assets.asset_cache.clear()``.
+
+    Returns
+    -------
+    pandas.DataFrame
+                One row per asset with its description and size in bytes,
+                least recently used first.
+
+    Examples
+    --------
+    >>> import flybrains
+    >>> _ = flybrains.FLYWIRE.mesh
+    >>> flybrains.resident_assets()                             # doctest: +SKIP
+                  asset   nbytes
+    0     FLYWIRE._mesh  1234567
+
+    """
+    return asset_cache.resident()
+
+
+def sizeof(value, depth: int = 3) -> int:
+    """Estimate the memory used by arrays in (nested) value.
+
+    Counts numpy arrays (memory-mapped ones included) and mesh vertices and
+    faces - inside lists, tuples, dicts and object attributes down to
+    `depth` levels.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "vertices") and hasattr(value, "faces"):
+        return np.asarray(value.vertices).nbytes + np.asarray(value.faces).nbytes
+    if depth <= 0:
+        return 0
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    elif hasattr(value, "__dict__"):
+        items = vars(value).values()
+    else:
+        return 0
+    return sum(sizeof(v, depth - 1) for v in items)
+
+
+def describe(owner, name) -> str:
+    """Label for an asset `name` of `owner`."""
+    if isinstance(owner, dict):
+        return str(name)
+    label = getattr(owner, "label", None)
+    if isinstance(label, str):
+        return f"{label}.{name}"
+    file = getattr(owner, "file", None)
+    if isinstance(file, (str, os.PathLike)):
+        return f"{os.path.basename(file)}.{name}"
+    return f"{type(owner).__name__}.{name}"
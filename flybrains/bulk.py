@@ -0,0 +1,318 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Transform many neurons (and/or into many targets) in a single pass."""
+
+import navis
+
+import numpy as np
+import pandas as pd
+import trimesh as tm
+
+from navis import transforms
+from navis.transforms.base import BaseTransform, TransOptimizer
+
+from .paths import compile_path, compile_tree
+from .results import xform_cached
+
+__all__ = ["xform_brain_bulk", "xform_brain_multi"]
+
+
+class _Precomputed(BaseTransform):
+    """Return precomputed results for a given set of points."""
+
+    def __init__(self, points: np.ndarray, xf: np.ndarray):
+        self.points = points
+        self.xf = xf
+
+    def __eq__(self, other) -> bool:
+        return other is self
+
+    def copy(self) -> "_Precomputed":
+        return self
+
+    def xform(self, points: np.ndarray, affine_fallback: bool = True) -> np.ndarray:
+        points = np.asarray(points)
+        expected, xf = self.points, self.xf
+        if len(points) != len(expected):
+            # TransformSequence drops points with NaN coordinates
+            keep = ~np.any(np.isnan(expected), axis=1)
+            expected, xf = expected[keep], xf[keep]
+        if not np.array_equal(points, expected, equal_nan=True):
+            raise ValueError("Points do not match the precomputed points")
+        return xf.copy()
+
+
+def _coordinates(x):
+    """Gather coordinates of object in the order `navis.xform` does.
+
+    Returns None for objects that we can't batch.
+    """
+    if isinstance(x, navis.TreeNeuron):
+        xyz = x.nodes[["x", "y", "z"]].values
+    elif isinstance(x, navis.MeshNeuron):
+        xyz = x.vertices
+    elif isinstance(x, navis.Dotprops):
+        xyz = x.points
+        if x.k is None or x.k <= 0:
+            # Helper points to carry over the tangent vectors
+            xyz = np.append(xyz, x.points + x.vect * x.sampling_resolution, axis=0)
+    elif isinstance(x, tm.Trimesh):
+        return np.asarray(x.vertices)
+    elif isinstance(x, pd.DataFrame):
+        if any(c not in x.columns for c in ["x", "y", "z"]):
+            return None
+        return x[["x", "y", "z"]].values
+    elif isinstance(x, np.ndarray):
+        return x if x.ndim == 2 and x.shape[1] == 3 else None
+    else:
+        return None
+
+    if x.has_connectors:
+        xyz = np.vstack([xyz, x.connectors[["x", "y", "z"]].values])
+    return np.asarray(xyz)
+
+
+def _is_collection(x) -> bool:
+    """Check if `x` is a list/tuple of neurons and/or meshes."""
+    return isinstance(x, (list, tuple)) and all(
+        isinstance(o, (navis.BaseNeuron, tm.Trimesh)) for o in x
+    )
+
+
+def _gather(x) -> tuple:
+    """Split input into objects and their coordinates.
+
+    Returns ``(None, None)`` if any of the objects can't be batched.
+    """
+    if isinstance(x, navis.NeuronList) or _is_collection(x):
+        objects = list(x)
+    elif isinstance(x, (list, tuple)):
+        objects = [np.asarray(x)]
+    else:
+        objects = [x]
+
+    coords = [_coordinates(o) for o in objects]
+    if not objects or any(c is None for c in coords):
+        return None, None
+    return objects, coords
+
+
+def _xform_points(xyz, seq, source, target, affine_fallback, caching):
+    """Run (N, 3) array through transform sequence.
+
+    If enabled, only points not in the result cache are transformed.
+    """
+
+    def func(xyz):
+        if not len(xyz):
+            return xyz.astype(np.float64)
+        bbox = np.vstack([np.nanmin(xyz, axis=0), np.nanmax(xyz, axis=0)]).T
+        with TransOptimizer(seq, bbox=bbox, caching=caching):
+            return seq.xform(xyz, affine_fallback=affine_fallback)
+
+    return xform_cached(func, xyz, source, target, seq, affine_fallback)
+
+
+def _scatter(x, objects, coords, xyz_xf, path, trs):
+    """Map transformed coordinates back onto (copies of) the objects."""
+    # This lets navis take care of units, radii, dotprops vectors, etc.
+    xf = []
+    offsets = np.cumsum([0] + [len(c) for c in coords])
+    for o, c, i, j in zip(objects, coords, offsets[:-1], offsets[1:]):
+        xf.append(navis.xform(o, _Precomputed(c, xyz_xf[i:j])))
+    _set_units([n for n in xf if isinstance(n, navis.BaseNeuron)], path, trs)
+
+    if isinstance(x, navis.NeuronList):
+        return x.__class__(xf)
+    elif _is_collection(x):
+        return type(x)(xf)
+    return xf[0]
+
+
+def _print_path(path, trs):
+    path_str = path[0]
+    for p, tr in zip(path[1:], trs):
+        link = "=" if isinstance(tr, transforms.AliasTransform) else "->"
+        path_str += f" {link} {p}"
+    print("Transform path:", path_str)
+
+
+def _set_units(neurons, path, trs):
+    """Use hard-coded units of the target template if available.
+
+    See `navis.xform_brain`.
+    """
+    # Find the last non-alias template space
+    for tmp, tr in zip(path[::-1], trs[::-1]):
+        if not isinstance(tr, transforms.AliasTransform):
+            try:
+                last_temp = transforms.registry.find_template(tmp)
+            except ValueError:
+                break
+            if hasattr(last_temp, "_navis_units"):
+                for n in neurons:
+                    n.units = last_temp._navis_units
+            break
+
+
+def xform_brain_bulk(
+    x,
+    source: str,
+    target: str,
+    via=None,
+    avoid=None,
+    affine_fallback: bool = True,
+    caching: bool = True,
+    verbose: bool = True,
+):
+    """Transform 3D data between template brains in a single batch.
+
+    Works like `navis.xform_brain` but instead of running the transforms once
+    per neuron, the coordinates (nodes, connectors, mesh vertices, etc.) of all
+    objects are gathered into a single array which is pushed through each
+    transform only once before being mapped back onto the objects. For
+    transforms with a large per-call overhead (e.g. Elastix or CMTK binaries)
+    transforming 10k neurons then costs about as much as transforming one.
+
+    Parameters
+    ----------
+    x :                 Neuron/List | Volume | numpy.ndarray | pandas.DataFrame
+                        Data to transform. Arrays must be of shape (N, 3),
+                        DataFrames must have x/y/z columns. Anything else
+                        (e.g. VoxelNeurons) is transformed as in
+                        `navis.xform_brain`.
+    source :            str
+                        Source template brain that the data currently is in.
+    target :            str
+                        Target template brain that the data should be
+                        transformed into.
+    via :               str | list thereof, optional
+                        Optionally set intermediate template(s).
+    avoid :             str | list thereof, optional
+                        Prohibit going through specific intermediate template(s).
+    affine_fallback :   bool
+                        If True, points that fail to transform fall back to the
+                        affine part of the transform.
+    caching :           bool
+                        If True, will (pre-)cache data for H5 transforms.
+    verbose :           bool
+                        If True, will print the transform path.
+
+    Returns
+    -------
+    same type as `x`
+                        Copy of input with transformed coordinates.
+
+    Examples
+    --------
+    >>> import flybrains
+    >>> xf = flybrains.xform_brain_bulk(nl, 'FANC', 'JRCVNC2018F')  # doctest: +SKIP
+
+    """
+    # This fuses adjacent affine/alias hops and is cached per source/target
+    path, trs, seq = compile_path(source, target, via=via, avoid=avoid)
+    if verbose:
+        _print_path(path, trs)
+
+    objects, coords = _gather(x)
+    if objects is None:
+        xf = navis.xform(
+            x, transform=seq, caching=caching, affine_fallback=affine_fallback
+        )
+        if isinstance(xf, (navis.NeuronList, navis.BaseNeuron)):
+            _set_units(navis.NeuronList(xf), path, trs)
+        return xf
+
+    # Push all coordinates through the transforms in one go
+    xyz_xf = _xform_points(
+        np.vstack(coords), seq, source, target, affine_fallback, caching
+    )
+    return _scatter(x, objects, coords, xyz_xf, path, trs)
+
+
+def xform_brain_multi(
+    x,
+    source: str,
+    targets: list,
+    affine_fallback: bool = True,
+    caching: bool = True,
+    verbose: bool = True,
+) -> dict:
+    """Transform 3D data from one source into multiple target brains.
+
+    Builds the shortest-path tree from `source` to all `targets` so that hops
+    shared between targets (e.g. FAFB14 -> JRC2018F on the way to JRC2018U,
+    JFRC2 and FCWB) are computed only once. Like `xform_brain_bulk`, all
+    coordinates are gathered into a single array.
+
+    Parameters
+    ----------
+    x :                 Neuron/List | Volume | numpy.ndarray | pandas.DataFrame
+                        Data to transform.
+    source :            str
+                        Source template brain that the data currently is in.
+    targets :           list of str
+                        Target template brains.
+    affine_fallback :   bool
+                        If True, points that fail to transform fall back to the
+                        affine part of the transform.
+    caching :           bool
+                        If True, will (pre-)cache data for H5 transforms.
+    verbose :           bool
+                        If True, will print the transform paths.
+
+    Returns
+    -------
+    dict
+                        Maps each target to a copy of the input with
+                        transformed coordinates.
+
+    Examples
+    --------
+    >>> import flybrains
+    >>> xf = flybrains.xform_brain_multi(
+    ...     points, "FAFB14", ["JRC2018F", "JRC2018U", "JFRC2", "FCWB"]
+    ... )                                                        # doctest: +SKIP
+    >>> xf["FCWB"]                                               # doctest: +SKIP
+
+    """
+    targets = [targets] if isinstance(targets, str) else targets
+    targets = list(dict.fromkeys(targets))
+    objects, coords = _gather(x)
+    if objects is None:
+        # Can't batch this (e.g. VoxelNeurons) -> one target at a time
+        return {
+            t: xform_brain_bulk(
+                x,
+                source,
+                t,
+                affine_fallback=affine_fallback,
+                caching=caching,
+                verbose=verbose,
+            )
+            for t in targets
+        }
+
+    # Hops between branch points are fused; this is cached per source/targets
+    paths, segments = compile_tree(source, targets)
+    if verbose:
+        for t in targets:
+            _print_path(*paths[t])
+
+    # Evaluate the tree: each segment starts at the source or a branch point
+    xyz = {source: np.vstack(coords)}
+    for start, end, seq in segments:
+        xyz[end] = _xform_points(xyz[start], seq, start, end, affine_fallback, caching)
+
+    return {t: _scatter(x, objects, coords, xyz[t], *paths[t]) for t in targets}
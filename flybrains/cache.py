@@ -0,0 +1,188 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Persistent on-disk caches used to speed up importing flybrains."""
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import warnings
+
+from typing import Optional
+
+__all__ = ["get_cache_dir", "clear_cache"]
+
+# File extensions of the transforms we are looking for
+TRANSFORM_EXTS = (".h5", ".list")
+
+# Directories we never descend into when looking for transforms
+SKIP_DIRS = (".git",)
+
+# Bump this if the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+
+def get_cache_dir(cache_dir: Optional[str] = None, create=False) -> str:
+    """Return path to the flybrains cache directory.
+
+    If the ``cache_dir`` argument is not specified, it tries to read from the
+    ``FLYBRAINS_CACHE`` environment variable and defaults to
+    ``$XDG_CACHE_HOME/flybrains`` (i.e. typically ``~/.cache/flybrains``).
+
+    Note that, unlike the data home, the cache is meant to live on a local
+    disk: everything in it can be regenerated.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("FLYBRAINS_CACHE", None)
+    if cache_dir is None:
+        xdg = os.environ.get("XDG_CACHE_HOME", os.path.join("~", ".cache"))
+        cache_dir = os.path.join(xdg, "flybrains")
+
+    cache_dir = os.path.expanduser(cache_dir)
+    if not os.path.exists(cache_dir) and create:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def clear_cache(cache_dir: Optional[str] = None):
+    """Remove all files from the flybrains cache directory."""
+    cache_dir = pathlib.Path(get_cache_dir(cache_dir))
+    if not cache_dir.is_dir():
+        return
+    for f in sorted(cache_dir.rglob("*"), reverse=True):
+        if f.is_dir():
+            f.rmdir()
+        else:
+            f.unlink()
+
+
+def _write_json(data, fp):
+    """Atomically write data as JSON (safe with concurrent processes)."""
+    fp = pathlib.Path(fp)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fp.with_name(f"{fp.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, fp)
+
+
+def _read_json(fp):
+    """Read JSON file. Returns None if file does not exist or is corrupt."""
+    try:
+        with open(fp, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _manifest_file(path: pathlib.Path) -> pathlib.Path:
+    """Path to the manifest for a given search path."""
+    key = hashlib.sha1(str(path).encode()).hexdigest()[:16]
+    return pathlib.Path(get_cache_dir()) / "manifests" / f"{key}.json"
+
+
+def _scan(path: pathlib.Path) -> dict:
+    """Walk `path` and collect transform files + directory stats."""
+    dirs = {}
+    hits = {ext: [] for ext in TRANSFORM_EXTS}
+    for root, dirnames, filenames in os.walk(path):
+        # Prune directories we don't want to descend into
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        st = os.stat(root)
+        dirs[os.path.relpath(root, path)] = [st.st_mtime_ns, st.st_ino]
+
+        for name in sorted(dirnames + filenames):
+            ext = os.path.splitext(name)[1]
+            if ext not in hits:
+                continue
+            fp = os.path.join(root, name)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                # E.g. broken symlinks
+                continue
+            kind = "dir" if name in dirnames else "file"
+            hits[ext].append(
+                [os.path.relpath(fp, path), kind, st.st_size, st.st_ino]
+            )
+
+    return {"version": MANIFEST_VERSION, "path": str(path), "dirs": dirs, "hits": hits}
+
+
+def _is_valid(manifest: dict, path: pathlib.Path) -> bool:
+    """Check if manifest still matches the directory tree."""
+    if not manifest or manifest.get("version") != MANIFEST_VERSION:
+        return False
+    if manifest.get("path") != str(path):
+        return False
+    try:
+        # Adding/removing/renaming entries changes the mtime of the
+        # parent directory
+        for d, (mtime, ino) in manifest["dirs"].items():
+            st = os.stat(path / d)
+            if st.st_mtime_ns != mtime or st.st_ino != ino:
+                return False
+        # Replacing a transform file in-place changes its size and/or inode
+        for hits in manifest["hits"].values():
+            for f, _, size, ino in hits:
+                st = os.stat(path / f)
+                if st.st_size != size or st.st_ino != ino:
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+def find_transforms(path, refresh: bool = False) -> dict:
+    """Find transform files/directories in given path.
+
+    Results are stored in a manifest in the cache directory and reused as long
+    as the directory tree has not changed (checked via the directories'
+    mtime and inode, and the files' size and inode).
+
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Path to search (recursively).
+    refresh :   bool
+                If True, will ignore any existing manifest and re-scan.
+
+    Returns
+    -------
+    dict
+                ``{".h5": [(path, kind), ...], ".list": [(path, kind), ...]}``
+                where ``kind`` is either "file" or "dir".
+
+    """
+    path = pathlib.Path(path).expanduser()
+
+    if not path.is_dir():
+        return {ext: [] for ext in TRANSFORM_EXTS}
+
+    fp = _manifest_file(path)
+    manifest = None if refresh else _read_json(fp)
+
+    if not _is_valid(manifest, path):
+        manifest = _scan(path)
+        try:
+            _write_json(manifest, fp)
+        except OSError as e:
+            warnings.warn(f"Unable to write transform manifest to {fp}: {e}")
+
+    return {
+        ext: [(path / f, kind) for f, kind, *_ in hits]
+        for ext, hits in manifest["hits"].items()
+    }
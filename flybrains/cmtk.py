@@ -0,0 +1,770 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Native (numpy) evaluation of CMTK registrations.
+
+Supports affine (`affine_xform`) and B-spline (`spline_warp`) registrations as
+written by CMTK into `registration` files inside `.list` directories. The
+conventions (parameterisation of the affine matrix, control point layout of
+the spline) follow CMTK's `Matrix4x4::Compose` and `SplineWarpXform`.
+Anything else falls back to the `streamxform` binary which we keep running
+in a pool of worker processes (see `StreamxformPool`).
+"""
+
+import atexit
+import functools
+import gzip
+import io
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from navis import transforms
+from navis.utils import CMTKError
+from scipy.spatial import cKDTree
+
+from . import parallel
+from .assets import asset_cache
+from .domain import DomainMixin
+from .lazy import load_once
+from .tps import _parse_points
+
+# Set FLYBRAINS_NATIVE_CMTK=1 to evaluate registrations in numpy instead of
+# calling the streamxform binary
+NATIVE_CMTK = os.environ.get("FLYBRAINS_NATIVE_CMTK", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Points for which inverting a warp does not converge to within this distance
+# (in the units of the registration, typically microns) are considered failed
+INVERSE_TOLERANCE = 1e-6
+
+# Maximum number of iterations when inverting a warp
+INVERSE_MAX_ITER = 50
+
+# Seconds after which idle streamxform processes are shut down
+STREAMXFORM_IDLE_TIMEOUT = float(os.environ.get("FLYBRAINS_CMTK_IDLE_TIMEOUT", 60))
+
+# Maximum number of streamxform processes per registration (chain)
+STREAMXFORM_POOL_SIZE = int(os.environ.get("FLYBRAINS_CMTK_POOL_SIZE", 4))
+
+# Seconds to wait for the next line of output from a streamxform process before
+# it is considered stuck (then killed and restarted)
+STREAMXFORM_TIMEOUT = float(os.environ.get("FLYBRAINS_CMTK_TIMEOUT", 30))
+
+# Make sure streamxform flushes its output after each line - otherwise we might
+# wait forever for results stuck in its output buffer. Without `stdbuf` we
+# can't keep processes around and start a new one for each call instead.
+_STDBUF = ["stdbuf", "-oL"] if shutil.which("stdbuf") else None
+
+_TOKEN_RE = re.compile(r'"[^"]*"|[{}]|[^\s{}"]+')
+
+
+def _is_value(token: str) -> bool:
+    """Check if token is a value (as opposed to a key or brace)."""
+    if token.startswith('"'):
+        return True
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def read_typedstream(fp) -> dict:
+    """Parse CMTK typedstream file (e.g. `registration`).
+
+    Parameters
+    ----------
+    fp :        str | pathlib.Path
+                Path to file. May be gzipped.
+
+    Returns
+    -------
+    dict
+                Nested dictionary. Numbers are parsed into numpy arrays,
+                strings are returned as strings. The version of the file is
+                stored under the "version" key as tuple.
+
+    """
+    fp = pathlib.Path(fp)
+    opener = gzip.open if fp.suffix == ".gz" else open
+    with opener(fp, "rt") as f:
+        text = f.read()
+
+    m = re.match(r"\s*!\s*TYPEDSTREAM\s+(\d+)\.(\d+)", text)
+    version = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+    tokens = _TOKEN_RE.findall(re.sub(r"^\s*!.*$", "", text, flags=re.M))
+
+    root = {"version": version}
+    stack = [root]
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == "}":
+            stack.pop()
+            i += 1
+            continue
+        key = tok
+        i += 1
+        if i < len(tokens) and tokens[i] == "{":
+            section = {}
+            stack[-1][key] = section
+            stack.append(section)
+            i += 1
+            continue
+        # Collect values (numbers or quoted strings)
+        values = []
+        while i < len(tokens) and _is_value(tokens[i]):
+            values.append(tokens[i])
+            i += 1
+        if not values and i < len(tokens) and tokens[i] != "}":
+            # Single unquoted word value (e.g. "absolute yes")
+            values.append(tokens[i])
+            i += 1
+        if not values:
+            stack[-1][key] = None
+        elif not _is_value(values[0]) or values[0].startswith('"'):
+            values = [v.strip('"') for v in values]
+            stack[-1][key] = values[0] if len(values) == 1 else values
+        else:
+            stack[-1][key] = np.array(values, dtype=np.float64)
+
+    return root
+
+
+def _affine_matrix(params: dict, legacy: bool = False) -> np.ndarray:
+    """Build 4x4 (column vector) affine matrix from CMTK parameters."""
+    xlate = params.get("xlate", np.zeros(3))
+    rotate = np.radians(params.get("rotate", np.zeros(3)))
+    if "log_scale" in params:
+        scale = np.exp(params["log_scale"])
+    else:
+        scale = params.get("scale", np.ones(3))
+    shear = params.get("shear", np.zeros(3))
+    center = params.get("center", np.zeros(3))
+
+    if legacy and np.any(shear != 0):
+        # Files written by CMTK < 2.4 use a different shear parameterisation
+        raise NotImplementedError("Shears in legacy (< 2.4) CMTK registrations")
+
+    cos0, cos1, cos2 = np.cos(rotate)
+    sin0, sin1, sin2 = np.sin(rotate)
+
+    # This is CMTK's Matrix4x4::Compose which uses row vectors (x' = x @ M)
+    M = np.eye(4)
+    M[0, :3] = [cos1 * cos2, -cos1 * sin2, -sin1]
+    M[1, :3] = [
+        sin0 * sin1 * cos2 + cos0 * sin2,
+        -sin0 * sin1 * sin2 + cos0 * cos2,
+        sin0 * cos1,
+    ]
+    M[2, :3] = [
+        cos0 * sin1 * cos2 - sin0 * sin2,
+        -cos0 * sin1 * sin2 - sin0 * cos2,
+        cos0 * cos1,
+    ]
+    M[:3, :3] *= scale[:, None]
+
+    for i in (2, 1, 0):
+        S = np.eye(4)
+        S[i // 2, (i // 2) + (i % 2) + 1] = shear[i]
+        M = M @ S
+
+    cM = center @ M[:3, :3]
+    M[3, :3] = xlate - cM + center
+
+    # Convert to column vectors
+    return M.T
+
+
+def _spline_weights(f: np.ndarray):
+    """Cubic B-spline weights (and their derivatives) for 4 control points."""
+    f2, f3 = f**2, f**3
+    w = np.stack(
+        [(1 - f) ** 3, 4 - 6 * f2 + 3 * f3, 1 + 3 * f + 3 * f2 - 3 * f3, f3], axis=-1
+    ) / 6
+    dw = np.stack(
+        [-((1 - f) ** 2) / 2, -2 * f + 1.5 * f2, 0.5 + f - 1.5 * f2, f2 / 2], axis=-1
+    )
+    return w, dw
+
+
+class _AffineReg:
+    """Affine CMTK registration."""
+
+    def __init__(self, params: dict, legacy: bool = False):
+        self.matrix = _affine_matrix(params, legacy=legacy)
+        self.inverse_matrix = np.linalg.inv(self.matrix)
+
+    def forward(self, points, affine_only=False):
+        return points @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+
+    def inverse(self, points, affine_only=False):
+        return points @ self.inverse_matrix[:3, :3].T + self.inverse_matrix[:3, 3]
+
+
+class _SplineWarpReg:
+    """B-spline (`spline_warp`) CMTK registration."""
+
+    def __init__(self, params: dict, legacy: bool = False):
+        if str(params.get("absolute", "yes")) != "yes":
+            raise NotImplementedError("Relative spline coefficients")
+
+        self.affine = _AffineReg(params.get("affine_xform", {}), legacy=legacy)
+        self.dims = params["dims"].astype(int)
+        self.domain = params["domain"]
+        self.origin = params.get("origin", np.zeros(3))
+        self.spacing = self.domain / (self.dims - 3)
+
+        coefs = params["coefficients"]
+        if len(coefs) != 3 * np.prod(self.dims):
+            raise ValueError(
+                f"Expected {3 * np.prod(self.dims)} coefficients, got {len(coefs)}"
+            )
+        # Coefficients are interleaved (x, y, z) per control point, x-fastest
+        self.coefs = coefs.reshape(*self.dims[::-1], 3)
+
+    def in_domain(self, points):
+        rel = points - self.origin
+        return np.all((rel >= 0) & (rel <= self.domain), axis=1)
+
+    def _eval(self, points, jacobian=False):
+        """Evaluate spline (and optionally its Jacobian) at given points."""
+        r = (points - self.origin) / self.spacing
+        grid = np.minimum(np.trunc(r).astype(int), self.dims - 4)
+        grid = np.maximum(grid, 0)
+        f = np.clip(r - grid, 0, 1)
+        w, dw = _spline_weights(f)
+
+        out = np.zeros_like(points)
+        jac = np.zeros((len(points), 3, 3)) if jacobian else None
+        for k in range(4):
+            for j in range(4):
+                wyz = w[:, 1, j] * w[:, 2, k]
+                for i in range(4):
+                    c = self.coefs[grid[:, 2] + k, grid[:, 1] + j, grid[:, 0] + i]
+                    out += c * (w[:, 0, i] * wyz)[:, None]
+                    if jacobian:
+                        jac[:, :, 0] += c * (dw[:, 0, i] * wyz)[:, None]
+                        jac[:, :, 1] += (
+                            c * (w[:, 0, i] * dw[:, 1, j] * w[:, 2, k])[:, None]
+                        )
+                        jac[:, :, 2] += (
+                            c * (w[:, 0, i] * w[:, 1, j] * dw[:, 2, k])[:, None]
+                        )
+        if jacobian:
+            jac /= self.spacing[None, None, :]
+        return out, jac
+
+    def forward(self, points, affine_only=False):
+        if affine_only:
+            return self.affine.forward(points)
+        out = np.full_like(points, np.nan)
+        inside = self.in_domain(points)
+        out[inside] = self._eval(points[inside])[0]
+        return out
+
+    @property
+    def _tree(self):
+        """KD-tree of the deformed control point positions."""
+        # Not `functools.cached_property` which needs Python 3.8
+        if not hasattr(self, "_kdtree"):
+            self._kdtree = cKDTree(self.coefs.reshape(-1, 3))
+        return self._kdtree
+
+    def inverse(self, points, affine_only=False):
+        if affine_only:
+            return self.affine.inverse(points)
+
+        # Points that already failed stay failed
+        out = np.full_like(points, np.nan)
+        valid = np.all(np.isfinite(points), axis=1)
+        if np.any(valid):
+            out[valid] = self._inverse(points[valid])
+        return out
+
+    def _inverse(self, points):
+        # Initial guess: original position of the closest deformed control point
+        _, ix = self._tree.query(points)
+        k, j, i = np.unravel_index(ix, self.coefs.shape[:3])
+        u = self.origin + (np.stack([i, j, k], axis=1) - 1) * self.spacing
+
+        # Newton iterations with step halving
+        res = self._eval(u)[0] - points
+        err = np.linalg.norm(res, axis=1)
+        todo = err > INVERSE_TOLERANCE
+        step = np.ones(len(points))
+        for _ in range(INVERSE_MAX_ITER):
+            if not np.any(todo):
+                break
+            ix = np.where(todo)[0]
+            xf, jac = self._eval(u[ix], jacobian=True)
+            res = (xf - points[ix])[:, :, None]
+            try:
+                delta = np.linalg.solve(jac, res)[:, :, 0]
+            except np.linalg.LinAlgError:
+                # (Near-)singular Jacobian for some points
+                delta = (np.linalg.pinv(jac) @ res)[:, :, 0]
+            cand = u[ix] - delta * step[ix, None]
+            cand_res = np.linalg.norm(self._eval(cand)[0] - points[ix], axis=1)
+            better = cand_res < err[ix]
+            u[ix[better]] = cand[better]
+            err[ix[better]] = cand_res[better]
+            step[ix[better]] = 1
+            step[ix[~better]] /= 2
+            todo = (err > INVERSE_TOLERANCE) & (step > 1e-6)
+
+        u[(err > INVERSE_TOLERANCE) | ~self.in_domain(u)] = np.nan
+        return u
+
+
+@functools.lru_cache(maxsize=128)
+def read_registration(reg: str):
+    """Read (and cache) CMTK registration.
+
+    Parameters
+    ----------
+    reg :       str
+                Path to a CMTK registration directory (e.g. `.list`) or
+                a registration file.
+
+    Returns
+    -------
+    _AffineReg | _SplineWarpReg
+
+    """
+    reg = pathlib.Path(reg)
+    if reg.is_dir():
+        for name in ("registration", "registration.gz"):
+            if (reg / name).is_file():
+                reg = reg / name
+                break
+        else:
+            raise FileNotFoundError(f"No registration file found in {reg}")
+
+    data = read_typedstream(reg)
+    legacy = data["version"] < (2, 4)
+    if "registration" in data:
+        data = data["registration"]
+
+    if "spline_warp" in data:
+        return _SplineWarpReg(data["spline_warp"], legacy=legacy)
+    if "affine_xform" in data:
+        return _AffineReg(data["affine_xform"], legacy=legacy)
+
+    raise NotImplementedError(f"Unsupported CMTK registration {reg}")
+
+
+class _StreamxformTimeout(CMTKError):
+    """streamxform did not produce output in time."""
+
+
+def _format_points(points: np.ndarray) -> bytes:
+    """Points as streamxform input."""
+    buf = io.BytesIO()
+    np.savetxt(buf, points, fmt="%.10g")
+    return buf.getvalue()
+
+
+def _parse_line(line: bytes) -> list:
+    """Parse line of streamxform output ("x y z" or "x y z FAILED")."""
+    values = line.split()
+    if len(values) == 3:
+        return [float(v) for v in values]
+    return [np.nan] * 3
+
+
+def _streamxform_once(args, points: np.ndarray) -> np.ndarray:
+    """Transform points by running streamxform once."""
+    proc = subprocess.run(
+        list(args),
+        input=_format_points(points),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    lines = proc.stdout.splitlines()
+    if len(lines) != len(points):
+        raise CMTKError(
+            f"streamxform returned {len(lines)} instead of {len(points)} points"
+        )
+    xf = np.full((len(points), 3), np.nan)
+    for i, line in enumerate(lines):
+        xf[i] = _parse_line(line)
+    return xf
+
+
+class _StreamxformWorker:
+    """Long-lived streamxform process reading points from stdin."""
+
+    def __init__(self, args):
+        self.proc = subprocess.Popen(
+            _STDBUF + list(args),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.last_used = time.monotonic()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except OSError:
+            # Process died - will be noticed when reading
+            pass
+
+    def _read(self, xf: np.ndarray, progress: list):
+        """Read one line per point into `xf`, counting lines in `progress`."""
+        for i in range(len(xf)):
+            line = self.proc.stdout.readline()
+            if not line:
+                return
+            xf[i] = _parse_line(line)
+            progress[0] = i + 1
+
+    def xform(self, points: np.ndarray, timeout: float = None) -> np.ndarray:
+        timeout = timeout if timeout else STREAMXFORM_TIMEOUT
+
+        # Write from a separate thread: streamxform's output would otherwise
+        # fill up the pipe and block while we are still writing
+        writer = threading.Thread(target=self._write, args=(_format_points(points),))
+        writer.start()
+
+        # Read from another thread so we can give up if streamxform gets stuck
+        xf = np.full((len(points), 3), np.nan)
+        progress = [0]
+        reader = threading.Thread(target=self._read, args=(xf, progress), daemon=True)
+        reader.start()
+        seen = 0
+        while True:
+            reader.join(timeout)
+            if not reader.is_alive():
+                break
+            if progress[0] == seen:
+                # No output for `timeout` seconds: killing the process also
+                # unblocks the reader and writer threads
+                self.kill()
+                reader.join()
+                writer.join()
+                raise _StreamxformTimeout(
+                    f"streamxform did not respond within {timeout} seconds"
+                )
+            seen = progress[0]
+        writer.join()
+
+        if progress[0] < len(points):
+            raise CMTKError("streamxform terminated unexpectedly")
+
+        self.last_used = time.monotonic()
+        return xf
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+class StreamxformPool:
+    """Pool of long-lived streamxform processes.
+
+    Starting streamxform is expensive compared to transforming a few hundred
+    points. This pool keeps processes around (one set per unique list of
+    registrations/arguments) and feeds them points through pipes. Processes
+    idle for longer than `idle_timeout` seconds are shut down; all processes
+    are shut down at interpreter exit. Processes that stop responding (see
+    ``FLYBRAINS_CMTK_TIMEOUT``) are killed and restarted once.
+
+    Keeping processes around requires `stdbuf` to make streamxform flush its
+    output after each point. If `stdbuf` is not available, a new streamxform
+    process is started for every call instead.
+
+    Parameters
+    ----------
+    size :          int
+                    Max number of processes per list of arguments.
+    idle_timeout :  float
+                    Seconds after which idle processes are shut down.
+
+    """
+
+    def __init__(
+        self, size=STREAMXFORM_POOL_SIZE, idle_timeout=STREAMXFORM_IDLE_TIMEOUT
+    ):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._busy = {}
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(v) for v in self._idle.values()) + sum(self._busy.values())
+
+    def _checkout(self, key) -> _StreamxformWorker:
+        with self._cond:
+            while True:
+                idle = self._idle.get(key, [])
+                while idle:
+                    worker = idle.pop()
+                    if worker.alive:
+                        self._busy[key] = self._busy.get(key, 0) + 1
+                        return worker
+                    worker.close()
+                if self._busy.get(key, 0) < self.size:
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    break
+                self._cond.wait()
+
+        try:
+            return _StreamxformWorker(key)
+        except BaseException:
+            self._release(key)
+            raise
+
+    def _release(self, key, worker=None):
+        with self._cond:
+            self._busy[key] -= 1
+            if worker is not None:
+                self._idle.setdefault(key, []).append(worker)
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, daemon=True)
+                    self._reaper.start()
+            self._cond.notify()
+
+    def _reap(self):
+        """Shut down idle processes (runs in a background thread)."""
+        while True:
+            time.sleep(min(self.idle_timeout, 5))
+            now = time.monotonic()
+            with self._cond:
+                expired = []
+                for key, workers in self._idle.items():
+                    keep = [w for w in workers if now - w.last_used < self.idle_timeout]
+                    expired += [w for w in workers if w not in keep]
+                    self._idle[key] = keep
+                self._idle = {k: v for k, v in self._idle.items() if v}
+                # Stop once there is nothing left to watch
+                done = not self._idle
+                if done:
+                    self._reaper = None
+            for w in expired:
+                w.close()
+            if done:
+                return
+
+    def xform(self, args, points: np.ndarray) -> np.ndarray:
+        """Transform points using streamxform with given arguments.
+
+        Parameters
+        ----------
+        args :      list of str
+                    Command (i.e. path to streamxform + arguments).
+        points :    (N, 3) numpy array
+                    Points to transform.
+
+        Returns
+        -------
+        (N, 3) numpy array
+                    Points that failed to transform will be `np.nan`.
+
+        """
+        if _STDBUF is None:
+            return _streamxform_once(args, points)
+
+        key = tuple(str(a) for a in args)
+        for attempt in range(2):
+            worker = self._checkout(key)
+            try:
+                xf = worker.xform(points)
+            except _StreamxformTimeout as e:
+                worker.close()
+                self._release(key)
+                if attempt:
+                    raise
+                warnings.warn(f"{e} - restarting it.")
+                continue
+            except BaseException:
+                worker.close()
+                self._release(key)
+                raise
+            self._release(key, worker)
+            return xf
+
+    def close(self):
+        """Shut down all idle processes."""
+        with self._cond:
+            workers = [w for v in self._idle.values() for w in v]
+            self._idle = {}
+        for w in workers:
+            w.close()
+
+
+# Global pool of streamxform processes
+streamxform_pool = StreamxformPool()
+atexit.register(streamxform_pool.close)
+
+
+class NativeCMTKtransform(DomainMixin, transforms.CMTKtransform):
+    """CMTK transform evaluated in numpy instead of calling streamxform.
+
+    Drop-in replacement for `navis.transforms.CMTKtransform`. Registrations
+    are only read when first needed. Falls back to `streamxform` for
+    registrations with unsupported features (or unless ``FLYBRAINS_NATIVE_CMTK=1``)
+    in which case points are piped through the persistent processes in
+    `streamxform_pool` instead of starting a new process for every call.
+    Points outside the source template are skipped if
+    ``FLYBRAINS_DOMAIN_FILTER`` is set.
+
+    Parameters
+    ----------
+    regs :          str | list of str
+                    Path(s) to CMTK transformations(s).
+    directions :    "forward" | "inverse" | list thereof
+                    Direction of transformation. Must provide one direction per
+                    `reg`.
+    threads :       int, optional
+                    Number of threads to use (only for `streamxform`).
+
+    """
+
+    @property
+    def native(self):
+        """List of parsed registrations. None if not supported natively."""
+        if not NATIVE_CMTK:
+            return None
+        # Parsed (and, if need be, warned about) only once per transform
+        return load_once(self, "_native", self._read_registrations)
+
+    def _read_registrations(self):
+        try:
+            return [read_registration(str(r)) for r in self.regs]
+        except (NotImplementedError, ValueError, KeyError, IndexError) as e:
+            warnings.warn(
+                f"Unable to evaluate CMTK registration natively ({e!r}) - "
+                "falling back to streamxform."
+            )
+            return None
+
+    def check_if_possible(self, on_error: str = "raise"):
+        """Check if this transform is possible."""
+        for r in self.regs:
+            if not os.path.isdir(r) and not os.path.isfile(r):
+                msg = f"Registration {r} not found."
+                if on_error == "raise":
+                    raise BaseException(msg)
+                return msg
+        if self.native is None:
+            return super().check_if_possible(on_error=on_error)
+
+    def copy(self) -> "NativeCMTKtransform":
+        """Return copy."""
+        return self._copy_spaces(super().copy())
+
+    def __neg__(self) -> "NativeCMTKtransform":
+        """Invert direction."""
+        return self._copy_spaces(super().__neg__(), invert=True)
+
+    def append(self, transform, direction: str = None):
+        """Add another transform."""
+        super().append(transform, direction=direction)
+        # Registrations changed: parse again on next use
+        vars(self).pop("_native", None)
+        asset_cache.discard(self, "_native")
+        # Merged transform ends up in the other transform's target space
+        if isinstance(transform, DomainMixin):
+            self.target_space = transform.target_space
+
+    def _xform(self, points: np.ndarray, regs, affine_only: bool) -> np.ndarray:
+        """Xform (N, 3) float array using `regs` (or streamxform if None)."""
+        if regs is None:
+            args = self.make_args(affine_only=affine_only)
+            return streamxform_pool.xform(args, points)
+
+        xf = points
+        for reg, d in zip(regs, self.directions):
+            if d == "forward":
+                xf = reg.forward(xf, affine_only=affine_only)
+            else:
+                xf = reg.inverse(xf, affine_only=affine_only)
+        return xf
+
+    def xform(
+        self,
+        points: np.ndarray,
+        affine_only: bool = False,
+        affine_fallback: bool = False,
+    ) -> np.ndarray:
+        """Xform data.
+
+        Parameters
+        ----------
+        points :            (N, 3) numpy array | pandas.DataFrame
+                            Points to xform. DataFrame must have x/y/z columns.
+        affine_only :       bool
+                            Whether to apply only the affine part of the
+                            transforms.
+        affine_fallback :   bool
+                            If True and some points did not transform during the
+                            non-rigid part of the transformation, we will apply
+                            only the affine transformation to those points.
+
+        Returns
+        -------
+        pointsxf :      (N, 3) numpy array
+                        Transformed points. Points that failed to transform will
+                        be `np.nan`.
+
+        """
+        self.check_if_possible(on_error="raise")
+
+        points = _parse_points(points)
+        regs = self.native
+        func = functools.partial(self._xform, regs=regs, affine_only=affine_only)
+        if affine_only:
+            xf = parallel.xform_chunks(func, points)
+        else:
+            affine = None
+            if affine_fallback:
+                affine = functools.partial(self._xform, regs=regs, affine_only=True)
+            xf = self._xform_in_domain(
+                lambda p: parallel.xform_chunks(func, p), points, affine=affine
+            )
+
+        if affine_fallback and not affine_only:
+            not_xf = np.any(np.isnan(xf), axis=1)
+            if np.any(not_xf):
+                xf[not_xf] = self.xform(points[not_xf], affine_only=True)
+
+        return xf
@@ -17,23 +17,49 @@ import re
 import subprocess
 import shutil
 import pathlib
+import threading
+import time
 import warnings
 
 from textwrap import dedent
 from navis import transforms
 
 import numpy as np
-import pandas as pd
 
+from .cache import find_transforms, get_cache_dir, _read_json, _write_json
 from .download import get_data_home, _total_h5_transforms, _total_cmtk_transforms
-
-__all__ = ["register_transforms", "report"]
+from .landmarks import load_landmarks
+from .lazy import LazyTransform, LazyInvertibleTransform
+from .tps import CachedTPStransform, LocalRBFtransform, ScaledTransform
+from .grid import GridTransform, InvertibleGridTransform, GRID_SPACING
+from .elastix import NativeElastixTransform, NATIVE_ELASTIX
+from .cmtk import NativeCMTKtransform
+from .h5 import H5transform, preferred_level
+from .repack import RepackedH5transform, find_repacked
+from .paths import FusableAffineTransform
+from .domain import get_domain, register_domain
+from .templates import template_meta
+
+__all__ = ["register_transforms", "report", "refresh_nat_regdirs"]
 
 # Read in meta data
 fp = os.path.dirname(__file__)
 
 data_filepath = os.path.join(fp, "data")
 
+# Voxel sizes (in nm) of the "{template}raw" spaces
+VOXEL_SIZES = {
+    # Hemibrain, MANC and MaleCNS are in 8x8x8 nm voxels
+    "JRCFIB2022M": (8, 8, 8),
+    "MANC": (8, 8, 8),
+    "JRCFIB2018F": (8, 8, 8),
+    # FAFB and FLYWIRE are in 4x4x40 nm voxels
+    "FLYWIRE": (4, 4, 40),
+    "FAFB14": (4, 4, 40),
+    # FANC is in 4.3x4.3x45 nm voxels
+    "FANC": (4.3, 4.3, 45),
+}
+
 # Define ALIASES here
 ALIASES = [
     ("hemibrain", "JRCFIB2018F"),
@@ -48,12 +74,97 @@ ALIASES = [
     ("FLYWIRE", "FLYWIREnm"),
 ]
 
+# Engines for landmark-based transforms (see `method` in `_load_tps`)
+LANDMARK_METHODS = {"tps": CachedTPStransform, "local": LocalRBFtransform}
+
+
+def _parse_landmark_method(value: str) -> dict:
+    """Parse FLYBRAINS_LANDMARK_METHOD (e.g. "tps,FANC_mirror_landmarks.csv=local")."""
+    methods = {"*": "tps"}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        fname, _, method = item.rpartition("=")
+        if method not in LANDMARK_METHODS:
+            warnings.warn(
+                f'Ignoring unknown landmark method "{method}" in '
+                "FLYBRAINS_LANDMARK_METHOD - expected one of "
+                f'{", ".join(LANDMARK_METHODS)}.'
+            )
+            continue
+        methods[fname.strip() or "*"] = method
+    return methods
+
+
+# Engine per landmark file ("*" = all other files). Set via the
+# FLYBRAINS_LANDMARK_METHOD environment variable
+LANDMARK_METHOD = _parse_landmark_method(
+    os.environ.get("FLYBRAINS_LANDMARK_METHOD", "")
+)
+
+
+# R code to find the nat.templatebrains, nat.flybrains and nat.jrcbrains
+# regdirs. We do this in a single call because each R startup costs us
+# 1-2 seconds. Each path is printed on its own line.
+_NAT_REGDIRS_CMD = (
+    # This is the basepath for nat.templatebrains
+    # Note that in this case, the registrations will be in subfolders of this
+    # path and the subfolders will be named based on the SHA of the URL the
+    # registrations were downloaded from
+    "p1<-tryCatch(file.path(rappdirs::user_data_dir('rpkg-nat.templatebrains', appauthor=NULL), 'regfolders'), error=function(e) '');"
+    # This is basepath for nat.flybrains
+    "p2<-system.file('extdata', c('bridgingregistrations', 'mirroringregistrations'), package = 'nat.flybrains');"
+    # This is the nat.jrcbrains basepath
+    # These are the h5 Saalfeld registrations
+    "p3<-tryCatch(rappdirs::user_data_dir('R/nat.jrcbrains'), error=function(e) '');"
+    "cat(c(p1, p2, p3), sep='\\n')"
+)
+
+# How long (in seconds) the nat regdirs cached on disk remain valid
+NAT_REGDIRS_TTL = float(os.environ.get("FLYBRAINS_NAT_TTL", 7 * 24 * 60 * 60))
+
+
+def _nat_regdirs_file():
+    return pathlib.Path(get_cache_dir()) / "nat_regdirs.json"
+
+
+def _discover_nat_regdirs(bin):
+    """Ask R for the nat.templatebrain, nat.flybrains and nat.jrcbrains regdirs."""
+    proc = subprocess.run([bin, "-e", _NAT_REGDIRS_CMD], capture_output=True)
 
-@functools.lru_cache()
-def get_nat_regdirs(verbose=False):
-    """Get nat.templatebrain, nat.flybrains and nat.jrcbrains regdirs."""
     regdirs = []
+    for line in proc.stdout.decode().split("\n"):
+        # Skip empty strings (happens if path not set at all)
+        # If we don't skip then we add the current directory
+        # `PosixPath('.')` which will lead to A LOT of recursive
+        # searching
+        if not line.strip():
+            continue
+        regdirs.append(line.strip())
+
+    return regdirs
+
+
+@functools.lru_cache()
+def get_nat_regdirs(verbose=False, ttl=None):
+    """Get nat.templatebrain, nat.flybrains and nat.jrcbrains regdirs.
+
+    Because starting R is slow, the regdirs are cached on disk (see
+    `flybrains.get_cache_dir`) and only re-discovered once the cache is older
+    than `ttl`. Use `refresh_nat_regdirs` to force a refresh.
+
+    Parameters
+    ----------
+    verbose :   bool
+                If True, will warn if R is not found.
+    ttl :       float, optional
+                Max age (in seconds) of the cached regdirs. Defaults to
+                ``NAT_REGDIRS_TTL`` (1 week; can be set via the
+                ``FLYBRAINS_NAT_TTL`` environment variable).
+
+    Returns
+    -------
+    list of pathlib.Path
 
+    """
     # Find R binary
     bin = shutil.which("Rscript")
 
@@ -62,60 +173,52 @@ def get_nat_regdirs(verbose=False):
             warnings.warn("No R binary found.")
         return []
 
-    # This is the basepath for nat.templatebrains
-    # Note that in this case, the registrations will be in subfolders of this
-    # path and the subfolders will be named based on the SHA of the URL the
-    # registrations were downloaded from
-    cmd = "library(rappdirs);file.path(user_data_dir('rpkg-nat.templatebrains', appauthor=NULL), 'regfolders')"
+    ttl = NAT_REGDIRS_TTL if ttl is None else ttl
 
-    # Run the command
-    proc = subprocess.run([bin, "-e", cmd], capture_output=True)
+    cached = _read_json(_nat_regdirs_file())
+    if (
+        cached
+        and cached.get("rscript") == bin
+        and (time.time() - cached.get("timestamp", 0)) < ttl
+    ):
+        return [pathlib.Path(p) for p in cached["regdirs"]]
 
-    # Parse output
-    outstr = proc.stdout.decode()
-    match = re.search('.*?"(.*?)"', outstr)
-    if match and match.group(1).strip() != "":
-        path = pathlib.Path(match.group(1))
-        regdirs.append(path)
+    return refresh_nat_regdirs(bin=bin)
 
-    # This is basepath for nat.flybrains
-    cmd = "regdirs=c('bridgingregistrations', 'mirroringregistrations');system.file('extdata', regdirs, package = 'nat.flybrains')"
 
-    # Run the command
-    proc = subprocess.run([bin, "-e", cmd], capture_output=True)
+def refresh_nat_regdirs(bin=None):
+    """Re-discover nat regdirs via R and update the on-disk cache.
 
-    # Parse output
-    outstr = proc.stdout.decode()
-    for line in outstr.split("\n"):
-        # Skip empty lines
-        if not line:
-            continue
-        match = re.search('.*?"(.*?)"', line)
-        if match:
-            # Skip empty strings (happens if path not set at all)
-            # If we don't skip then we add the current directory
-            # `PosixPath('.')` which will lead to A LOT of recursive
-            # searching
-            if match.group(1).strip() == "":
-                continue
-            path = pathlib.Path(match.group(1))
-            regdirs.append(path)
+    Parameters
+    ----------
+    bin :       str, optional
+                Path to the Rscript binary. If not provided will search for it.
 
-    # This is the nat.jrcbrains basepath
-    # These are the h5 Saalfeld registrations
-    cmd = "library(rappdirs);rappdirs::user_data_dir('R/nat.jrcbrains')"
+    Returns
+    -------
+    list of pathlib.Path
 
-    # Run the command
-    proc = subprocess.run([bin, "-e", cmd], capture_output=True)
+    """
+    if bin is None:
+        bin = shutil.which("Rscript")
 
-    # Parse output
-    outstr = proc.stdout.decode()
-    match = re.search('.*?"(.*?)"', outstr)
-    if match and match.group(1).strip() != "":
-        path = pathlib.Path(match.group(1))
-        regdirs.append(path)
+    # Make sure subsequent calls to `get_nat_regdirs` see the new data
+    get_nat_regdirs.cache_clear()
 
-    return regdirs
+    if not bin:
+        return []
+
+    regdirs = _discover_nat_regdirs(bin)
+
+    try:
+        _write_json(
+            {"rscript": bin, "timestamp": time.time(), "regdirs": regdirs},
+            _nat_regdirs_file(),
+        )
+    except OSError as e:
+        warnings.warn(f"Unable to cache nat regdirs: {e}")
+
+    return [pathlib.Path(p) for p in regdirs]
 
 
 def report():
@@ -127,10 +230,11 @@ def report():
     """)
 
     data_home = pathlib.Path(get_data_home()).expanduser()
+    hits = find_transforms(data_home)
     # Number of .list CMTK directories
-    n_cmtk = len([p for p in data_home.rglob(f"*.list") if p.is_dir()])
+    n_cmtk = len([p for p, kind in hits[".list"] if kind == "dir"])
     # Number of .h5 H5 file
-    n_h5 = len([p for p in data_home.rglob(f"*.h5") if p.is_file()])
+    n_h5 = len([p for p, kind in hits[".h5"] if kind == "file"])
 
     rep += dedent(f"""
     CMTK registrations (Jefferis lab/VFB): {n_cmtk} of {_total_cmtk_transforms}
@@ -149,10 +253,11 @@ def report():
         """)
     else:
         for path in nat_paths:
+            hits = find_transforms(path)
             # Number of .list CMTK directories
-            n_cmtk = len([p for p in path.expanduser().rglob("*.list") if p.is_dir()])
+            n_cmtk = len([p for p, kind in hits[".list"] if kind == "dir"])
             # Number of .h5 H5 file
-            n_h5 = len([p for p in path.expanduser().rglob("*.h5") if p.is_file()])
+            n_h5 = len([p for p, kind in hits[".h5"] if kind == "file"])
             rep += dedent(f"""\
             {path}: {n_cmtk} CMTK | {n_h5} H5 transforms
             """)
@@ -180,46 +285,47 @@ def inject_paths():
     transforms.registry.scan_paths()
 
 
-def _FANCnm_JRCVNC2018F_pre(points):
-    """Apply necessary pre-transforms for FANC -> JRCVNC2018F elastix transform."""
+def _FANCnm_JRCVNC2018F_pre():
+    """Affine matrix with pre-transforms for FANC -> JRCVNC2018F elastix transform."""
     # Dark magic transforms see:
     # https://github.com/htem/GridTape_VNC_paper/blob/main/template_registration_pipeline/register_EM_dataset_to_template/README.md
-    points -= (533.2, 533.2, 945)  # (1.24, 1.24, 2.1) vox at (430, 430, 450)nm/vox
-    points /= (430, 430, 450)
-    points *= (300, 300, 400)
-    points[:, 2] = 435 * 400 - points[:, 2]  # z flipping a stack with 436 slices
+    # (1.24, 1.24, 2.1) vox at (430, 430, 450)nm/vox
+    offset = np.array([533.2, 533.2, 945])
+    # Rescale from (430, 430, 450) to (300, 300, 400) nm/vox
+    scale = np.array([300, 300, 400]) / np.array([430, 430, 450])
+    M = np.diag([*scale, 1])
+    M[:3, 3] = -offset * scale
 
-    # Convert to microns
-    points /= 1000
+    # z flipping a stack with 436 slices
+    flip = np.diag([1.0, 1, -1, 1])
+    flip[2, 3] = 435 * 400
 
-    return points
+    # Convert to microns
+    return np.diag([1e-3, 1e-3, 1e-3, 1]) @ flip @ M
 
 
-def _FANCnm_JRCVNC2018F_reflect(points):
-    """Apply reflect."""
-    # Unreflect
+def _FANCnm_JRCVNC2018F_reflect():
+    """Affine matrix for (un-)reflecting JRCVNC2018F."""
     template_plane_of_symmetry_x_microns = 329 * 0.4
-    points[:, 0] = template_plane_of_symmetry_x_microns * 2 - points[:, 0]
-
-    return points
+    M = np.diag([-1.0, 1, 1, 1])
+    M[0, 3] = template_plane_of_symmetry_x_microns * 2
+    return M
 
 
-def _JRCVNC2018F_FANCnm_post(points):
-    """Apply necessary post-transforms for JRCVNC2018F -> FANCnm elastix transform."""
-    points *= 1000  # Convert microns to nm so that the math below works
+def search_register_path(path, verbose=False, refresh=False):
+    """Search a single path for transforms and register them.
 
-    # Dark magic transforms see:
-    # https://github.com/htem/GridTape_VNC_paper/blob/main/template_registration_pipeline/register_EM_dataset_to_template/README.md
-    points[:, 2] = 435 * 400 - points[:, 2]  # z flipping a stack with 436 slices
-    points /= (300, 300, 400)
-    points *= (430, 430, 450)
-    points += (533.2, 533.2, 945)  # (1.24, 1.24, 2.1) vox at (430, 430, 450)nm/vox
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Path to search (recursively).
+    verbose :   bool
+                If True, will print what's being registered.
+    refresh :   bool
+                If True, will re-scan the directory tree even if we have an
+                up-to-date manifest of transforms in that path.
 
-    return points
-
-
-def search_register_path(path, verbose=False):
-    """Search a single path for transforms and register them."""
+    """
     path = pathlib.Path(path).expanduser()
 
     if verbose:
@@ -229,11 +335,13 @@ def search_register_path(path, verbose=False):
     if not path.is_dir():
         return
 
-    # Find transform files/directories
-    for ext, tr in zip(
-        [".h5", ".list"], [transforms.h5reg.H5transform, transforms.cmtk.CMTKtransform]
-    ):
-        for hit in path.rglob(f"*{ext}"):
+    # Find transform files/directories (this uses a cached manifest)
+    found = find_transforms(path, refresh=refresh)
+    # Unless turned off, CMTK registrations are evaluated in numpy (otherwise
+    # via a pool of persistent streamxform processes). Both H5 and CMTK
+    # transforms are run in parallel chunks if FLYBRAINS_WORKERS > 1
+    for ext, tr in zip([".h5", ".list"], [H5transform, NativeCMTKtransform]):
+        for hit, _ in found[ext]:
             if hit.is_dir() or hit.is_file():
                 # These files are inside the CMTK folders and show as
                 # symlinks in OSX/Linux but as files (?) in Windows
@@ -275,31 +383,29 @@ def search_register_path(path, verbose=False):
                         # or after the main transform. By convention, these are placed as separate
                         # CMTK transforms in a subfolder called either `post_registration` or `pre_registration`.
                         # See also https://github.com/jefferislab/BridgingRegistrations/pull/10
-                        if (hit / "post_registration").exists():
-                            # Define intermediate space
-                            transforms.registry.register_transform(
-                                transform=tr(hit / "post_registration"),
-                                source=f"{source}-{target}(post)",
-                                target=target,
-                                transform_type=transform_type,
-                            )
-                            target = f"{source}-{target}(post)"
+                        # We fold these into a single transform: pre -> main -> post
+                        regs = [str(hit)]
                         if (hit / "pre_registration").exists():
-                            # Define intermediate space
-                            transforms.registry.register_transform(
-                                transform=tr(hit / "pre_registration"),
-                                source=source,
-                                target=f"{source}-{target}(pre)",
-                                transform_type=transform_type,
-                            )
-                            source = f"{source}-{target}(pre)"
-
-                    # Initialize the transform
-                    transform = tr(hit)
+                            regs.insert(0, str(hit / "pre_registration"))
+                        if (hit / "post_registration").exists():
+                            regs.append(str(hit / "post_registration"))
+                        transform = tr(regs, directions=["forward"] * len(regs))
+                    else:
+                        # Prefer the memory-mappable repack of the H5 file
+                        # (see `repack_h5`) if there is an up-to-date one
+                        store = find_repacked(hit)
+                        transform = RepackedH5transform(store) if store else tr(hit)
+                    # This lets the (optional) domain filter skip points
+                    # outside of the source template
+                    transform.set_spaces(source, target)
+
+                    if ext == ".h5":
+                        # Use the (optional) preferred resolution level
+                        transform = transform.at_level(*preferred_level(source, target))
 
                     if verbose:
                         print(
-                            f"Registering {hit} ({tr.__name__}) "
+                            f"Registering {hit} ({type(transform).__name__}) "
                             f'as "{source}" -> "{target}"'
                         )
 
@@ -322,52 +428,132 @@ def register_aliases():
         )
 
 
-def register_mirror_transforms():
-    """Register mirror transforms."""
-    # 1. MaleCNS
-    fp = os.path.join(data_filepath, "maleCNS_mirror_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
+def landmark_method(fname: str) -> str:
+    """Engine ("tps" or "local") used for given landmark file."""
+    return LANDMARK_METHOD.get(fname, LANDMARK_METHOD.get("*", "tps"))
+
+
+def _landmark_transform(lazy, fname, source_cols, target_cols):
+    """Construct landmark transform with the engine configured for `fname`."""
+    # Passing the method explicitly also makes it part of lazy transforms'
+    # signature (see `flybrains.results`)
+    return _make_transform(
+        lazy, _load_tps, fname, source_cols, target_cols, landmark_method(fname)
     )
+
+
+def _load_tps(fname, source_cols, target_cols, method="tps"):
+    """Build landmark transform from landmark file in ./data.
+
+    Parameters
+    ----------
+    method :    "tps" | "local"
+                "tps" builds a (global) thin plate spline, "local" uses
+                compactly supported radial basis functions which scale much
+                better with large numbers of landmarks.
+
+    """
+    if method not in LANDMARK_METHODS:
+        raise ValueError(
+            f'`method` must be one of {", ".join(LANDMARK_METHODS)}, got "{method}"'
+        )
+    # Note: this uses a binary copy of the CSV file and the solved
+    # coefficients are cached on disk
+    source = load_landmarks(fname, source_cols)
+    target = load_landmarks(fname, target_cols)
+    return LANDMARK_METHODS[method](source, target)
+
+
+def _load_elastix(fname, copy_files=(), spaces=(None, None)):
+    """Build Elastix transform from parameter file in ./data.
+
+    Parameters
+    ----------
+    spaces :    (source, target)
+                Source and target space. The domain filter skips points
+                outside of the source space.
+
+    """
+    # If requested, we evaluate the parameter files in numpy instead of
+    # calling transformix
+    if not NATIVE_ELASTIX:
+        return transforms.ElastixTransform(
+            os.path.join(data_filepath, fname),
+            copy_files=[os.path.join(data_filepath, f) for f in copy_files],
+        )
+    return NativeElastixTransform(
+        os.path.join(data_filepath, fname),
+        copy_files=[os.path.join(data_filepath, f) for f in copy_files],
+    ).set_spaces(*spaces)
+
+
+def _fast_mode(tr, template):
+    """Wrap transform in a displacement grid over the template's bounding box.
+
+    Only applies if fast mode is on (i.e. ``FLYBRAINS_GRID_SPACING`` is set).
+    The grid itself is only computed on first use. The grid is only invertible
+    if `tr` is.
+    """
+    if not GRID_SPACING:
+        return tr
+    meta = template_meta[template]
+    units = meta["units"]
+    units = units[0] if isinstance(units, list) else units
+    if units != "nanometers":
+        raise ValueError(f"Expected {template} in nanometers, got {units}")
+    if hasattr(tr, "__neg__"):
+        return InvertibleGridTransform(tr, meta["boundingbox"], GRID_SPACING)
+    return GridTransform(tr, meta["boundingbox"], GRID_SPACING)
+
+
+def _make_transform(lazy, factory, *args, invertible=True):
+    """Construct transform either right away or on first use (lazy)."""
+    if not lazy:
+        return factory(*args)
+    if invertible:
+        return LazyInvertibleTransform(factory, *args)
+    return LazyTransform(factory, *args)
+
+
+def register_mirror_transforms(lazy=False):
+    """Register mirror transforms.
+
+    Parameters
+    ----------
+    lazy :  bool
+            If True, will only parse the landmarks and build the transforms
+            once they are first used.
+
+    """
+    mirr = (("x_flip", "y_flip", "z_flip"), ("x_mirr", "y_mirr", "z_mirr"))
+
+    # 1. MaleCNS
+    tr = _landmark_transform(lazy, "maleCNS_mirror_landmarks_nm.csv", *mirr)
+    tr = _fast_mode(tr, "JRCFIB2022M")
     transforms.registry.register_transform(
         transform=tr, source="JRCFIB2022M", target=None, transform_type="mirror"
     )
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values / 8,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values / 8,
-    )
+    # Raw (8nm voxel) space re-uses the nm transform instead of solving
+    # the same landmarks again
+    tr = ScaledTransform(tr, 8)
     transforms.registry.register_transform(
         transform=tr, source="JRCFIB2022Mraw", target=None, transform_type="mirror"
     )
     # 2. FANC (based on subsampling a FANC -> MANCsym transform)
-    fp = os.path.join(data_filepath, "FANC_mirror_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
-    )
+    tr = _landmark_transform(lazy, "FANC_mirror_landmarks.csv", *mirr)
+    tr = _fast_mode(tr, "FANC")
     transforms.registry.register_transform(
         transform=tr, source="FANC", target=None, transform_type="mirror"
     )
     # 3. FlyWire
-    fp = os.path.join(data_filepath, "FLYWIRE_mirror_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
-    )
+    tr = _landmark_transform(lazy, "FLYWIRE_mirror_landmarks.csv", *mirr)
+    tr = _fast_mode(tr, "FLYWIRE")
     transforms.registry.register_transform(
         transform=tr, source="FLYWIRE", target=None, transform_type="mirror"
     )
     # 4.1 FAFB14 (created by xforming landmarks for FlyWire mirror into FAFB14 space)
-    fp = os.path.join(data_filepath, "FAFB14_mirror_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
-    )
+    tr = _landmark_transform(lazy, "FAFB14_mirror_landmarks.csv", *mirr)
+    tr = _fast_mode(tr, "FAFB14")
     transforms.registry.register_transform(
         transform=tr, source="FAFB14", target=None, transform_type="mirror"
     )
@@ -376,22 +562,14 @@ def register_mirror_transforms():
         transform=tr, source="FAFB", target=None, transform_type="mirror"
     )
     # 5. BANC
-    fp = os.path.join(data_filepath, "BANC_mirror_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
-    )
+    tr = _landmark_transform(lazy, "BANC_mirror_landmarks_nm.csv", *mirr)
+    tr = _fast_mode(tr, "BANC")
     transforms.registry.register_transform(
         transform=tr, source="BANC", target=None, transform_type="mirror"
     )
     # 6. Aedes
-    fp = os.path.join(data_filepath, "Aedes_mirror_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_flip", "y_flip", "z_flip"]].values,
-        lm[["x_mirr", "y_mirr", "z_mirr"]].values,
-    )
+    tr = _landmark_transform(lazy, "Aedes_mirror_landmarks_nm.csv", *mirr)
+    tr = _fast_mode(tr, "AEDES")
     transforms.registry.register_transform(
         transform=tr, source="AEDES", target=None, transform_type="mirror"
     )
@@ -399,9 +577,8 @@ def register_mirror_transforms():
 
 def register_unit_transforms():
     """Add transform between raw (voxel) and nanometer space."""
-    # Hemibrain, MANC and MaleCNS are in 8x8x8 nm voxels
-    for template in ("JRCFIB2022M", "MANC", "JRCFIB2018F"):
-        tr = transforms.AffineTransform(np.diag([8, 8, 8, 1]))
+    for template, voxel_size in VOXEL_SIZES.items():
+        tr = FusableAffineTransform(np.diag([*voxel_size, 1]))
         transforms.registry.register_transform(
             transform=tr,
             source=f"{template}raw",
@@ -409,28 +586,9 @@ def register_unit_transforms():
             transform_type="bridging",
             weight=0.1,
         )
-    # FAFB and FLYWIRE are in 4x4x40 nm voxels
-    for template in ("FLYWIRE", "FAFB14"):
-        tr = transforms.AffineTransform(np.diag([4, 4, 40, 1]))
-        transforms.registry.register_transform(
-            transform=tr,
-            source=f"{template}raw",
-            target=template,
-            transform_type="bridging",
-            weight=0.1,
-        )
-    # FANC is in 4.3x4.3x45 nm voxels
-    tr = transforms.AffineTransform(np.diag([4.3, 4.3, 45, 1]))
-    transforms.registry.register_transform(
-        transform=tr,
-        source="FANCraw",
-        target="FANC",
-        transform_type="bridging",
-        weight=0.1,
-    )
 
     # Bogovic et al seem to have a difference in Z calibration
-    tr = transforms.AffineTransform(np.diag([1, 1, 1 / 0.6220880, 1]))
+    tr = FusableAffineTransform(np.diag([1, 1, 1 / 0.6220880, 1]))
     transforms.registry.register_transform(
         transform=tr,
         source="JFRC2",
@@ -449,7 +607,7 @@ def register_unit_transforms():
         "JRCFIB2022M",
         "BANC",
     ):
-        tr = transforms.AffineTransform(np.diag([1e3, 1e3, 1e3, 1]))
+        tr = FusableAffineTransform(np.diag([1e3, 1e3, 1e3, 1]))
         transforms.registry.register_transform(
             transform=tr,
             source=f"{template}um",
@@ -459,33 +617,45 @@ def register_unit_transforms():
         )
 
 
-def register_manual_transforms():
-    """Manually add some transforms (e.g. from landmark files)."""
+def register_manual_transforms(lazy=False):
+    """Manually add some transforms (e.g. from landmark files).
+
+    Parameters
+    ----------
+    lazy :  bool
+            If True, will only parse the landmarks and build the transforms
+            once they are first used.
+
+    """
     # Add a simple symmetrization transform for FAFB14
-    fp = os.path.join(data_filepath, "FAFB14_symmetrize_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x", "y", "z"]].values, lm[["x_sym", "y_sym", "z_sym"]].values
+    tr = _landmark_transform(
+        lazy,
+        "FAFB14_symmetrize_landmarks_nm.csv",
+        ("x", "y", "z"),
+        ("x_sym", "y_sym", "z_sym"),
     )
+    tr = _fast_mode(tr, "FAFB14")
     transforms.registry.register_transform(
         transform=tr, source="FAFB14", target="FAFB14sym", transform_type="bridging"
     )
     # Add a simple symmetrization transform for FLYWIRE
-    fp = os.path.join(data_filepath, "FLYWIRE_symmetrize_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x", "y", "z"]].values, lm[["x_sym", "y_sym", "z_sym"]].values
+    tr = _landmark_transform(
+        lazy,
+        "FLYWIRE_symmetrize_landmarks_nm.csv",
+        ("x", "y", "z"),
+        ("x_sym", "y_sym", "z_sym"),
     )
+    tr = _fast_mode(tr, "FLYWIRE")
     transforms.registry.register_transform(
         transform=tr, source="FLYWIRE", target="FLYWIREsym", transform_type="bridging"
     )
 
     # Add a male CNS <-> FAFB transform
-    fp = os.path.join(data_filepath, "FAFB14_maleCNS_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["fafb14_x", "fafb14_y", "fafb14_z"]].values,
-        lm[["mcns_x", "mcns_y", "mcns_z"]].values,
+    tr = _landmark_transform(
+        lazy,
+        "FAFB14_maleCNS_landmarks.csv",
+        ("fafb14_x", "fafb14_y", "fafb14_z"),
+        ("mcns_x", "mcns_y", "mcns_z"),
     )
     transforms.registry.register_transform(
         transform=tr, source="FAFB14", target="JRCFIB2022M", transform_type="bridging"
@@ -493,22 +663,22 @@ def register_manual_transforms():
 
     # Add male CNS <-> FlyWire transform. This was generated from the
     # CNS <-> FAFB transform by simply xforming the FAFB coordinates
-    fp = os.path.join(data_filepath, "FLYWIRE_maleCNS_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["flywire_x", "flywire_y", "flywire_z"]].values,
-        lm[["mcns_x", "mcns_y", "mcns_z"]].values,
+    tr = _landmark_transform(
+        lazy,
+        "FLYWIRE_maleCNS_landmarks.csv",
+        ("flywire_x", "flywire_y", "flywire_z"),
+        ("mcns_x", "mcns_y", "mcns_z"),
     )
     transforms.registry.register_transform(
         transform=tr, source="FLYWIRE", target="JRCFIB2022M", transform_type="bridging"
     )
 
     # Add transform for male CNS where the VNC is tilted down 90 degrees (for visualization)
-    fp = os.path.join(data_filepath, "JRCFIB2022M_plotting_landmarks.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["mcns_plot_x", "mcns_plot_y", "mcns_plot_z"]].values,
-        lm[["mcns_x", "mcns_y", "mcns_z"]].values,
+    tr = _landmark_transform(
+        lazy,
+        "JRCFIB2022M_plotting_landmarks.csv",
+        ("mcns_plot_x", "mcns_plot_y", "mcns_plot_z"),
+        ("mcns_x", "mcns_y", "mcns_z"),
     )
     transforms.registry.register_transform(
         transform=tr,
@@ -519,30 +689,38 @@ def register_manual_transforms():
 
     # Add a FANC-MANC transform. These landmarks are created from the
     # CMTK transforms between FANC -> MANCsym -> MANC
-    fp = os.path.join(data_filepath, "MANC_FANC_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_manc", "y_manc", "z_manc"]].values,
-        lm[["x_fanc", "y_fanc", "z_fanc"]].values,
+    tr = _landmark_transform(
+        lazy,
+        "MANC_FANC_landmarks_nm.csv",
+        ("x_manc", "y_manc", "z_manc"),
+        ("x_fanc", "y_fanc", "z_fanc"),
     )
     transforms.registry.register_transform(
         transform=tr, source="MANC", target="FANC", transform_type="bridging"
     )
 
     # MaleCNS - BANC transform
-    fp = os.path.join(data_filepath, "maleCNS_BANC_landmarks_nm.csv")
-    lm = pd.read_csv(fp)
-    tr = transforms.TPStransform(
-        lm[["x_banc", "y_banc", "z_banc"]].values,
-        lm[["x_mcns", "y_mcns", "z_mcns"]].values,
+    tr = _landmark_transform(
+        lazy,
+        "maleCNS_BANC_landmarks_nm.csv",
+        ("x_banc", "y_banc", "z_banc"),
+        ("x_mcns", "y_mcns", "z_mcns"),
     )
     transforms.registry.register_transform(
         transform=tr, source="BANC", target="JRCFIB2022M", transform_type="bridging"
     )
 
 
-def register_fanc_jrcvnc2018f():
-    """Register FANC -> JRCVNC2018F and reverse transforms."""
+def register_fanc_jrcvnc2018f(lazy=False):
+    """Register FANC -> JRCVNC2018F and reverse transforms.
+
+    Parameters
+    ----------
+    lazy :  bool
+            If True, will only build the Elastix transforms once they are
+            first used.
+
+    """
     # Some general notes for the Elastix transform between FANC and JRCVNC2018F:
     # 1. Elastix transforms are not invertible - hence there are two separate
     #    transforms for forward and reverse directions
@@ -554,9 +732,19 @@ def register_fanc_jrcvnc2018f():
     # 3. This transform is technically for FANC v3 but according to Jasper can
     #    also be applied to v4.
 
+    # Domains of the intermediate spaces (used by the optional domain filter)
+    register_domain(
+        "FANCum_fixed",
+        lambda: get_domain("FANC").transformed(_FANCnm_JRCVNC2018F_pre()),
+    )
+    register_domain(
+        "JRCVNC2018F_reflected",
+        lambda: get_domain("JRCVNC2018F").transformed(_FANCnm_JRCVNC2018F_reflect()),
+    )
+
     # First up: forward FANC (nm) -> JRCVNC2018F
     # Preflight for FANCnm (v3) -> JRCVNC2018F
-    tr = transforms.FunctionTransform(_FANCnm_JRCVNC2018F_pre)
+    tr = FusableAffineTransform(_FANCnm_JRCVNC2018F_pre())
     transforms.registry.register_transform(
         transform=tr,
         source="FANC",
@@ -566,8 +754,14 @@ def register_fanc_jrcvnc2018f():
     )
 
     # Elastix FANC_fixed -> JRCVNC2018F (reflected) transform
-    fp = os.path.join(data_filepath, "FANC_JRCVNC2018F/TransformParameters.FixedFANC.txt")
-    tr = transforms.ElastixTransform(fp)
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "FANC_JRCVNC2018F/TransformParameters.FixedFANC.txt",
+        (),
+        ("FANCum_fixed", "JRCVNC2018F_reflected"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="FANCum_fixed",
@@ -576,7 +770,7 @@ def register_fanc_jrcvnc2018f():
     )
 
     # Unreflect
-    tr = transforms.FunctionTransform(_FANCnm_JRCVNC2018F_reflect)
+    tr = FusableAffineTransform(_FANCnm_JRCVNC2018F_reflect())
     transforms.registry.register_transform(
         transform=tr,
         source="JRCVNC2018F_reflected",
@@ -587,7 +781,7 @@ def register_fanc_jrcvnc2018f():
 
     # Now the reverse: JRCVNC2018F -> FANC (nm)
     # First reflect
-    tr = transforms.FunctionTransform(_FANCnm_JRCVNC2018F_reflect)
+    tr = FusableAffineTransform(_FANCnm_JRCVNC2018F_reflect())
     transforms.registry.register_transform(
         transform=tr,
         source="JRCVNC2018F",
@@ -597,9 +791,14 @@ def register_fanc_jrcvnc2018f():
     )
 
     # Second apply Elastix FANC_fixed -> JRCVNC2018F transform
-    fp1 = os.path.join(data_filepath, "FANC_JRCVNC2018F/TransformParameters.FixedTemplate.Bspline.txt")
-    fp2 = os.path.join(data_filepath, "FANC_JRCVNC2018F/TransformParameters.FixedTemplate.affine.txt")
-    tr = transforms.ElastixTransform(fp1, copy_files=[fp2])
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "FANC_JRCVNC2018F/TransformParameters.FixedTemplate.Bspline.txt",
+        ("FANC_JRCVNC2018F/TransformParameters.FixedTemplate.affine.txt",),
+        ("JRCVNC2018F_reflected", "FANCum_fixed"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="JRCVNC2018F_reflected",
@@ -608,7 +807,7 @@ def register_fanc_jrcvnc2018f():
     )
 
     # Postflight for JRCVNC2018F -> FANCnm (v3)
-    tr = transforms.FunctionTransform(_JRCVNC2018F_FANCnm_post)
+    tr = FusableAffineTransform(np.linalg.inv(_FANCnm_JRCVNC2018F_pre()))
     transforms.registry.register_transform(
         transform=tr,
         source="FANCum_fixed",
@@ -618,16 +817,28 @@ def register_fanc_jrcvnc2018f():
     )
 
 
-def register_banc_transforms():
+def register_banc_transforms(lazy=False):
     """Register BANC -> JRC templates and reverse transforms.
 
     Kindly shared by Jasper Phelps. See:
     https://github.com/navis-org/navis-flybrains/issues/17
 
+    Parameters
+    ----------
+    lazy :  bool
+            If True, will only build the Elastix transforms once they are
+            first used.
+
     """
     # First up: forward BANC (um) -> JRC2018F
-    fp = os.path.join(data_filepath, "BANC_JRC2018F/BANC_to_template.txt")
-    tr = transforms.ElastixTransform(fp)
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "BANC_JRC2018F/BANC_to_template.txt",
+        (),
+        ("BANCum", "JRC2018F"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="BANCum",
@@ -635,8 +846,14 @@ def register_banc_transforms():
         transform_type="bridging",
     )
     # Next up: reverse JRC2018F -> BANC (um)
-    fp = os.path.join(data_filepath, "BANC_JRC2018F/3_elastix_Bspline_fine.txt")
-    tr = transforms.ElastixTransform(fp)
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "BANC_JRC2018F/3_elastix_Bspline_fine.txt",
+        (),
+        ("JRC2018F", "BANCum"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="JRC2018F",
@@ -644,8 +861,14 @@ def register_banc_transforms():
         transform_type="bridging",
     )
     # VNC transforms:
-    fp = os.path.join(data_filepath, "BANC_JRCVNC2018F/BANC_to_template.txt")
-    tr = transforms.ElastixTransform(fp)
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "BANC_JRCVNC2018F/BANC_to_template.txt",
+        (),
+        ("BANCum", "JRCVNC2018F"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="BANCum",
@@ -653,8 +876,14 @@ def register_banc_transforms():
         transform_type="bridging",
     )
     # Next up: reverse JRCVNC2018F -> BANC (um)
-    fp = os.path.join(data_filepath, "BANC_JRCVNC2018F/3_elastix_Bspline_fine.txt")
-    tr = transforms.ElastixTransform(fp)
+    tr = _make_transform(
+        lazy,
+        _load_elastix,
+        "BANC_JRCVNC2018F/3_elastix_Bspline_fine.txt",
+        (),
+        ("JRCVNC2018F", "BANCum"),
+        invertible=False,
+    )
     transforms.registry.register_transform(
         transform=tr,
         source="JRCVNC2018F",
@@ -663,8 +892,8 @@ def register_banc_transforms():
     )
 
 
-def register_transforms():
-    """Register transforms with navis."""
+def _search_paths():
+    """Collect paths to scan for transforms (data home, default path, nat regdirs)."""
     # These are the paths we need to scan
     data_home = pathlib.Path(get_data_home()).expanduser()
     default_path = pathlib.Path("~/flybrain-data").expanduser()
@@ -676,8 +905,20 @@ def register_transforms():
         search_paths.append(default_path)
     search_paths += nat_paths
 
+    return search_paths
+
+
+def register_search_paths(refresh=False):
+    """Scan search paths for transforms and register them.
+
+    Parameters
+    ----------
+    refresh :   bool
+                If True, will ignore cached manifests and re-scan all paths.
+
+    """
     # Go over all paths and add transforms
-    for path in search_paths:
+    for path in _search_paths():
         # Do not (re-)move this line! Otherwise is_dir() might fail
         path = pathlib.Path(path).expanduser()
 
@@ -685,23 +926,100 @@ def register_transforms():
         if not path.is_dir():
             continue
 
-        search_register_path(path)
+        search_register_path(path, refresh=refresh)
+
+
+# Registry methods that need to see the path-scanned transforms
+_DEFERRED_HOOKS = (
+    "bridging_graph",
+    "find_mirror_reg",
+    "find_closest_mirror_reg",
+    "summary",
+)
+
+_SCAN_LOCK = threading.RLock()
+
+
+def _ensure_scanned():
+    """Run the search path scan now if it was deferred (see `_defer_path_scan`).
+
+    Call this before looking at `transforms.registry.transforms` directly.
+    """
+    registry = transforms.registry
+    with _SCAN_LOCK:
+        # Restore the original (class) methods before doing anything else
+        # so that this only ever runs once
+        hooks = [registry.__dict__.pop(name, None) for name in _DEFERRED_HOOKS]
+        if any(hooks):
+            register_search_paths()
+
+
+def _defer_path_scan():
+    """Delay scanning the search paths until navis first looks for a transform.
+
+    We temporarily shadow some of the registry's methods with wrappers that
+    run the scan and then restore the original methods.
+    """
+    registry = transforms.registry
+
+    def make_hook(name):
+        method = getattr(registry, name)
+
+        @functools.wraps(method)
+        def hook(*args, **kwargs):
+            _ensure_scanned()
+            return getattr(registry, name)(*args, **kwargs)
+
+        # `registry.clear_caches()` expects this for lru-cached methods
+        if hasattr(method, "cache_clear"):
+            hook.cache_clear = method.cache_clear
+
+        return hook
+
+    for name in _DEFERRED_HOOKS:
+        setattr(registry, name, make_hook(name))
+
+
+def register_transforms(lazy=None):
+    """Register transforms with navis.
+
+    Parameters
+    ----------
+    lazy :  bool, optional
+            If True, transforms are registered but only built when a bridging
+            path first needs them: landmark (TPS) and Elastix transforms are
+            constructed on first use and scanning the data home/nat regdirs
+            for CMTK and H5 transforms is delayed until navis first looks
+            for a bridging or mirror transform. If None (default), will use
+            the ``FLYBRAINS_LAZY`` environment variable (e.g.
+            ``FLYBRAINS_LAZY=1``) and default to False.
+
+    """
+    if lazy is None:
+        lazy = os.environ.get("FLYBRAINS_LAZY", "0").lower() in ("1", "true", "yes")
+
+    if lazy:
+        _defer_path_scan()
+    else:
+        register_search_paths()
 
     # Register some manual transforms
-    register_manual_transforms()
+    register_manual_transforms(lazy=lazy)
 
     # Register FANC -> JRCVNC2018F transform
     # (we put this in a separate function as it is a bit more involved)
-    register_fanc_jrcvnc2018f()
+    register_fanc_jrcvnc2018f(lazy=lazy)
 
     # Add transforms between raw and um space
+    # (these are simple affine transforms - there is nothing to gain from
+    # constructing them lazily)
     register_unit_transforms()
 
     # Register (additional) mirror transforms
-    register_mirror_transforms()
+    register_mirror_transforms(lazy=lazy)
 
     # Register BANC transforms
-    register_banc_transforms()
+    register_banc_transforms(lazy=lazy)
 
     # Register aliases
     register_aliases()
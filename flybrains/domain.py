@@ -0,0 +1,234 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Skip expensive transforms for points outside of their domain.
+
+The domain of a transform is the bounding box (and optionally the mesh) of
+its source template. Points outside of it are either returned as NaN or
+receive only the affine part of the transform.
+"""
+
+import functools
+import os
+import warnings
+
+import navis
+import numpy as np
+
+from navis import transforms
+
+from .lazy import load_once
+from .order import xform_ordered
+from .templates import template_meta
+
+# What to do with points outside a transform's domain: "nan" or "affine". If
+# not set, points are not pre-filtered.
+DOMAIN_FILTER = os.environ.get("FLYBRAINS_DOMAIN_FILTER", "").lower() or None
+if DOMAIN_FILTER not in (None, "nan", "affine"):
+    warnings.warn(
+        f'Unknown FLYBRAINS_DOMAIN_FILTER "{DOMAIN_FILTER}" - expected "nan" '
+        'or "affine". Domain filter is off.'
+    )
+    DOMAIN_FILTER = None
+
+# Fraction by which to pad the bounding boxes
+DOMAIN_MARGIN = float(os.environ.get("FLYBRAINS_DOMAIN_MARGIN", 0.05))
+
+# Set FLYBRAINS_DOMAIN_MESH=1 to also check points against the template meshes
+DOMAIN_MESH = os.environ.get("FLYBRAINS_DOMAIN_MESH", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Resolved domains and factories for spaces that are not templates
+_DOMAINS = {}
+_FACTORIES = {}
+
+_SCALES = {"nanometers": 1, "microns": 1e3}
+
+
+class Domain:
+    """Region of space covered by a template.
+
+    Parameters
+    ----------
+    bbox :      (3, 2) array | list of 6
+                Bounding box: ``[xmin, xmax, ymin, ymax, zmin, zmax]``.
+    template :  str, optional
+                Name of the template whose mesh to use for the (optional)
+                mesh check.
+    scale :     float
+                Factor to convert the mesh into the units of `bbox`.
+
+    """
+
+    def __init__(self, bbox, template=None, scale=1):
+        self.bbox = np.asarray(bbox, dtype=np.float64).reshape(3, 2)
+        self.template = template
+        self.scale = scale
+
+    def __repr__(self):
+        return f"Domain({self.bbox.ravel().tolist()}, template={self.template})"
+
+    @property
+    def volume(self):
+        """Template mesh as navis Volume (None if not available)."""
+        return load_once(self, "_volume", self._load_volume)
+
+    def _load_volume(self):
+        try:
+            mesh = transforms.registry.find_template(self.template).mesh
+            return navis.Volume(mesh.vertices * self.scale, mesh.faces)
+        except BaseException:
+            return None
+
+    def transformed(self, matrix: np.ndarray) -> "Domain":
+        """Return bounding box of this domain after affine transform."""
+        corners = np.array(np.meshgrid(*self.bbox, indexing="ij")).reshape(3, -1).T
+        corners = corners @ matrix[:3, :3].T + matrix[:3, 3]
+        return Domain(np.vstack([corners.min(axis=0), corners.max(axis=0)]).T)
+
+    def contains(self, points: np.ndarray, margin: float = None) -> np.ndarray:
+        """Check which points are inside this domain.
+
+        Parameters
+        ----------
+        points :    (N, 3) array
+                    Points to check.
+        margin :    float, optional
+                    Fraction by which to pad the bounding box. Defaults to
+                    `DOMAIN_MARGIN`.
+
+        Returns
+        -------
+        (N, ) bool array
+
+        """
+        margin = DOMAIN_MARGIN if margin is None else margin
+        pad = (self.bbox[:, 1] - self.bbox[:, 0]) * margin
+        inside = np.all(
+            (points >= self.bbox[:, 0] - pad) & (points <= self.bbox[:, 1] + pad),
+            axis=1,
+        )
+        if DOMAIN_MESH and self.template and np.any(inside):
+            if self.volume is not None:
+                inside[inside] = navis.in_volume(points[inside], self.volume)
+        return inside
+
+
+def register_domain(name: str, factory):
+    """Register domain for a space that is not a template (e.g. intermediates).
+
+    Parameters
+    ----------
+    name :      str
+                Name of the space as used in the bridging graph.
+    factory :   callable
+                Function returning a `Domain`. Called on first use.
+
+    """
+    _FACTORIES[name] = factory
+    _DOMAINS.pop(name, None)
+
+
+def get_domain(name: str):
+    """Get domain for a template space (None if unknown).
+
+    Handles the "um" variants of templates in nanometers (e.g. "FAFB14um").
+    """
+    if name is None:
+        return None
+    if name not in _DOMAINS:
+        if name in _FACTORIES:
+            _DOMAINS[name] = _FACTORIES[name]()
+        else:
+            _DOMAINS[name] = _from_template_meta(name)
+    return _DOMAINS[name]
+
+
+def _from_template_meta(name: str):
+    """Build domain from the template's meta data."""
+    template, scale = name, 1
+    if template not in template_meta and name.endswith("um"):
+        template, scale = name[:-2], 1e-3
+
+    meta = template_meta.get(template, {})
+    units = meta.get("units", None)
+    units = units[0] if isinstance(units, list) else units
+    # We don't trust bounding boxes in e.g. voxels
+    if not meta.get("boundingbox") or units not in _SCALES:
+        return None
+    if scale != 1 and units != "nanometers":
+        return None
+
+    bbox = np.asarray(meta["boundingbox"], dtype=np.float64) * scale
+    return Domain(bbox, template=template, scale=scale)
+
+
+class DomainMixin:
+    """Mixin for transforms that skip points outside of their domain.
+
+    The domain is defined by the names of the source (and target) space of
+    the transform which are set at registration via `set_spaces`.
+    """
+
+    source_space = None
+    target_space = None
+
+    def set_spaces(self, source: str, target: str):
+        """Set source/target space (returns self)."""
+        self.source_space, self.target_space = source, target
+        return self
+
+    def _copy_spaces(self, other, invert: bool = False):
+        """Carry over spaces to `other` (e.g. a copy or inverse)."""
+        if invert:
+            other.set_spaces(self.target_space, self.source_space)
+        else:
+            other.set_spaces(self.source_space, self.target_space)
+        return other
+
+    def _xform_in_domain(self, func, points: np.ndarray, affine=None) -> np.ndarray:
+        """Run `func` only for points inside the domain.
+
+        Points are also sorted along a space-filling curve if
+        ``FLYBRAINS_POINT_ORDER`` is set (see `flybrains.order`).
+
+        Parameters
+        ----------
+        func :      callable
+                    Evaluates the full transform for an (N, 3) array.
+        points :    (N, 3) array
+                    Points to transform.
+        affine :    callable, optional
+                    Evaluates only the affine part of the transform. Used for
+                    points outside the domain if ``DOMAIN_FILTER="affine"``.
+
+        """
+        func = functools.partial(xform_ordered, func, space=self.source_space)
+
+        domain = get_domain(self.source_space) if DOMAIN_FILTER else None
+        if domain is None:
+            return func(points)
+
+        inside = domain.contains(points)
+        if np.all(inside):
+            return func(points)
+
+        out = np.full(points.shape, np.nan)
+        if np.any(inside):
+            out[inside] = func(points[inside])
+        if DOMAIN_FILTER == "affine" and affine is not None:
+            out[~inside] = affine(points[~inside])
+        return out
@@ -0,0 +1,383 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Native (numpy) evaluation of Elastix transform parameter files.
+
+Supports what we ship in ./data: affine and (recursive) B-spline transforms
+of order 3, chained via `InitialTransformParametersFileName`. Anything else
+falls back to calling `transformix`. Results for the shipped parameter files
+are checked against `transformix` in ``tests/test_elastix.py``.
+"""
+
+import os
+import pathlib
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import warnings
+
+from functools import partial
+
+import numpy as np
+
+from navis import transforms
+from navis.utils import make_iterable
+
+from . import parallel
+from .domain import DomainMixin
+from .lazy import load_once
+from .tps import _parse_points
+
+# Set FLYBRAINS_NATIVE_ELASTIX=1 to evaluate parameter files in numpy instead
+# of calling the transformix binary
+NATIVE_ELASTIX = os.environ.get("FLYBRAINS_NATIVE_ELASTIX", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+_PARAM_RE = re.compile(r"^\s*\((\w+)\s*(.*)\)\s*$")
+
+
+def read_parameter_file(fp) -> dict:
+    """Parse Elastix transform parameter file.
+
+    Parameters
+    ----------
+    fp :        str | pathlib.Path
+                Path to parameter file.
+
+    Returns
+    -------
+    dict
+                Maps parameter names to values. Numbers are parsed into
+                numpy arrays, strings are returned as (lists of) strings.
+
+    """
+    params = {}
+    with open(fp, "r") as f:
+        for line in f:
+            line = line.split("//", 1)[0]
+            m = _PARAM_RE.match(line)
+            if not m:
+                continue
+            key, value = m.groups()
+            if '"' in value:
+                value = shlex.split(value)
+                params[key] = value[0] if len(value) == 1 else value
+            else:
+                params[key] = np.array(value.split(), dtype=np.float64)
+    return params
+
+
+def _bspline3(t: np.ndarray) -> np.ndarray:
+    """Cubic B-spline kernel."""
+    t = np.abs(t)
+    return np.where(
+        t < 1, (4 - 6 * t**2 + 3 * t**3) / 6, np.where(t < 2, (2 - t) ** 3 / 6, 0)
+    )
+
+
+class _AffineStep:
+    """Elastix AffineTransform: ``T(x) = A(x - c) + t + c``."""
+
+    def __init__(self, params: dict):
+        p = params["TransformParameters"]
+        if len(p) != 12:
+            raise NotImplementedError(f"Expected 12 affine parameters, got {len(p)}")
+        self.matrix = p[:9].reshape(3, 3)
+        center = params.get("CenterOfRotationPoint", np.zeros(3))
+        self.offset = p[9:] + center - self.matrix @ center
+
+    def __call__(self, points: np.ndarray) -> np.ndarray:
+        return points @ self.matrix.T + self.offset
+
+
+class _TranslationStep:
+    """Elastix TranslationTransform."""
+
+    def __init__(self, params: dict):
+        self.offset = params["TransformParameters"]
+
+    def __call__(self, points: np.ndarray) -> np.ndarray:
+        return points + self.offset
+
+
+class _BSplineStep:
+    """Elastix (Recursive)BSplineTransform of order 3.
+
+    Displacements are ``sum_k c_k * B3(i - k)`` over the 4x4x4 control points
+    around the continuous grid index ``i`` of a point. As in ITK, points
+    outside the grid's valid region are not displaced.
+    """
+
+    def __init__(self, params: dict):
+        order = int(params.get("BSplineTransformSplineOrder", [3])[0])
+        if order != 3:
+            raise NotImplementedError(f"B-spline order {order} not supported")
+        if params.get("UseCyclicTransform", "false") != "false":
+            raise NotImplementedError("Cyclic B-spline transforms not supported")
+
+        self.size = params["GridSize"].astype(int)
+        origin = params["GridOrigin"]
+        spacing = params["GridSpacing"]
+        direction = params.get("GridDirection", np.eye(3).ravel()).reshape(3, 3)
+        index = params.get("GridIndex", np.zeros(3)).astype(int)
+        if np.any(index != 0):
+            raise NotImplementedError("Grid index other than (0, 0, 0) not supported")
+
+        # Physical point -> continuous grid index
+        self.to_index = np.linalg.inv(direction @ np.diag(spacing))
+        self.origin = origin
+
+        coefs = params["TransformParameters"]
+        n = np.prod(self.size)
+        if len(coefs) != 3 * n:
+            raise ValueError(f"Expected {3 * n} B-spline parameters, got {len(coefs)}")
+        # Parameters are ordered x-fastest, one block per dimension
+        self.coefs = coefs.reshape(3, *self.size[::-1])
+
+    def __call__(self, points: np.ndarray) -> np.ndarray:
+        cindex = (points - self.origin) @ self.to_index.T
+
+        # Valid region for order 3 is [1, size - 2)
+        valid = np.all((cindex >= 1) & (cindex < self.size - 2), axis=1)
+        out = points.copy()
+        if not np.any(valid):
+            return out
+        cindex = cindex[valid]
+
+        start = np.floor(cindex).astype(int) - 1
+        # Weights along each axis: (N, 3, 4)
+        offsets = np.arange(4)
+        weights = _bspline3(cindex[:, :, None] - (start[:, :, None] + offsets))
+
+        disp = np.zeros_like(cindex)
+        for i in offsets:
+            for j in offsets:
+                wxy = weights[:, 0, i] * weights[:, 1, j]
+                for k in offsets:
+                    w = wxy * weights[:, 2, k]
+                    c = self.coefs[
+                        :, start[:, 2] + k, start[:, 1] + j, start[:, 0] + i
+                    ]
+                    disp += c.T * w[:, None]
+
+        out[valid] += disp
+        return out
+
+
+_STEPS = {
+    "AffineTransform": _AffineStep,
+    "TranslationTransform": _TranslationStep,
+    "BSplineTransform": _BSplineStep,
+    "RecursiveBSplineTransform": _BSplineStep,
+}
+
+
+def _resolve(name: str, file: pathlib.Path, copy_files) -> pathlib.Path:
+    """Find initial transform file (transformix looks in the working dir)."""
+    for f in copy_files:
+        if pathlib.Path(f).name == pathlib.Path(name).name:
+            return pathlib.Path(f)
+    return file.parent / name
+
+
+def parse_chain(file, copy_files=()) -> list:
+    """Parse Elastix parameter file and its initial transforms.
+
+    Returns
+    -------
+    list
+                ``[(step, combine), ...]`` in order of application where
+                ``combine`` (either "Compose" or "Add") defines how the step
+                is combined with the preceding ones.
+
+    """
+    file = pathlib.Path(file)
+    chain, seen = [], set()
+    while True:
+        if file in seen:
+            raise ValueError(f"Circular initial transforms in {file}")
+        seen.add(file)
+
+        params = read_parameter_file(file)
+        if params.get("UseBinaryFormatForTransformationParameters") == "true":
+            raise NotImplementedError("Binary transform parameters")
+        kind = params.get("Transform", None)
+        if kind not in _STEPS:
+            raise NotImplementedError(f'Transform "{kind}" not supported')
+        combine = params.get("HowToCombineTransforms", "Compose")
+        if combine not in ("Compose", "Add"):
+            raise NotImplementedError(f'Combining transforms via "{combine}"')
+        chain.insert(0, (_STEPS[kind](params), combine))
+
+        initial = params.get("InitialTransformParametersFileName", "NoInitialTransform")
+        if initial == "NoInitialTransform":
+            break
+        file = _resolve(initial, file, copy_files)
+
+    return chain
+
+
+class NativeElastixTransform(DomainMixin, transforms.ElastixTransform):
+    """Elastix transform evaluated in numpy instead of calling transformix.
+
+    Drop-in replacement for `navis.transforms.ElastixTransform`. Parameter
+    files are only parsed when the transform is first used. Falls back to
+    `transformix` for parameter files with unsupported features. Points
+    outside the source template are skipped if ``FLYBRAINS_DOMAIN_FILTER``
+    is set.
+
+    Parameters
+    ----------
+    file :              str
+                        Filepath to elastix transformation file.
+    copy_files :        filepath | list, optional
+                        Any supplemental files (e.g. defining an initial
+                        affine transform).
+
+    """
+
+    @property
+    def chain(self):
+        """Parsed transforms. None if not supported natively."""
+        return load_once(self, "_chain", self._parse_chain)
+
+    def _parse_chain(self):
+        try:
+            return parse_chain(self.file, self.copy_files)
+        except NotImplementedError as e:
+            warnings.warn(
+                f"Unable to evaluate {self.file.name} natively ({e}) - "
+                "falling back to transformix."
+            )
+            return None
+
+    def check_if_possible(self, on_error: str = "raise"):
+        """Check if this transform is possible."""
+        if not self.file.is_file():
+            msg = f"Transformation file {self.file} not found."
+            if on_error == "raise":
+                raise BaseException(msg)
+            return msg
+        if self.chain is None:
+            return super().check_if_possible(on_error=on_error)
+
+    def xform(self, points: np.ndarray, return_logs=False) -> np.ndarray:
+        """Xform data.
+
+        Parameters
+        ----------
+        points :        (N, 3) numpy array | pandas.DataFrame
+                        Points to xform. DataFrame must have x/y/z columns.
+        return_logs :   bool
+                        If True, will run transformix and return logs.
+
+        Returns
+        -------
+        pointsxf :      (N, 3) numpy array
+                        Transformed points.
+
+        """
+        self.check_if_possible(on_error="raise")
+
+        if return_logs:
+            return self._transformix(_parse_points(points), return_logs=True)
+
+        if self.chain is None:
+            func, affine = self._transformix, None
+        else:
+            func, affine = self._native, partial(self._native, affine_only=True)
+        return self._xform_in_domain(
+            lambda p: parallel.xform_chunks(func, p), _parse_points(points), affine
+        )
+
+    def _native(self, points: np.ndarray, affine_only=False) -> np.ndarray:
+        """Xform (N, 3) float array in numpy."""
+        xf = points
+        for step, combine in self.chain:
+            if affine_only and isinstance(step, _BSplineStep):
+                continue
+            if combine == "Add":
+                # T(x) = T_initial(x) + T_current(x) - x
+                xf = xf + step(points) - points
+            else:
+                # T(x) = T_current(T_initial(x))
+                xf = step(xf)
+        return xf
+
+    def _transformix(self, points: np.ndarray, return_logs=False) -> np.ndarray:
+        """Xform (N, 3) float array using the transformix binary.
+
+        Unlike `navis.transforms.ElastixTransform.xform` this does not change
+        the current working directory and is hence safe to run in parallel.
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            p = pathlib.Path(tempdir)
+
+            # Transformix expects secondary transform files in the working dir
+            for f in make_iterable(self.copy_files) if self.copy_files else []:
+                shutil.copy(f, p)
+
+            in_file = p / "inputpoints.txt"
+            self.write_input_file(points, in_file)
+            out_file = p / "outputpoints.txt"
+
+            command = [
+                str(transforms.elastix._elastixbin / "transformix"),
+                "-out",
+                str(p),
+                "-tp",
+                str(self.file),
+                "-def",
+                str(in_file),
+            ]
+            if parallel.ELASTIX_THREADS:
+                command += ["-threads", str(parallel.ELASTIX_THREADS)]
+            proc = subprocess.run(command, stdout=subprocess.PIPE, cwd=p)
+
+            if return_logs:
+                logfile = p / "transformix.log"
+                if not logfile.is_file():
+                    raise FileNotFoundError("No log file found.")
+                return logfile.read_text()
+
+            if not out_file.is_file():
+                raise FileNotFoundError(
+                    "Elastix transform did not produce any "
+                    f"output:\n {proc.stdout.decode()}"
+                )
+            return self.read_output_file(out_file)
+
+    def compare(self, points: np.ndarray) -> np.ndarray:
+        """Compare native against transformix results (requires elastix).
+
+        Parameters
+        ----------
+        points :        (N, 3) numpy array
+                        Points to xform.
+
+        Returns
+        -------
+        (N, ) numpy array
+                        Euclidean distance between native and transformix
+                        results.
+
+        """
+        points = _parse_points(points)
+        native = self._native(points)
+        binary = self._transformix(points)
+        return np.linalg.norm(native - binary, axis=1)
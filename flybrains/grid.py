@@ -0,0 +1,298 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Fast approximation of (smooth) transforms via precomputed displacement grids."""
+
+import hashlib
+import os
+import pathlib
+import threading
+import warnings
+
+import numpy as np
+
+from navis.transforms.base import BaseTransform
+from scipy.ndimage import map_coordinates
+
+from .cache import get_cache_dir, _read_json, _write_json
+from .lazy import LazyTransform, load_once
+from .order import xform_ordered
+from .tps import _parse_points, _run_chunks
+
+# Grid spacing for the fast mode of landmark transforms (in nm). If not set,
+# fast mode is off.
+GRID_SPACING = os.environ.get("FLYBRAINS_GRID_SPACING", None)
+GRID_SPACING = float(GRID_SPACING) if GRID_SPACING else None
+
+# Number of random points used to estimate the error of a grid
+GRID_ERROR_SAMPLES = 100_000
+
+
+def _grid_eval(points, offset, spacing, grid, out):
+    """Trilinear interpolation of displacements for given points."""
+    coords = ((points - offset) / spacing).T
+    for i in range(3):
+        out[:, i] = map_coordinates(grid[i], coords, order=1, prefilter=False)
+    out += points
+    return out
+
+
+class GridTransform(BaseTransform):
+    """Approximate a transform by a regular grid of displacements.
+
+    The displacement of the wrapped transform is rasterized into a regular
+    grid covering the given bounding box (this happens once, on first use).
+    Points are then transformed by trilinear interpolation of the grid which
+    is much faster than e.g. evaluating a thin plate spline. Points outside the
+    bounding box fall back to the exact transform.
+
+    Parameters
+    ----------
+    transform :     BaseTransform
+                    The transform to approximate. If it has a `key` attribute
+                    (e.g. `CachedTPStransform`), the grid will be cached on
+                    disk.
+    bbox :          (3, 2) array | list of 6
+                    Bounding box to rasterize: ``[xmin, xmax, ymin, ymax,
+                    zmin, zmax]``.
+    spacing :       float
+                    Grid spacing (in the units of the transform).
+    margin :        float
+                    Fraction by which to pad the bounding box.
+    dtype :         numpy dtype
+                    Data type for storing the displacements.
+    n_threads :     int, optional
+                    Number of threads to use for interpolation.
+
+    Examples
+    --------
+    Check the error introduced by the grid:
+
+    >>> tr = GridTransform(tps, bbox, spacing=2000)      # doctest: +SKIP
+    >>> tr.max_error                                     # doctest: +SKIP
+    21.3
+
+    Notes
+    -----
+    Use `InvertibleGridTransform` if the wrapped transform can be inverted:
+    navis decides whether to add inverse edges to the bridging graph based on
+    whether the transform has a `__neg__` method.
+
+    """
+
+    def __init__(
+        self,
+        transform: BaseTransform,
+        bbox,
+        spacing: float,
+        margin: float = 0.05,
+        dtype=np.float32,
+        n_threads: int = None,
+    ):
+        """Initialize."""
+        bbox = np.asarray(bbox, dtype=np.float64).reshape(3, 2)
+        if np.any(bbox[:, 1] <= bbox[:, 0]):
+            raise ValueError(f"Invalid bounding box: {bbox.tolist()}")
+        if spacing <= 0:
+            raise ValueError("`spacing` must be positive")
+
+        self.transform = transform
+        self.bbox = bbox
+        self.spacing = float(spacing)
+        self.margin = margin
+        self.dtype = np.dtype(dtype)
+        self.n_threads = n_threads
+
+        pad = (bbox[:, 1] - bbox[:, 0]) * margin
+        self.offset = bbox[:, 0] - pad
+        self.shape = tuple(
+            int(n) for n in np.ceil((bbox[:, 1] + pad - self.offset) / self.spacing) + 1
+        )
+
+    def __eq__(self, other) -> bool:
+        """Check if the same."""
+        if not isinstance(other, GridTransform):
+            return False
+        return (
+            np.all(self.bbox == other.bbox)
+            and self.spacing == other.spacing
+            and self.margin == other.margin
+            and self.dtype == other.dtype
+            and self.transform == other.transform
+        )
+
+    def __repr__(self):
+        built = vars(self).get("_built", None)
+        err = f"{built[1]:.2f}" if built else "NA"
+        return (
+            f"{type(self).__name__}<{type(self.transform).__name__}> "
+            f"(shape={self.shape}, spacing={self.spacing}, max error={err})"
+        )
+
+    @property
+    def key(self) -> str:
+        """Key for caching the grid on disk. None if not cacheable."""
+        tr = self.transform
+        if isinstance(tr, LazyTransform):
+            tr = tr.transform
+        key = getattr(tr, "key", None)
+        if key is None:
+            return None
+        h = hashlib.sha1(
+            str((key, self.bbox.tolist(), self.spacing, self.margin)).encode()
+        )
+        return f"{h.hexdigest()[:20]}-{self.dtype.name}"
+
+    @property
+    def grid(self) -> np.ndarray:
+        """(3, X, Y, Z) array of displacements."""
+        return self._build()[0]
+
+    @property
+    def max_error(self) -> float:
+        """Maximum error vs the exact transform (estimated from random points)."""
+        return self._build()[1]
+
+    def _build(self) -> tuple:
+        """Return ``(grid, max_error)`` (built on first use)."""
+        # Only one thread builds the grid, the others wait for it
+        return load_once(self, "_built", self._build_grid)
+
+    def _build_grid(self) -> tuple:
+        key = self.key
+        if key:
+            fp = pathlib.Path(get_cache_dir()) / "grids" / f"{key}.npy"
+            meta = _read_json(fp.with_suffix(".json"))
+            try:
+                grid = np.load(fp, mmap_mode="r")
+                if meta and grid.shape == (3, *self.shape):
+                    return grid, meta["max_error"]
+            except (OSError, ValueError):
+                pass
+
+        # Rasterize displacements at the grid nodes
+        axes = [
+            self.offset[i] + np.arange(self.shape[i]) * self.spacing for i in range(3)
+        ]
+        nodes = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+        disp = self.transform.xform(nodes) - nodes
+        grid = np.ascontiguousarray(disp.T.reshape(3, *self.shape).astype(self.dtype))
+        max_error = self._estimate_error(grid)
+
+        if key:
+            try:
+                fp.parent.mkdir(parents=True, exist_ok=True)
+                tmp = fp.with_name(
+                    f"{key}.{os.getpid()}-{threading.get_ident()}.tmp.npy"
+                )
+                np.save(tmp, grid)
+                os.replace(tmp, fp)
+                _write_json({"max_error": max_error}, fp.with_suffix(".json"))
+            except OSError as e:
+                warnings.warn(f"Unable to cache displacement grid: {e}")
+
+        return grid, max_error
+
+    def estimate_error(self, n: int = GRID_ERROR_SAMPLES, seed: int = 0) -> float:
+        """Estimate maximum error of the grid vs the exact transform.
+
+        Parameters
+        ----------
+        n :     int
+                Number of random points within the bounding box to test.
+        seed :  int
+                Seed for the random number generator.
+
+        Returns
+        -------
+        float
+                Maximum Euclidean distance between exact and interpolated
+                positions.
+
+        """
+        return self._estimate_error(self.grid, n=n, seed=seed)
+
+    def _estimate_error(self, grid, n: int = GRID_ERROR_SAMPLES, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        size = self.bbox[:, 1] - self.bbox[:, 0]
+        points = self.bbox[:, 0] + rng.random((n, 3)) * size
+        exact = self.transform.xform(points)
+        approx = _run_chunks(
+            _grid_eval, points, len(points), 1, self.offset, self.spacing, grid
+        )
+        return float(np.linalg.norm(exact - approx, axis=1).max())
+
+    def copy(self) -> "GridTransform":
+        """Return copy (shares the grid)."""
+        x = self.__class__.__new__(self.__class__)
+        x.__dict__.update(self.__dict__)
+        return x
+
+    def xform(self, points: np.ndarray) -> np.ndarray:
+        """Transform points.
+
+        Parameters
+        ----------
+        points :    (N, 3) array
+                    Points to transform.
+
+        Returns
+        -------
+        pointsxf :  (N, 3) array
+                    Transformed points.
+
+        """
+        points = _parse_points(points)
+        grid = self.grid
+
+        # Points outside the grid are transformed exactly
+        upper = self.offset + (np.array(self.shape) - 1) * self.spacing
+        inside = np.all((points >= self.offset) & (points <= upper), axis=1)
+
+        out = np.empty_like(points)
+        if np.any(inside):
+            out[inside] = xform_ordered(
+                lambda p: _run_chunks(
+                    _grid_eval,
+                    p,
+                    1_000_000,
+                    self.n_threads,
+                    self.offset,
+                    self.spacing,
+                    grid,
+                ),
+                points[inside],
+            )
+        if not np.all(inside):
+            out[~inside] = self.transform.xform(points[~inside])
+
+        return out
+
+
+class InvertibleGridTransform(GridTransform):
+    """Invertible version of `GridTransform`.
+
+    The inverse approximates the inverse of the wrapped transform over the
+    same bounding box (its grid is built separately on first use).
+    """
+
+    def __neg__(self) -> "InvertibleGridTransform":
+        """Invert direction."""
+        return InvertibleGridTransform(
+            -self.transform,
+            self.bbox,
+            self.spacing,
+            margin=self.margin,
+            dtype=self.dtype,
+            n_threads=self.n_threads,
+        )
@@ -0,0 +1,692 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""H5 (Saalfeld lab) deformation field transforms."""
+
+import contextlib
+import functools
+import itertools
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from navis import transforms
+from scipy.ndimage import map_coordinates
+
+from . import parallel
+from .assets import asset_cache
+from .domain import Domain, DomainMixin, get_domain
+from .paths import clear_plans
+from .tps import _parse_points
+
+__all__ = ["set_h5_level", "compare_h5_levels"]
+
+# Byte budget of the process-wide cache of decoded deformation field chunks
+# (0 = no caching)
+CHUNK_CACHE_BYTES = int(os.environ.get("FLYBRAINS_H5_CACHE_BYTES", 512 * 2**20))
+
+# Block size (in voxels) used for fields that are not stored in chunks
+CONTIGUOUS_BLOCK = 64
+
+# Default resolution level of registered H5 transforms (navis semantics: -1 =
+# finest, -2 = second finest, etc.) or the accuracy (coarsest voxel spacing in
+# the transform's units - microns for the JRC transforms) they should have
+H5_LEVEL = os.environ.get("FLYBRAINS_H5_LEVEL", None)
+H5_LEVEL = int(H5_LEVEL) if H5_LEVEL else None
+H5_ACCURACY = os.environ.get("FLYBRAINS_H5_ACCURACY", None)
+H5_ACCURACY = float(H5_ACCURACY) if H5_ACCURACY else None
+
+# Preferred (level, accuracy) per (source, target) - None acts as wildcard
+_PREFERRED_LEVELS = {}
+
+
+class ChunkCache:
+    """Thread-safe LRU cache for decoded chunks of H5 deformation fields.
+
+    Chunks also count towards the global `asset_cache` budget and may be
+    evicted by it.
+
+    Parameters
+    ----------
+    max_bytes :     int
+                    Byte budget. Least recently used chunks are evicted once
+                    the cached chunks exceed this size.
+
+    """
+
+    def __init__(self, max_bytes: int):
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __repr__(self):
+        return f"ChunkCache({self.info()})"
+
+    @property
+    def max_bytes(self) -> int:
+        """Byte budget. Setting a lower budget evicts chunks immediately."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int):
+        with self._lock:
+            self._max_bytes = int(value)
+            evicted = self._evict()
+        for key in evicted:
+            asset_cache.discard(self, key)
+
+    def _evict(self) -> list:
+        """Evict least recently used chunks until we are within budget."""
+        evicted = []
+        while self._chunks and self.nbytes > self._max_bytes:
+            key, old = self._chunks.popitem(last=False)
+            self.nbytes -= old.nbytes
+            evicted.append(key)
+        return evicted
+
+    def get(self, key):
+        """Return cached chunk (or None) and update the counters."""
+        with self._lock:
+            chunk = self._chunks.get(key, None)
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._chunks.move_to_end(key)
+        if chunk is not None:
+            asset_cache.touch(self, key)
+        return chunk
+
+    def put(self, key, chunk: np.ndarray):
+        """Add chunk and evict least recently used chunks over the budget."""
+        if chunk.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            evicted = self._evict()
+        for old in evicted:
+            asset_cache.discard(self, old)
+        label = f"{os.path.basename(key[0])}{list(key[1:])}"
+        asset_cache.track(self, key, chunk.nbytes, _evict_chunk(key), label)
+
+    def discard(self, key):
+        """Drop chunk (if cached)."""
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is not None:
+                self.nbytes -= chunk.nbytes
+
+    def clear(self):
+        """Drop all chunks and reset the counters."""
+        with self._lock:
+            keys = list(self._chunks)
+            self._chunks.clear()
+            self.nbytes = self.hits = self.misses = 0
+        for key in keys:
+            asset_cache.discard(self, key)
+
+    def info(self) -> dict:
+        """Summary of cache usage."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "chunks": len(self._chunks),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def _evict_chunk(key):
+    """Return function that drops chunk `key` from a `ChunkCache`."""
+    return lambda cache: cache.discard(key)
+
+
+chunk_cache = ChunkCache(CHUNK_CACHE_BYTES)
+
+
+def read_block(field: h5py.Dataset, key: tuple, zyx_slices: tuple) -> np.ndarray:
+    """Read block of a (z, y, x, 3) deformation field via the chunk cache.
+
+    Only the HDF5 chunks overlapping the block are read (and decoded) -
+    chunks already in `chunk_cache` are not read again.
+
+    Parameters
+    ----------
+    field :         h5py.Dataset
+                    Deformation field of shape (z, y, x, 3).
+    key :           tuple
+                    Identifies the field in the cache, e.g. ``(file, level, field)``.
+    zyx_slices :    tuple of slices
+                    Block to read. Slices must have explicit start/stop.
+
+    Returns
+    -------
+    (Z, Y, X, 3) numpy array
+
+    """
+    if chunk_cache.max_bytes <= 0:
+        return field[zyx_slices]
+
+    shape = field.shape[:3]
+    chunks = field.chunks[:3] if field.chunks else (CONTIGUOUS_BLOCK,) * 3
+    start = np.array([s.start for s in zyx_slices])
+    stop = np.array([s.stop for s in zyx_slices])
+
+    out = np.empty(tuple(stop - start) + field.shape[3:], dtype=field.dtype)
+    if np.any(stop <= start):
+        return out
+
+    ranges = [range(a // c, (b - 1) // c + 1) for a, b, c in zip(start, stop, chunks)]
+    for ix in itertools.product(*ranges):
+        c0 = np.array(ix) * chunks
+        c1 = np.minimum(c0 + chunks, shape)
+        chunk = chunk_cache.get(key + ix)
+        if chunk is None:
+            chunk = field[tuple(slice(a, b) for a, b in zip(c0, c1))]
+            chunk_cache.put(key + ix, chunk)
+        # Copy the intersection of chunk and block
+        a, b = np.maximum(c0, start), np.minimum(c1, stop)
+        out[tuple(slice(i, j) for i, j in zip(a - start, b - start))] = chunk[
+            tuple(slice(i, j) for i, j in zip(a - c0, b - c0))
+        ]
+    return out
+
+
+class H5transform(DomainMixin, transforms.h5reg.H5transform):
+    """Hdf5 transform of 3D spatial data.
+
+    Drop-in replacement for `navis.transforms.h5reg.H5transform` that
+    transforms large point clouds in chunks across `parallel.N_WORKERS`
+    threads. Each chunk only reads the part of the deformation field it
+    needs, going through the process-wide LRU `chunk_cache` unless the
+    transform has its own cache (``cache=True``). Points outside the source
+    template are skipped if ``FLYBRAINS_DOMAIN_FILTER`` is set.
+
+    For files with deformation fields at multiple resolutions, a coarser level
+    can be picked per call (see `.xform`) or via `.at_level`.
+
+    See `navis.transforms.h5reg.H5transform` for parameters.
+
+    """
+
+    def __neg__(self) -> "H5transform":
+        """Invert direction."""
+        x = self.__class__(
+            self.file,
+            direction={"forward": "inverse", "inverse": "forward"}[self.direction],
+            level=int(self.level) if self.level else None,
+            cache=self.use_cache,
+        )
+        return self._copy_spaces(x, invert=True)
+
+    def copy(self, drop_cache=False) -> "H5transform":
+        """Return copy (carries over the cache unless `drop_cache=True`)."""
+        x = self.__class__(
+            self.file,
+            direction=self.direction,
+            level=int(self.level) if self.level else None,
+            cache=self.use_cache,
+        )
+        if not drop_cache and self.use_cache:
+            x.cache, x.cached = self.cache, self.cached
+            if hasattr(self, "_fully_ingested"):
+                x._fully_ingested = self._fully_ingested
+        return self._copy_spaces(x)
+
+    @property
+    def levels(self) -> dict:
+        """Available resolution levels -> voxel spacing (z, y, x).
+
+        Empty if the file has only a single deformation field.
+        """
+        if not hasattr(self, "_levels"):
+            with h5py.File(self.file, "r") as h5:
+                levels = [k for k in h5.keys() if k.lstrip("-").isdigit()]
+                self._levels = {
+                    k: np.asarray(h5[k][self.field].attrs["spacing"])
+                    for k in sorted(levels, key=int)
+                }
+        return self._levels
+
+    def level_for_accuracy(self, accuracy: float):
+        """Pick the coarsest level with voxel spacing <= `accuracy`.
+
+        Falls back to the finest level if none is fine enough. Returns None
+        if the file has only a single deformation field.
+        """
+        if not self.levels:
+            return None
+        spacing = {k: sp.max() for k, sp in self.levels.items()}
+        fine = [k for k, sp in spacing.items() if sp <= accuracy]
+        if fine:
+            return int(max(fine, key=spacing.get))
+        return int(min(spacing, key=spacing.get))
+
+    def at_level(self, level=None, accuracy=None) -> "H5transform":
+        """Return this transform at a given resolution level.
+
+        Parameters
+        ----------
+        level :     int, optional
+                    Level to use. Negative values go backwards from the
+                    highest available resolution (-1 = highest, -2 = second
+                    highest, etc).
+        accuracy :  float, optional
+                    Instead of `level`: use the coarsest level with a voxel
+                    spacing of at most `accuracy` (in the transform's units -
+                    microns for the JRC transforms).
+
+        Returns
+        -------
+        H5transform
+                    `self` if that already is the requested level.
+
+        """
+        if accuracy is not None:
+            level = self.level_for_accuracy(accuracy)
+        if level is None or not self.levels:
+            return self
+        if level < 0:
+            # Same as navis: -1 = first (finest) level, -2 = second, etc.
+            level = list(self.levels)[-level - 1]
+        level = str(int(level))
+        if level == self.level:
+            return self
+
+        if not hasattr(self, "_at_level"):
+            self._at_level = {}
+        if level not in self._at_level:
+            x = self.__class__(
+                self.file,
+                direction=self.direction,
+                level=int(level),
+                cache=self.use_cache,
+            )
+            self._at_level[level] = self._copy_spaces(x)
+        return self._at_level[level]
+
+    def compare_levels(self, points=None, n_points: int = 10_000, seed: int = 0):
+        """Measure deviation of each resolution level from the finest level.
+
+        Parameters
+        ----------
+        points :    (N, 3) array, optional
+                    Points to transform. If not provided, will sample
+                    `n_points` random points from the source template's
+                    bounding box (or the extent of the deformation field).
+        n_points :  int
+                    Number of points to sample.
+        seed :      int
+                    Seed for sampling points.
+
+        Returns
+        -------
+        pandas.DataFrame
+                    One row per level with its voxel spacing, the distance
+                    between its results and those of the finest level
+                    (mean, median, 99th percentile and max) and the time it
+                    took to transform the points.
+
+        """
+        if not self.levels:
+            raise ValueError(f"{self.file} has only a single resolution level")
+
+        if points is None:
+            domain = get_domain(self.source_space)
+            if domain is None:
+                domain = self._field_domain()
+            rng = np.random.default_rng(seed)
+            points = rng.uniform(*domain.bbox.T, size=(n_points, 3))
+        points = _parse_points(points)
+
+        spacing = {k: sp.max() for k, sp in self.levels.items()}
+        finest = min(spacing, key=spacing.get)
+
+        data, ref = [], None
+        for level in sorted(spacing, key=spacing.get):
+            start = time.time()
+            xf = self.at_level(int(level)).xform(points, affine_fallback=False)
+            dur = time.time() - start
+            if ref is None:
+                ref = xf
+            dist = np.linalg.norm(xf - ref, axis=1)
+            dist = dist[~np.isnan(dist)]
+            if not len(dist):
+                dist = np.full(1, np.nan)
+            data.append(
+                [
+                    int(level),
+                    spacing[level],
+                    np.mean(dist),
+                    np.median(dist),
+                    np.percentile(dist, 99),
+                    np.max(dist),
+                    dur,
+                ]
+            )
+        return pd.DataFrame(
+            data,
+            columns=[
+                "level",
+                "spacing",
+                "mean",
+                "median",
+                "p99",
+                "max",
+                "time",
+            ],
+        ).set_index("level")
+
+    def _field_domain(self) -> Domain:
+        """Extent of the deformation field in input coordinates."""
+        sp = self.spacing[::-1]
+        domain = Domain(np.vstack([np.zeros(3), np.array(self.shape[:3][::-1]) * sp]).T)
+        if self.direction == "inverse" and self.affine is not None:
+            # The affine part is applied before the deformation field
+            domain = domain.transformed(np.linalg.inv(self.affine))
+        return domain
+
+    @property
+    def affine(self):
+        """(4, 4) affine part of the transform. None if there is none."""
+        if not hasattr(self, "_affine"):
+            with self._open() as field:
+                self._affine = None
+                if "affine" in field.attrs:
+                    self._affine = np.eye(4)
+                    self._affine[:3, :4] = field.attrs["affine"].reshape(3, 4)
+        return self._affine
+
+    def _xform_affine(self, points: np.ndarray) -> np.ndarray:
+        """Apply only the affine part of the transform."""
+        M = self.affine
+        if M is None:
+            return points.copy()
+        return points @ M[:3, :3].T + M[:3, 3]
+
+    def xform(
+        self,
+        points: np.ndarray,
+        affine_fallback: bool = True,
+        force_deform: bool = True,
+        level=None,
+        accuracy=None,
+    ) -> np.ndarray:
+        """Xform data.
+
+        Parameters
+        ----------
+        points :            (N, 3) numpy array | pandas.DataFrame
+                            Points to xform. DataFrame must have x/y/z columns.
+        affine_fallback :   bool
+                            If False, points outside the deformation field will
+                            be returned as `np.nan`. If True, points outside the
+                            deformation field fall back to the affine part of
+                            the transform.
+        force_deform :      bool
+                            If True and `affine_fallback=True`, points outside
+                            the deformation field are deformed using the closest
+                            point inside the field.
+        level :             int, optional
+                            Use a different resolution level for this call
+                            (see `.at_level`).
+        accuracy :          float, optional
+                            Use the coarsest level with a voxel spacing of at
+                            most `accuracy` for this call (see `.at_level`).
+
+        Returns
+        -------
+        pointsxf :          (N, 3) numpy array
+                            Transformed points.
+
+        """
+        if level is not None or accuracy is not None:
+            tr = self.at_level(level=level, accuracy=accuracy)
+            if tr is not self:
+                return tr.xform(points, affine_fallback, force_deform)
+
+        # Only the first chunk warns about points outside the deformation field
+        warned = []
+
+        def func(chunk):
+            warn = not warned
+            warned.append(True)
+            return self._xform(chunk, affine_fallback, force_deform, warn=warn)
+
+        # Worker processes reopen the file (not for transforms with their own
+        # in-memory cache which can't be shared)
+        process_func = None
+        if not self.use_cache:
+            process_func = functools.partial(
+                _xform_chunk,
+                (self.file, self.direction, self.level),
+                affine_fallback,
+                force_deform,
+            )
+
+        return self._xform_in_domain(
+            lambda p: parallel.xform_chunks(func, p, process_func=process_func),
+            _parse_points(points),
+            affine=self._xform_affine if affine_fallback else None,
+        )
+
+    @contextlib.contextmanager
+    def _open(self):
+        """Open the deformation field for reading."""
+        with h5py.File(self.file, "r") as h5:
+            yield h5[self.level][self.field] if self.level else h5[self.field]
+
+    def _read_block(self, field, zyx_slices: tuple) -> np.ndarray:
+        """Read block of the deformation field (via the chunk cache)."""
+        return read_block(field, (self.file, self.level, self.field), zyx_slices)
+
+    def _xform(self, points, affine_fallback, force_deform, warn=True) -> np.ndarray:
+        """Xform points reading the deformation field via the chunk cache.
+
+        Mirrors `navis.transforms.h5reg.H5transform.xform`.
+        """
+        if self.use_cache:
+            # The transform's own cache takes precedence
+            tr = self.copy()
+            tr._silenced_large_out_warning = not warn
+            return super(H5transform, tr).xform(
+                points, affine_fallback=affine_fallback, force_deform=force_deform
+            )
+
+        affine = self.affine
+        affine = transforms.AffineTransform(affine) if affine is not None else None
+        with self._open() as field:
+            qm = field.attrs.get("quantization_multiplier", 1)
+            spacing = field.attrs["spacing"]
+
+            # For inverse direction, the affine part is applied first
+            if self.direction == "inverse" and affine:
+                xf = affine.xform(points)
+            else:
+                xf = points
+            affine_xf = xf.copy()
+
+            # Voxel coordinates (spacing is given in z, y, x)
+            xf_voxel = xf / spacing[::-1]
+            xf_indices = xf_voxel.round().astype(int)
+
+            # Bounding box of the deformation vectors we need (+ padding for
+            # the interpolation)
+            mn = xf_indices.min(axis=0) - 2
+            mx = xf_indices.max(axis=0) + 2
+            mn = np.clip(mn, 2, np.array(self.shape[:-1][::-1])) - 2
+            mx = np.clip(mx, 0, np.array(self.shape[:-1][::-1]) - 2) + 2
+
+            offsets = self._read_block(
+                field, (slice(mn[2], mx[2]), slice(mn[1], mx[1]), slice(mn[0], mx[0]))
+            )
+
+        is_out = (xf_voxel.min(axis=1) < 0) | np.any(
+            xf_voxel >= self.shape[:-1][::-1], axis=1
+        )
+        frac_out = is_out.sum() / xf_voxel.shape[0]
+        if warn and frac_out > 0.2:
+            transforms.h5reg.logger.warning(
+                f"A suspiciously large fraction ({frac_out:.1%}) "
+                f"of {xf_voxel.shape[0]} points appear to be outside "
+                "the H5 deformation field. Please make doubly sure "
+                "that the input coordinates are in the correct "
+                "space/units"
+            )
+
+        coords = xf_voxel[:, ::-1].T - mn[::-1].reshape(3, 1)
+        mode = "nearest" if affine_fallback and force_deform else "constant"
+        cval = 0 if mode == "nearest" else np.nan
+        offset_vxl = np.vstack(
+            [
+                map_coordinates(offsets[..., i], coords, order=1, mode=mode, cval=cval)
+                for i in range(3)
+            ]
+        ).T
+
+        xf = xf + offset_vxl * qm
+
+        # For forward direction, the affine part is applied last
+        if self.direction == "forward" and affine:
+            xf = affine.xform(xf)
+            affine_xf = affine.xform(affine_xf)
+
+        if affine_fallback and not force_deform and is_out.any():
+            xf[is_out, :] = affine_xf[is_out, :]
+        if not affine_fallback:
+            xf[is_out, :] = np.nan
+
+        return xf
+
+
+@functools.lru_cache(maxsize=16)
+def _worker_transform(file: str, direction: str, level) -> H5transform:
+    """H5 transform in a worker process (kept around between chunks)."""
+    return H5transform(file, direction=direction, level=int(level) if level else None)
+
+
+def _xform_chunk(spec: tuple, affine_fallback, force_deform, points, first):
+    """Xform chunk of points in a worker process (see `parallel.xform_chunks`)."""
+    tr = _worker_transform(*spec)
+    return tr._xform(points, affine_fallback, force_deform, warn=first)
+
+
+def preferred_level(source: str, target: str) -> tuple:
+    """Get the preferred ``(level, accuracy)`` for an H5 transform."""
+    for key in ((source, target), (source, None), (None, target), (None, None)):
+        if key in _PREFERRED_LEVELS:
+            return _PREFERRED_LEVELS[key]
+    return H5_LEVEL, H5_ACCURACY
+
+
+def set_h5_level(level=None, accuracy=None, source=None, target=None):
+    """Set the resolution level of registered H5 transforms.
+
+    Coarser levels are much faster to read and need less memory, which is
+    useful for e.g. interactive plotting or screening large numbers of
+    neurons. Applies to transforms that are already registered and to those
+    registered later.
+
+    Parameters
+    ----------
+    level :     int, optional
+                Level to use. Negative values go backwards from the highest
+                available resolution (-1 = highest, -2 = second highest, etc).
+    accuracy :  float, optional
+                Instead of `level`: use the coarsest level with a voxel
+                spacing of at most `accuracy` (in the transform's units -
+                microns for the JRC transforms).
+    source :    str, optional
+                Only change transforms from this source. Note that transforms
+                for templates in nanometers are registered with an "um" suffix
+                (e.g. "FAFB14um").
+    target :    str, optional
+                Only change transforms to this target.
+
+    Examples
+    --------
+    >>> import flybrains
+    >>> # Use a coarse level for everything
+    >>> flybrains.set_h5_level(accuracy=5)
+    >>> # ... and then back to full resolution
+    >>> flybrains.set_h5_level(level=-1)
+
+    """
+    _PREFERRED_LEVELS[(source, target)] = (level, accuracy)
+
+    registry = transforms.registry
+    for i, t in enumerate(registry.transforms):
+        if not isinstance(t.transform, H5transform):
+            continue
+        if source not in (None, t.source) or target not in (None, t.target):
+            continue
+        tr = t.transform.at_level(*preferred_level(t.source, t.target))
+        registry.transforms[i] = t._replace(transform=tr)
+
+    registry.clear_caches()
+    clear_plans()
+
+
+def compare_h5_levels(source: str, target: str, points=None, n_points=10_000):
+    """Measure deviation between resolution levels of an H5 transform.
+
+    Parameters
+    ----------
+    source :    str
+                Source of the registered H5 transform (e.g. "FAFB14um").
+    target :    str
+                Target of the registered H5 transform (e.g. "JRC2018F").
+    points :    (N, 3) array, optional
+                Points (in `source` space) to transform. If not provided,
+                will sample `n_points` random points from the source
+                template's bounding box.
+    n_points :  int
+                Number of points to sample.
+
+    Returns
+    -------
+    pandas.DataFrame
+                See `H5transform.compare_levels`.
+
+    """
+    # Avoid circular import
+    from .core import _ensure_scanned
+
+    # With FLYBRAINS_LAZY=1, H5 transforms are only registered by the scan
+    _ensure_scanned()
+    for t in transforms.registry.transforms:
+        if not isinstance(t.transform, H5transform):
+            continue
+        if (t.source, t.target) == (source, target):
+            return t.transform.compare_levels(points=points, n_points=n_points)
+        if (t.source, t.target) == (target, source):
+            return (-t.transform).compare_levels(points=points, n_points=n_points)
+    raise ValueError(f'No H5 transform registered between "{source}" and "{target}"')
@@ -0,0 +1,145 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Binary store for the landmark files in ./data.
+
+The CSV files remain the source of truth. On first use, each CSV is converted
+into a `.npy` file (float64, columns in the same order as in the CSV) in the
+flybrains cache directory. The file name contains the hash of the CSV, so
+whenever a CSV changes its binary copy is rebuilt automatically. Hashes are
+kept in an index keyed by path, size and modification time so that loads
+don't have to read the CSV.
+"""
+
+import hashlib
+import os
+import pathlib
+import warnings
+
+import numpy as np
+
+from .cache import get_cache_dir, _read_json, _write_json
+
+# Read in meta data
+fp = os.path.dirname(__file__)
+
+data_filepath = os.path.join(fp, "data")
+
+# Content hashes of CSV files we have already seen in this process
+_CSV_HASHES = {}
+
+
+def _landmarks_dir() -> pathlib.Path:
+    return pathlib.Path(get_cache_dir()) / "landmarks"
+
+
+def _csv_hash(fp: str) -> str:
+    """Content hash of a CSV file.
+
+    Hashes are stored in an index (keyed by path, size and mtime) so that we
+    don't have to read the file again.
+    """
+    fp = os.path.abspath(fp)
+    st = os.stat(fp)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if _CSV_HASHES.get(fp, [None])[:2] == stamp:
+        return _CSV_HASHES[fp][2]
+
+    index_fp = _landmarks_dir() / "index.json"
+    index = _read_json(index_fp) or {}
+    if index.get(fp, [None])[:2] != stamp:
+        with open(fp, "rb") as f:
+            index[fp] = stamp + [hashlib.sha1(f.read()).hexdigest()]
+        try:
+            _write_json(index, index_fp)
+        except OSError:
+            # Read-only cache: hash again next session
+            pass
+    _CSV_HASHES[fp] = index[fp]
+    return index[fp][2]
+
+
+def _parse_header(line: bytes) -> list:
+    """Parse column names from CSV header."""
+    return [c.strip().strip('"') for c in line.decode().strip().split(",")]
+
+
+def _build(csv_fp: str, npy_fp: pathlib.Path) -> np.ndarray:
+    """Parse CSV and write binary copy."""
+    # Pandas is only needed to (re-)build the binary copy
+    import pandas as pd
+
+    data = pd.read_csv(csv_fp).values.astype(np.float64)
+
+    try:
+        npy_fp.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first to avoid other processes picking up
+        # a partially written file
+        tmp = npy_fp.with_name(f"{npy_fp.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp, data)
+        os.replace(tmp, npy_fp)
+
+        # Remove binary copies of previous versions of this CSV
+        stem = npy_fp.stem.rsplit("-", 1)[0]
+        for f in npy_fp.parent.glob(f"{stem}-*.npy"):
+            if f != npy_fp:
+                # Might have been removed by another process in the meantime
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        warnings.warn(f"Unable to write landmark store {npy_fp}: {e}")
+
+    return data
+
+
+def load_landmarks(fname: str, columns=None) -> np.ndarray:
+    """Load landmarks from the binary store.
+
+    Parameters
+    ----------
+    fname :     str
+                Name of the CSV file in ``flybrains/data``.
+    columns :   list of str, optional
+                Columns to return (in that order). If None, will return all
+                columns.
+
+    Returns
+    -------
+    (N, M) numpy array
+                Read-only (memory-mapped) if no columns are selected.
+
+    """
+    csv_fp = os.path.join(data_filepath, fname)
+
+    with open(csv_fp, "rb") as f:
+        header = _parse_header(f.readline())
+
+    sha = _csv_hash(csv_fp)[:16]
+    npy_fp = _landmarks_dir() / f"{pathlib.Path(fname).stem}-{sha}.npy"
+
+    try:
+        data = np.load(npy_fp, mmap_mode="r")
+    except (OSError, ValueError):
+        data = _build(csv_fp, npy_fp)
+
+    if data.ndim != 2 or data.shape[1] != len(header):
+        # Something is off - rebuild
+        data = _build(csv_fp, npy_fp)
+
+    if columns is None:
+        return data
+
+    ix = [header.index(c) for c in columns]
+    return np.asarray(data[:, ix])
@@ -0,0 +1,228 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Transforms that are only constructed when they are first needed."""
+
+import os
+import threading
+import weakref
+
+from inspect import signature
+
+import numpy as np
+
+from navis.transforms.base import BaseTransform
+
+from .assets import asset_cache, describe, sizeof
+
+
+_ATTR_LOCKS = {}
+_ATTR_LOCKS_LOCK = threading.Lock()
+
+
+def attr_lock(obj, attr) -> threading.RLock:
+    """Get the lock guarding the lazy initialization of `obj.<attr>`.
+
+    There is one (re-entrant) lock per object and attribute, so threads
+    initializing different attributes don't block each other. Locks are
+    dropped when their object is garbage collected.
+    """
+    key = (id(obj), attr)
+    with _ATTR_LOCKS_LOCK:
+        lock = _ATTR_LOCKS.get(key, None)
+        if lock is None:
+            lock = _ATTR_LOCKS[key] = threading.RLock()
+            try:
+                weakref.finalize(obj, _ATTR_LOCKS.pop, key, None)
+            except TypeError:
+                # Not weak-referenceable (e.g. a dict): keep the lock
+                pass
+    return lock
+
+
+def _store(obj) -> dict:
+    """Dict holding the attributes of `obj` (or `obj` itself if a dict)."""
+    return obj if isinstance(obj, dict) else vars(obj)
+
+
+def load_once(obj, attr, func, label: str = None):
+    """Return `obj.<attr>`, setting it to `func()` on first access.
+
+    Thread-safe: if several threads ask for the missing attribute at the same
+    time, `func` is run by only one of them and the others wait for its
+    result. If `func` raises, nothing is set and the next call tries again.
+
+    The attribute is registered with the `asset_cache` and may be dropped
+    again (and reloaded on next access) to stay within the memory budget.
+    If `obj` is a dict, `attr` is used as key instead.
+    """
+    try:
+        value = _store(obj)[attr]
+        asset_cache.touch(obj, attr)
+        return value
+    except KeyError:
+        pass
+    with attr_lock(obj, attr):
+        try:
+            return _store(obj)[attr]
+        except KeyError:
+            pass
+        value = _store(obj)[attr] = func()
+    nbytes = sizeof(value)
+    if nbytes:
+        label = label if label else describe(obj, attr)
+        asset_cache.track(obj, attr, nbytes, _drop_attr(attr), label)
+    return value
+
+
+def _drop_attr(attr):
+    """Return function that deletes `attr` from an object."""
+    return lambda obj: _store(obj).pop(attr, None)
+
+
+class _Loader:
+    """Shared holder for a lazily constructed transform.
+
+    Copies of a `LazyTransform` share the same loader so that the (potentially
+    expensive) construction only happens once - even if several threads need
+    the transform at the same time. The transform is registered with the
+    `asset_cache` and constructed again if it was dropped to stay within the
+    memory budget.
+    """
+
+    def __init__(self, factory, args):
+        self.factory = factory
+        self.args = args
+
+    @property
+    def label(self) -> str:
+        """Description of the transform."""
+        args = ", ".join(
+            os.path.basename(a) if isinstance(a, str) else type(a).__name__
+            for a in self.args
+        )
+        return f"{getattr(self.factory, '__name__', 'transform')}({args})"
+
+    @property
+    def value(self):
+        """The transform (None if not yet constructed)."""
+        return vars(self).get("_value", None)
+
+    def get(self):
+        return load_once(self, "_value", lambda: self.factory(*self.args))
+
+
+class LazyTransform(BaseTransform):
+    """Transform that is constructed on first use.
+
+    Parameters
+    ----------
+    factory :   callable
+                Function that returns the actual transform. Will be called
+                with `*args` the first time the transform is needed.
+    *args
+                Arguments for `factory`. These are also used to compare lazy
+                transforms, so they should be hashable/comparable (e.g. file
+                names and column names).
+
+    Notes
+    -----
+    Use `LazyInvertibleTransform` if the wrapped transform can be inverted:
+    navis decides whether to add inverse edges to the bridging graph based on
+    whether the transform has a `__neg__` method.
+
+    """
+
+    def __init__(self, factory, *args):
+        """Initialize."""
+        if not callable(factory):
+            raise TypeError("`factory` must be callable")
+        self._loader = _Loader(factory, args)
+
+    def __eq__(self, other) -> bool:
+        """Check if the same."""
+        if not isinstance(other, LazyTransform):
+            return False
+        return (self._loader.factory, self._loader.args) == (
+            other._loader.factory,
+            other._loader.args,
+        )
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"{self.__class__.__name__}<{self._loader.factory.__name__}{self._loader.args}> ({state})"
+
+    @property
+    def is_loaded(self) -> bool:
+        """Whether the wrapped transform has already been constructed."""
+        return self._loader.value is not None
+
+    @property
+    def transform(self) -> BaseTransform:
+        """The wrapped transform (constructed on first access)."""
+        return self._loader.get()
+
+    def check_if_possible(self, on_error: str = "raise"):
+        """Test if running the transform is possible."""
+        return self.transform.check_if_possible(on_error=on_error)
+
+    def copy(self) -> "LazyTransform":
+        """Return copy (shares the underlying transform)."""
+        x = self.__class__.__new__(self.__class__)
+        x.__dict__.update(self.__dict__)
+        return x
+
+    def xform(
+        self, points: np.ndarray, affine_fallback: bool = True, **kwargs
+    ) -> np.ndarray:
+        """Xform data.
+
+        Parameters
+        ----------
+        points :            (N, 3) numpy array
+                            Points to xform.
+        affine_fallback :   bool
+                            Passed through to the wrapped transform if it
+                            supports it.
+        **kwargs
+                            Passed through to the wrapped transform.
+
+        Returns
+        -------
+        pointsxf :      (N, 3) numpy array
+                        Transformed points.
+
+        """
+        tr = self.transform
+        if "affine_fallback" in signature(tr.xform).parameters:
+            kwargs["affine_fallback"] = affine_fallback
+        return tr.xform(points, **kwargs)
+
+
+class LazyInvertibleTransform(LazyTransform):
+    """Invertible version of `LazyTransform`.
+
+    The inverse is itself lazy and will only construct the wrapped transform
+    when it is first used.
+    """
+
+    def __neg__(self) -> "LazyInvertibleTransform":
+        """Invert direction."""
+        return LazyInvertibleTransform(_negate, self)
+
+
+def _negate(tr):
+    """Return inverse of given (lazy) transform."""
+    if isinstance(tr, LazyTransform):
+        tr = tr.transform
+    return -tr
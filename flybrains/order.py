@@ -0,0 +1,195 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Sort points along a space-filling curve before grid-backed transforms.
+
+Points from neurons or synapse tables come in arbitrary order. Sorting them
+along a Morton (Z-order) or Hilbert curve means that neighbouring points -
+and hence each chunk of points - touch only a small part of a deformation
+field or B-spline grid. Results are returned in the original order.
+"""
+
+import os
+import warnings
+
+import numpy as np
+
+from .templates import template_meta
+
+# Curve to sort points along before grid-backed transforms: "morton" or
+# "hilbert". If not set, points are transformed in the order they come in.
+POINT_ORDER = os.environ.get("FLYBRAINS_POINT_ORDER", "").lower() or None
+if POINT_ORDER not in (None, "morton", "hilbert"):
+    warnings.warn(
+        f'Unknown FLYBRAINS_POINT_ORDER "{POINT_ORDER}" - expected "morton" '
+        'or "hilbert". Points will not be sorted.'
+    )
+    POINT_ORDER = None
+
+# Don't bother sorting fewer points than this
+ORDER_MIN_POINTS = 1_000
+
+# Max number of bits per axis used for the curve
+ORDER_MAX_BITS = 16
+
+_SCALES = {"nanometers": 1, "microns": 1e3}
+
+
+def _voxel_grid(space: str):
+    """Get ``(origin, voxdims, dims)`` of a template's voxel grid (or None)."""
+    template, scale = space, 1
+    if template not in template_meta and str(space).endswith("um"):
+        template, scale = space[:-2], 1e-3
+
+    meta = template_meta.get(template, {})
+    units = meta.get("units", None)
+    units = units[0] if isinstance(units, list) else units
+    if not meta.get("dims") or not meta.get("voxdims") or units not in _SCALES:
+        return None
+    if scale != 1 and units != "nanometers":
+        return None
+
+    bbox = meta.get("boundingbox", None)
+    origin = np.asarray(bbox, dtype=np.float64)[::2] if bbox else np.zeros(3)
+    voxdims = np.asarray(meta["voxdims"], dtype=np.float64)
+    return origin * scale, voxdims * scale, np.asarray(meta["dims"])
+
+
+def _interleave(X: np.ndarray, bits: int) -> np.ndarray:
+    """Interleave bits of (N, 3) integer array (first column most significant)."""
+    ix = np.zeros(len(X), dtype=np.uint64)
+    for b in range(bits - 1, -1, -1):
+        for i in range(3):
+            ix = (ix << np.uint64(1)) | ((X[:, i] >> np.uint64(b)) & np.uint64(1))
+    return ix
+
+
+def morton_index(ijk: np.ndarray, bits: int) -> np.ndarray:
+    """Morton (Z-order) index of (N, 3) integer grid coordinates."""
+    return _interleave(ijk.astype(np.uint64), bits)
+
+
+def hilbert_index(ijk: np.ndarray, bits: int) -> np.ndarray:
+    """Hilbert index of (N, 3) integer grid coordinates.
+
+    Vectorized version of J. Skilling's algorithm ("Programming the Hilbert
+    curve", AIP Conf. Proc. 707, 2004).
+    """
+    X = ijk.astype(np.uint64)
+
+    # Inverse undo
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = np.uint64(Q - 1)
+        for i in range(3):
+            flip = (X[:, i] & np.uint64(Q)) != 0
+            if i == 0:
+                X[:, 0] ^= np.where(flip, P, np.uint64(0))
+                continue
+            # Invert low bits of X[0] if bit is set, else exchange them with X[i]
+            t = np.where(flip, np.uint64(0), (X[:, 0] ^ X[:, i]) & P)
+            X[:, 0] ^= np.where(flip, P, t)
+            X[:, i] ^= t
+        Q >>= 1
+
+    # Gray encode
+    for i in range(1, 3):
+        X[:, i] ^= X[:, i - 1]
+    t = np.zeros(len(X), dtype=np.uint64)
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        t[(X[:, 2] & np.uint64(Q)) != 0] ^= np.uint64(Q - 1)
+        Q >>= 1
+    X ^= t[:, None]
+
+    return _interleave(X, bits)
+
+
+def point_order(points: np.ndarray, space: str = None, curve: str = "hilbert"):
+    """Get the order of points along a space-filling curve.
+
+    Parameters
+    ----------
+    points :    (N, 3) array
+                Points to sort.
+    space :     str, optional
+                Template space the points are in. If its voxel grid (`dims` and
+                `voxdims`) is known, the curve runs through that grid.
+                Otherwise the grid is fitted to the points.
+    curve :     "hilbert" | "morton"
+                Which curve to use. Hilbert curves have slightly better
+                locality, Morton curves are cheaper to compute.
+
+    Returns
+    -------
+    (N, ) array
+                Indices that sort `points`.
+
+    """
+    grid = _voxel_grid(space) if space else None
+    if grid is None:
+        origin = np.nanmin(points, axis=0)
+        dims = np.full(3, 2**ORDER_MAX_BITS)
+        voxdims = (np.nanmax(points, axis=0) - origin) / (dims - 1)
+        voxdims[voxdims == 0] = 1
+    else:
+        origin, voxdims, dims = grid
+
+    ijk = np.nan_to_num((points - origin) / voxdims).astype(np.int64)
+    ijk = np.clip(ijk, 0, dims - 1)
+
+    # Drop the lowest bits if the grid is too fine for our curve
+    bits = int(np.ceil(np.log2(max(dims.max(), 2))))
+    if bits > ORDER_MAX_BITS:
+        ijk >>= bits - ORDER_MAX_BITS
+        bits = ORDER_MAX_BITS
+
+    if curve == "hilbert":
+        ix = hilbert_index(ijk, bits)
+    elif curve == "morton":
+        ix = morton_index(ijk, bits)
+    else:
+        raise ValueError(f'`curve` must be "hilbert" or "morton", got "{curve}"')
+    return np.argsort(ix, kind="stable")
+
+
+def xform_ordered(func, points: np.ndarray, space: str = None, curve: str = None):
+    """Run ``func(points)`` on points sorted along a space-filling curve.
+
+    Parameters
+    ----------
+    func :      callable
+                Must accept an (N, 3) array and return an (N, 3) array.
+    points :    (N, 3) array
+                Points to transform.
+    space :     str, optional
+                Template space the points are in. See `point_order`.
+    curve :     "hilbert" | "morton", optional
+                Defaults to `POINT_ORDER`. If that is not set either, points
+                are not sorted.
+
+    Returns
+    -------
+    (N, 3) array
+                Results in the original order of `points`.
+
+    """
+    curve = curve if curve else POINT_ORDER
+    if not curve or len(points) < ORDER_MIN_POINTS:
+        return func(points)
+
+    order = point_order(points, space=space, curve=curve)
+    xf = func(points[order])
+    out = np.empty_like(xf)
+    out[order] = xf
+    return out
@@ -0,0 +1,124 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Chunk-parallel evaluation of H5, CMTK and Elastix transforms.
+
+Settings are read from the module at call time, i.e. they can be changed
+at runtime via e.g. ``flybrains.parallel.N_WORKERS = 4``.
+
+By default, workers are threads. This works well for transforms that spend
+their time in external processes (`transformix`, `streamxform`) or in numpy
+calls that release the GIL (native Elastix and CMTK transforms). H5 transforms
+gain little: h5py serializes all HDF5 calls behind a global lock - so reading
+and decoding chunks of the deformation field does not run in parallel - and
+`scipy.ndimage.map_coordinates` holds the GIL while interpolating. With
+``POOL = "process"``, H5 transforms instead send chunks to a pool of worker
+processes which reopen the file from its path and keep their own chunk cache.
+See ``benchmarks/parallel_h5.py`` to measure the effect on a given machine.
+"""
+
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Number of workers for transforming points in parallel (1 = serial)
+N_WORKERS = int(os.environ.get("FLYBRAINS_WORKERS", 1))
+
+# Number of points per chunk
+CHUNK_SIZE = int(os.environ.get("FLYBRAINS_CHUNK_SIZE", 50_000))
+
+# Kind of workers: "thread" or "process" (only used by H5 transforms, others
+# always use threads)
+POOL = os.environ.get("FLYBRAINS_POOL", "thread").lower()
+
+# Number of threads for each transformix call (None = transformix default)
+ELASTIX_THREADS = os.environ.get("FLYBRAINS_ELASTIX_THREADS", None)
+ELASTIX_THREADS = int(ELASTIX_THREADS) if ELASTIX_THREADS else None
+
+
+_PROCESS_POOL = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+
+def process_pool(n_workers: int) -> ProcessPoolExecutor:
+    """Get the persistent pool of `n_workers` worker processes.
+
+    The pool is kept between calls so that workers can hold on to open
+    transforms and cached data. It is replaced if `n_workers` changes.
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None or _PROCESS_POOL._max_workers != n_workers:
+            if _PROCESS_POOL is not None:
+                _PROCESS_POOL.shutdown(wait=False)
+            _PROCESS_POOL = ProcessPoolExecutor(max_workers=n_workers)
+        return _PROCESS_POOL
+
+
+def close_process_pool():
+    """Shut down the worker processes (and drop their caches)."""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is not None:
+            _PROCESS_POOL.shutdown()
+            _PROCESS_POOL = None
+
+
+def xform_chunks(
+    func, points: np.ndarray, n_workers=None, chunk_size=None, process_func=None
+):
+    """Run ``func(chunk)`` over chunks of points in parallel.
+
+    Workers are threads unless `POOL` is "process" and `process_func` is
+    given (see the module docstring for when either helps). As long as the
+    functions transform each point independently, the result is identical to
+    ``func(points)``.
+
+    Parameters
+    ----------
+    func :          callable
+                    Must accept an (N, 3) array and return an (N, 3) array.
+    points :        (N, 3) numpy array
+                    Points to transform.
+    n_workers :     int, optional
+                    Number of workers. Defaults to `N_WORKERS`.
+    chunk_size :    int, optional
+                    Number of points per chunk. Defaults to `CHUNK_SIZE`.
+    process_func :  callable, optional
+                    Picklable equivalent of `func` for worker processes. Is
+                    called as ``process_func(chunk, first)`` where `first` is
+                    True only for the first chunk (e.g. to warn only once).
+
+    Returns
+    -------
+    (N, 3) numpy array
+                    Results in the original order of `points`.
+
+    """
+    n_workers = n_workers if n_workers else N_WORKERS
+    chunk_size = chunk_size if chunk_size else CHUNK_SIZE
+    if n_workers <= 1 or len(points) <= chunk_size:
+        return func(points)
+
+    chunks = [points[i : i + chunk_size] for i in range(0, len(points), chunk_size)]
+    if POOL == "process" and process_func is not None:
+        first = [i == 0 for i in range(len(chunks))]
+        results = process_pool(n_workers).map(process_func, chunks, first)
+        return np.concatenate(list(results), axis=0)
+
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(chunks))) as pool:
+        # `map` returns results in order and raises any exceptions
+        return np.concatenate(list(pool.map(func, chunks)), axis=0)
@@ -0,0 +1,203 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Compile bridging paths into as few transforms as possible."""
+
+import networkx as nx
+import numpy as np
+
+from navis import transforms
+from navis.transforms.base import TransformSequence
+
+# Compiled plans: (source, target, via, avoid) -> (path, transforms, sequence)
+_PLANS = {}
+
+# Compiled shortest-path trees: (source, targets) -> (paths, segments)
+_TREES = {}
+
+
+class FusableAffineTransform(transforms.AffineTransform):
+    """Affine transform that absorbs subsequent affine and alias transforms.
+
+    `navis.transforms.TransformSequence` tries to merge each transform with
+    the preceding one via ``.append()``. For this class, that means adjacent
+    linear hops (e.g. unit conversions) are fused into a single 4x4 matrix
+    instead of each one copying the full point array.
+
+    Parameters
+    ----------
+    matrix :        (4, 4) np.ndarray
+                    Affine matrix.
+
+    """
+
+    def append(self, transform):
+        """Fuse `transform` into this one (raises NotImplementedError if not linear)."""
+        if isinstance(transform, transforms.AffineTransform):
+            # Apply `transform` after this one
+            self.matrix = transform.matrix @ self.matrix
+        elif not isinstance(transform, transforms.AliasTransform):
+            raise NotImplementedError(f"Unable to fuse {type(transform)}")
+
+
+def fuse_transforms(trs: list) -> list:
+    """Fuse runs of adjacent affine and alias transforms.
+
+    Parameters
+    ----------
+    trs :       list of BaseTransform
+                Transforms in order of application.
+
+    Returns
+    -------
+    list
+                Transforms where each run of linear hops is replaced by a
+                single `FusableAffineTransform` (or dropped altogether if it
+                consists only of aliases). Non-linear transforms are returned
+                as they are.
+
+    """
+    fused = []
+    for tr in trs:
+        linear = isinstance(tr, (transforms.AffineTransform, transforms.AliasTransform))
+        if not linear:
+            fused.append(tr)
+        elif isinstance(tr, transforms.AliasTransform):
+            continue
+        elif fused and isinstance(fused[-1], FusableAffineTransform):
+            fused[-1].append(tr)
+        else:
+            fused.append(FusableAffineTransform(np.array(tr.matrix, dtype=np.float64)))
+
+    # Drop identities (e.g. unit conversions there and back again)
+    fused = [
+        tr
+        for tr in fused
+        if not (
+            isinstance(tr, FusableAffineTransform) and np.allclose(tr.matrix, np.eye(4))
+        )
+    ]
+    return fused if fused else [transforms.AliasTransform()]
+
+
+def compile_path(source: str, target: str, via=None, avoid=None) -> tuple:
+    """Find bridging path and compile its transforms into a sequence.
+
+    Plans are cached per source/target (and `via`/`avoid`) until new
+    transforms are registered.
+
+    Parameters
+    ----------
+    source :    str
+                Source template brain.
+    target :    str
+                Target template brain.
+    via :       str | list thereof, optional
+                Force specific intermediate template(s).
+    avoid :     str | list thereof, optional
+                Avoid going through specific intermediate template(s).
+
+    Returns
+    -------
+    path :      list
+                Path from source to target: ``[source, ..., target]``.
+    trs :       list
+                The (uncompiled) transforms along the path.
+    seq :       TransformSequence
+                Compiled transform sequence.
+
+    """
+    key = (
+        source,
+        target,
+        tuple(np.atleast_1d(via)) if via is not None else None,
+        tuple(np.atleast_1d(avoid)) if avoid is not None else None,
+        # Invalidate plans when transforms are (un-)registered
+        len(transforms.registry.transforms),
+    )
+    if key not in _PLANS:
+        path, trs = transforms.registry.find_bridging_path(
+            source, target, via=via, avoid=avoid
+        )
+        _PLANS[key] = (path, trs, TransformSequence(*fuse_transforms(trs)))
+    return _PLANS[key]
+
+
+def _edge_transform(G, n1, n2):
+    """Pick transform between two nodes the same way navis does."""
+    # navis uses the edge with the highest weight if there are multiple
+    edges = sorted(G[n1][n2].values(), key=lambda e: e["weight"])
+    return edges[-1]["transform"]
+
+
+def compile_tree(source: str, targets: list) -> tuple:
+    """Compile shortest-path tree from one source to multiple targets.
+
+    Parameters
+    ----------
+    source :    str
+                Source template brain.
+    targets :   list of str
+                Target template brains.
+
+    Returns
+    -------
+    paths :     dict
+                Maps each target to its ``(path, transforms)``.
+    segments :  list
+                ``(start, end, TransformSequence)`` for each branch of the tree
+                in order of evaluation. Hops between branch points (or targets)
+                are fused into a single sequence.
+
+    """
+    key = (source, tuple(targets), len(transforms.registry.transforms))
+    if key in _TREES:
+        return _TREES[key]
+
+    G = transforms.registry.bridging_graph()
+    if source not in G.nodes:
+        raise ValueError(f'Source "{source}" has no known bridging registrations.')
+    shortest = nx.single_source_dijkstra_path(G, source, weight="weight")
+
+    paths, children = {}, {}
+    for t in targets:
+        if t not in shortest:
+            raise nx.NetworkXNoPath(
+                f"No bridging path connecting {source} and {t} found."
+            )
+        path = shortest[t]
+        paths[t] = (path, [_edge_transform(G, a, b) for a, b in zip(path, path[1:])])
+        for a, b in zip(path, path[1:]):
+            children.setdefault(a, set()).add(b)
+
+    # Walk the tree and collapse chains without branches or targets
+    segments, stack = [], [source]
+    while stack:
+        start = stack.pop()
+        for child in sorted(children.get(start, [])):
+            trs, node = [_edge_transform(G, start, child)], child
+            while node not in targets and len(children.get(node, [])) == 1:
+                (nxt,) = children[node]
+                trs.append(_edge_transform(G, node, nxt))
+                node = nxt
+            segments.append((start, node, TransformSequence(*fuse_transforms(trs))))
+            stack.append(node)
+
+    _TREES[key] = (paths, segments)
+    return _TREES[key]
+
+
+def clear_plans():
+    """Clear compiled paths (e.g. after swapping registered transforms)."""
+    _PLANS.clear()
+    _TREES.clear()
@@ -0,0 +1,360 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Repack H5 transforms into uncompressed, memory-mappable array stores.
+
+A store is a directory with one ``.npy`` file per resolution level and
+field (mirroring the groups of the H5 file) plus a ``meta.json`` with the
+fields' attributes. By default, stores live in the flybrains cache directory
+and are picked up by `search_register_path` in place of the original H5 file
+as long as that file hasn't changed.
+"""
+
+import contextlib
+import hashlib
+import os
+import pathlib
+import shutil
+import warnings
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from tqdm.auto import tqdm
+
+from .cache import _read_json, _write_json, find_transforms, get_cache_dir
+from .download import get_data_home
+from .h5 import H5transform
+
+__all__ = ["repack_h5", "repack_transforms"]
+
+# Bump this if the layout of the stores changes
+REPACK_VERSION = 1
+
+# Number of z-planes copied at a time
+SLAB_SIZE = 16
+
+
+def repacked_path(path, cache_dir=None) -> pathlib.Path:
+    """Default location of the repacked store for a given H5 file."""
+    path = pathlib.Path(path).expanduser().absolute()
+    key = hashlib.sha1(str(path).encode()).hexdigest()[:8]
+    return pathlib.Path(get_cache_dir(cache_dir)) / "repacked" / f"{path.stem}-{key}"
+
+
+def find_repacked(path, store=None):
+    """Return path to a valid repacked store for H5 file (None if there is none).
+
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Path to the original H5 file.
+    store :     str | pathlib.Path, optional
+                Path to the store. Defaults to `repacked_path(path)`.
+
+    """
+    store = pathlib.Path(store) if store else repacked_path(path)
+    meta = _read_json(store / "meta.json")
+    if not meta or meta.get("version") != REPACK_VERSION:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # The original file must not have changed since repacking
+    if meta["size"] != st.st_size or meta["mtime_ns"] != st.st_mtime_ns:
+        return None
+    return store
+
+
+def _resolve_level(level, available: list) -> str:
+    """Translate `level` (navis semantics) into the name of an available level."""
+    if level is None:
+        return available[0]
+    if level < 0:
+        return available[-level - 1]
+    if str(level) not in available:
+        raise ValueError(f"Level {level} not available (available: {available})")
+    return str(level)
+
+
+def repack_h5(path, levels=None, dtype=None, out=None, overwrite=False):
+    """Repack H5 transform into a memory-mappable array store.
+
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Path to the H5 file.
+    levels :    list of int, optional
+                Resolution levels to keep. Negative values go backwards from the
+                highest available resolution (-1 = highest, -2 = second highest,
+                etc). By default, all levels are kept.
+    dtype :     str | numpy.dtype, optional
+                Data type to store the deformation fields in. By default, the
+                original data type is kept (i.e. the store is lossless). Use
+                e.g. "float16" to halve the size of float32 fields at the cost
+                of some precision - see the returned error report.
+    out :       str | pathlib.Path, optional
+                Where to write the store. Defaults to the flybrains cache
+                directory where `search_register_path` will find it.
+    overwrite : bool
+                If False and a valid store already exists, will skip.
+
+    Returns
+    -------
+    pandas.DataFrame
+                One row per level and field with its data type, size and the
+                max/mean absolute error (in the units of the transform)
+                introduced by the repacking.
+
+    """
+    path = pathlib.Path(path).expanduser()
+    out = pathlib.Path(out) if out else repacked_path(path)
+
+    if find_repacked(path, out) and not overwrite:
+        return pd.DataFrame(_read_json(out / "meta.json")["report"])
+
+    st = os.stat(path)
+    meta = {
+        "version": REPACK_VERSION,
+        "source": str(path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "fields": {},
+        "report": [],
+    }
+
+    tmp = out.with_name(f"{out.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    with h5py.File(path, "r") as h5:
+        available = sorted((k for k in h5.keys() if k.lstrip("-").isdigit()), key=int)
+        if not available:
+            keep = [""]
+        elif levels is None:
+            keep = available
+        else:
+            keep = [_resolve_level(lv, available) for lv in levels]
+
+        for level in keep:
+            group = h5[level] if level else h5
+            (tmp / level).mkdir(exist_ok=True)
+            meta["fields"][level] = {}
+            for field in ("dfield", "invdfield"):
+                if field not in group:
+                    continue
+                attrs, report = _repack_field(group[field], tmp / level / field, dtype)
+                meta["fields"][level][field] = attrs
+                meta["report"].append({"level": level, "field": field, **report})
+
+    _write_json(meta, tmp / "meta.json")
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+
+    return pd.DataFrame(meta["report"])
+
+
+def _repack_field(src: h5py.Dataset, fp: pathlib.Path, dtype=None) -> tuple:
+    """Copy field into .npy file (in slabs along z)."""
+    qm = float(src.attrs.get("quantization_multiplier", 1))
+    dtype = src.dtype if dtype is None else np.dtype(dtype)
+    convert = dtype != src.dtype
+
+    arr = np.lib.format.open_memmap(
+        fp.with_suffix(".npy"), mode="w+", dtype=dtype, shape=src.shape
+    )
+    max_err, sum_err = 0.0, 0.0
+    for z in range(0, src.shape[0], SLAB_SIZE):
+        block = src[z : z + SLAB_SIZE]
+        if convert:
+            # Converted fields store the offsets in real-world units
+            values = block.astype(np.float64) * qm
+            arr[z : z + SLAB_SIZE] = values
+            err = np.abs(arr[z : z + SLAB_SIZE].astype(np.float64) - values)
+            max_err = max(max_err, float(err.max(initial=0)))
+            sum_err += float(err.sum())
+        else:
+            arr[z : z + SLAB_SIZE] = block
+    arr.flush()
+    del arr
+
+    if not np.isfinite(max_err):
+        warnings.warn(f"{fp.name} has values outside the range of {dtype}")
+
+    attrs = {
+        "shape": list(src.shape),
+        "dtype": dtype.str,
+        "spacing": np.asarray(src.attrs["spacing"]).tolist(),
+        "affine": (
+            np.asarray(src.attrs["affine"]).ravel().tolist()
+            if "affine" in src.attrs
+            else None
+        ),
+        "quantization_multiplier": 1 if convert else qm,
+    }
+    report = {
+        "dtype": dtype.name,
+        "nbytes": int(np.prod(src.shape)) * dtype.itemsize,
+        "max_error": max_err,
+        "mean_error": sum_err / max(np.prod(src.shape), 1),
+    }
+    return attrs, report
+
+
+def repack_transforms(data_home=None, levels=None, dtype=None, overwrite=False):
+    """Repack all downloaded H5 transforms.
+
+    Run this after `download_jrc_transforms` and/or
+    `download_jrc_vnc_transforms`. The repacked stores are used from the next
+    time the transforms are registered (i.e. after restarting Python).
+
+    Parameters
+    ----------
+    data_home :     str, optional
+                    Directory with the H5 files. If not specified, it tries to
+                    read from the ``FLYBRAINS_DATA`` environment variable and
+                    defaults to ``~/flybrain-data``.
+    levels :        list of int, optional
+                    Resolution levels to keep. See `repack_h5`.
+    dtype :         str | numpy.dtype, optional
+                    Data type for the deformation fields. See `repack_h5`.
+    overwrite :     bool
+                    If True, will overwrite existing stores.
+
+    Returns
+    -------
+    pandas.DataFrame
+                    The combined error report.
+
+    """
+    data_home = get_data_home(data_home)
+    files = [f for f, kind in find_transforms(data_home)[".h5"] if kind == "file"]
+
+    reports = []
+    for f in tqdm(files, desc="Repacking", leave=False):
+        try:
+            rep = repack_h5(f, levels=levels, dtype=dtype, overwrite=overwrite)
+        except BaseException as e:
+            warnings.warn(f"Error repacking {f}: {e}")
+            continue
+        rep.insert(0, "file", f.name)
+        reports.append(rep)
+
+    return pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+
+
+class _StoredField:
+    """Memory-mapped deformation field with h5py-like ``attrs``."""
+
+    chunks = None
+
+    def __init__(self, fp: pathlib.Path, attrs: dict):
+        self.data = np.load(fp, mmap_mode="r")
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+        self.attrs = {
+            "spacing": np.asarray(attrs["spacing"]),
+            "quantization_multiplier": attrs["quantization_multiplier"],
+        }
+        if attrs["affine"] is not None:
+            self.attrs["affine"] = np.asarray(attrs["affine"])
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class RepackedH5transform(H5transform):
+    """H5 transform reading from a repacked (memory-mapped) store.
+
+    Reads are served straight from the OS page cache, hence there is no need
+    for (pre-)caching: `precache` and `full_ingest` do nothing.
+
+    Parameters
+    ----------
+    f :             str | pathlib.Path
+                    Path to the store (see `repack_h5`).
+    direction :     "forward" | "inverse"
+                    Direction of transformation.
+    level :         int, optional
+                    Resolution level to use. Negative values go backwards from
+                    the highest available resolution (-1 = highest).
+    cache :         bool
+                    Ignored.
+    full_ingest :   bool
+                    Ignored.
+
+    """
+
+    def __init__(
+        self, f, direction="forward", level=-1, cache=False, full_ingest=False
+    ):
+        assert direction in ("forward", "inverse"), (
+            '`direction` must be "forward"' f'or "inverse", not "{direction}"'
+        )
+        self.file = str(f)
+        self.direction = direction
+        self.field = {"forward": "dfield", "inverse": "invdfield"}[direction]
+
+        self.meta = _read_json(pathlib.Path(self.file) / "meta.json")
+        if not self.meta:
+            raise ValueError(f"{self.file} is not a repacked H5 transform")
+        available = sorted((k for k in self.meta["fields"] if k), key=int)
+        self._level = _resolve_level(level, available) if available else None
+
+        info = self._info
+        self._shape = tuple(info["shape"])
+        self.dtype = np.dtype(info["dtype"])
+
+    @property
+    def _info(self) -> dict:
+        """Attributes of the deformation field."""
+        return self.meta["fields"][self.level or ""][self.field]
+
+    @property
+    def levels(self) -> dict:
+        """Available resolution levels -> voxel spacing (z, y, x)."""
+        levels = sorted((k for k in self.meta["fields"] if k), key=int)
+        return {
+            k: np.asarray(self.meta["fields"][k][self.field]["spacing"]) for k in levels
+        }
+
+    @property
+    def spacing(self):
+        """Voxel spacing of the deformation field (z, y, x)."""
+        return np.asarray(self._info["spacing"])
+
+    @property
+    def quantization_multiplier(self):
+        """Quantization multiplier of the deformation field."""
+        return self._info["quantization_multiplier"]
+
+    def precache(self, bbox, padding=True):
+        """Does nothing: the store is memory-mapped."""
+
+    def full_ingest(self):
+        """Does nothing: the store is memory-mapped."""
+
+    @contextlib.contextmanager
+    def _open(self):
+        """Open (memory-map) the deformation field."""
+        if not hasattr(self, "_stored"):
+            fp = pathlib.Path(self.file) / (self.level or "") / f"{self.field}.npy"
+            self._stored = _StoredField(fp, self._info)
+        yield self._stored
+
+    def _read_block(self, field, zyx_slices: tuple) -> np.ndarray:
+        """Read block of the deformation field (no chunk cache needed)."""
+        block = field[zyx_slices]
+        # scipy can't interpolate float16
+        return block.astype(np.float32) if block.dtype == np.float16 else block
@@ -0,0 +1,408 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Cache results of bridging transforms for (quantized) coordinates.
+
+Results are keyed by the source and target space, a signature of the
+transforms in between (files, modification times, levels, matrices, etc.)
+and the coordinates rounded to `RESULT_TOLERANCE`. Points that round to the
+same coordinates share the result of the first one that was transformed.
+
+Results are only cached for source spaces with known units. The in-memory
+cache is bounded by its number of points (`RESULT_CACHE_SIZE`) and is not
+counted towards the memory budget of `flybrains.assets.asset_cache`.
+"""
+
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import warnings
+
+from collections import OrderedDict
+
+import numpy as np
+
+from navis.transforms.base import BaseTransform, TransformSequence
+
+from .__version__ import __version__
+from .cache import get_cache_dir
+from .core import ALIASES, VOXEL_SIZES, data_filepath
+from .lazy import LazyTransform
+from .templates import template_meta
+
+# Where to cache results: "memory" or "disk" (memory + sqlite database in the
+# cache directory). If not set, results are not cached.
+RESULT_CACHE = os.environ.get("FLYBRAINS_RESULT_CACHE", "").lower() or None
+if RESULT_CACHE not in (None, "memory", "disk"):
+    warnings.warn(
+        f'Unknown FLYBRAINS_RESULT_CACHE "{RESULT_CACHE}" - expected "memory" '
+        'or "disk". Results will not be cached.'
+    )
+    RESULT_CACHE = None
+
+# Max number of points kept in memory
+RESULT_CACHE_SIZE = int(os.environ.get("FLYBRAINS_RESULT_CACHE_SIZE", 5_000_000))
+
+# Max size (in MB) of the sqlite database (0 = unlimited). Results of the
+# least recently written transform plans are dropped first.
+RESULT_CACHE_DISK_MB = int(os.environ.get("FLYBRAINS_RESULT_CACHE_DISK_MB", 1024))
+
+# Coordinates are rounded to this tolerance (in nanometers) for the lookup
+RESULT_TOLERANCE = float(os.environ.get("FLYBRAINS_RESULT_TOLERANCE", 1))
+
+# Attributes that identify a transform (if present)
+_SIGNATURE_ATTRS = (
+    "file",
+    "regs",
+    "direction",
+    "directions",
+    "level",
+    "matrix",
+    "scale",
+    "spacing",
+    "source",
+    "target",
+    "transform",
+)
+
+# Max number of SQL variables per query
+_SQL_BATCH = 500
+
+
+class ResultCache:
+    """LRU cache of transformed points with optional sqlite persistence.
+
+    Each point takes up roughly 250 bytes in memory. Unlike meshes and
+    transforms, cached results are not tracked by the `asset_cache`.
+
+    Parameters
+    ----------
+    max_points :    int
+                    Max number of points to keep in memory.
+    max_disk_mb :   int
+                    Max size of the sqlite database in MB (0 = unlimited).
+
+    """
+
+    def __init__(self, max_points: int, max_disk_mb: int = 0):
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_points = max_points
+        self.max_disk_mb = max_disk_mb
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._mem)
+
+    def __repr__(self):
+        return f"ResultCache({self.info()})"
+
+    @property
+    def db_file(self) -> pathlib.Path:
+        """Path to the sqlite database."""
+        return pathlib.Path(get_cache_dir()) / "results.sqlite"
+
+    def _connect(self) -> sqlite3.Connection:
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.db_file, timeout=30)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(plan TEXT, key BLOB, x REAL, y REAL, z REAL, PRIMARY KEY (plan, key))"
+        )
+        # When each plan was last written to (for pruning)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS plans (plan TEXT PRIMARY KEY, written REAL)"
+        )
+        return con
+
+    @staticmethod
+    def _db_bytes(con: sqlite3.Connection) -> int:
+        """Bytes used by the database (excluding free pages)."""
+        used = con.execute("PRAGMA page_count").fetchone()[0]
+        used -= con.execute("PRAGMA freelist_count").fetchone()[0]
+        return used * con.execute("PRAGMA page_size").fetchone()[0]
+
+    def _prune(self, con: sqlite3.Connection, plan: str):
+        """Drop least recently written plans until the database fits its cap.
+
+        Freed pages are reused by later writes, i.e. the file itself does not
+        shrink but stops growing.
+        """
+        max_bytes = self.max_disk_mb * 2**20
+        if not max_bytes or self._db_bytes(con) <= max_bytes:
+            return
+
+        oldest = con.execute(
+            "SELECT plan FROM plans WHERE plan != ? ORDER BY written", [plan]
+        ).fetchall()
+        for (p,) in oldest:
+            con.execute("DELETE FROM results WHERE plan = ?", [p])
+            con.execute("DELETE FROM plans WHERE plan = ?", [p])
+            if self._db_bytes(con) <= max_bytes:
+                return
+
+        # Still too large (e.g. a single plan): drop the oldest rows
+        n_rows = con.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = 1 - max_bytes / self._db_bytes(con)
+        con.execute(
+            "DELETE FROM results WHERE rowid IN "
+            "(SELECT rowid FROM results ORDER BY rowid LIMIT ?)",
+            [int(n_rows * (excess + 0.1)) + 1],
+        )
+
+    def lookup(self, plan: str, keys: list, disk: bool = False):
+        """Look up points.
+
+        Parameters
+        ----------
+        plan :      str
+                    Identifies source, target and transforms.
+        keys :      list of bytes
+                    Quantized coordinates.
+        disk :      bool
+                    Whether to also look in the sqlite database.
+
+        Returns
+        -------
+        values :    (N, 3) array
+                    Cached results (NaN where not found).
+        found :     (N, ) bool array
+
+        """
+        values = np.full((len(keys), 3), np.nan)
+        found = np.zeros(len(keys), dtype=bool)
+        prefix = plan.encode()
+        with self._lock:
+            for i, k in enumerate(keys):
+                v = self._mem.get(prefix + k, None)
+                if v is not None:
+                    self._mem.move_to_end(prefix + k)
+                    values[i] = v
+                    found[i] = True
+            self.hits += int(found.sum())
+
+        if disk and not found.all():
+            miss = np.where(~found)[0]
+            from_disk = {}
+            with self._connect() as con:
+                for i in range(0, len(miss), _SQL_BATCH):
+                    batch = [keys[j] for j in miss[i : i + _SQL_BATCH]]
+                    rows = con.execute(
+                        "SELECT key, x, y, z FROM results WHERE plan = ? "
+                        f"AND key IN ({','.join('?' * len(batch))})",
+                        [plan] + batch,
+                    )
+                    from_disk.update({k: (x, y, z) for k, x, y, z in rows})
+            con.close()
+            for j in miss:
+                v = from_disk.get(keys[j], None)
+                if v is not None:
+                    values[j] = v
+                    found[j] = True
+            # Promote to memory
+            self.store(plan, list(from_disk), np.array(list(from_disk.values())))
+            with self._lock:
+                self.disk_hits += len(from_disk)
+
+        with self._lock:
+            self.misses += int((~found).sum())
+        return values, found
+
+    def store(self, plan: str, keys: list, values: np.ndarray, disk: bool = False):
+        """Add points to the cache (and optionally to the sqlite database)."""
+        if not len(keys):
+            return
+        prefix = plan.encode()
+        rows = [tuple(v) for v in np.asarray(values, dtype=np.float64).tolist()]
+        with self._lock:
+            for k, v in zip(keys, rows):
+                self._mem[prefix + k] = v
+                self._mem.move_to_end(prefix + k)
+            while len(self._mem) > self.max_points:
+                self._mem.popitem(last=False)
+
+        if disk:
+            with self._connect() as con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    [(plan, k, *v) for k, v in zip(keys, rows)],
+                )
+                con.execute(
+                    "INSERT OR REPLACE INTO plans VALUES (?, ?)", [plan, time.time()]
+                )
+                self._prune(con, plan)
+            con.close()
+
+    def clear(self, disk: bool = False):
+        """Clear the in-memory cache (and optionally the sqlite database)."""
+        with self._lock:
+            self._mem.clear()
+            self.hits = self.disk_hits = self.misses = 0
+        if disk and self.db_file.exists():
+            self.db_file.unlink()
+
+    def info(self) -> dict:
+        """Summary of cache usage."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "points": len(self._mem),
+                "max_points": self.max_points,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DISK_MB)
+
+
+def _signature(tr) -> str:
+    """Signature of a transform that changes if the transform does."""
+    if isinstance(tr, TransformSequence):
+        return "[" + ",".join(_signature(t) for t in tr.transforms) + "]"
+    if isinstance(tr, LazyTransform):
+        # Don't trigger loading of the transform
+        args = [
+            _signature(a) if isinstance(a, BaseTransform) else repr(a)
+            for a in tr._loader.args
+        ]
+        # Files are typically given relative to the data directory
+        args += _mtimes(tr._loader.args, data_filepath)
+        return f"{type(tr).__name__}<{tr._loader.factory.__qualname__}({args})>"
+
+    parts = [type(tr).__name__]
+    for attr in _SIGNATURE_ATTRS:
+        value = getattr(tr, attr, None)
+        if value is None:
+            continue
+        if isinstance(value, BaseTransform):
+            value = _signature(value)
+        elif isinstance(value, np.ndarray):
+            value = hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+        else:
+            value = repr(value)
+        parts.append(f"{attr}={value}")
+
+    # Make sure we notice if files have been replaced
+    parts += _mtimes(getattr(tr, "regs", None) or [getattr(tr, "file", None)])
+    return "(" + ",".join(parts) + ")"
+
+
+def _mtimes(values, root=None) -> list:
+    """Modification times of existing files among (nested lists of) `values`.
+
+    If given, relative paths are taken to be relative to `root`.
+    """
+    mtimes = []
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            mtimes += _mtimes(v, root)
+        elif isinstance(v, (str, pathlib.Path)):
+            f = os.path.join(root, v) if root else v
+            if os.path.exists(f):
+                mtimes.append(str(os.stat(f).st_mtime_ns))
+    return mtimes
+
+
+def plan_key(source: str, target: str, seq, affine_fallback: bool) -> str:
+    """Key identifying a compiled bridging path."""
+    sig = "|".join(
+        [
+            __version__,
+            str(source),
+            str(target),
+            str(affine_fallback),
+            str(RESULT_TOLERANCE),
+            repr(_units_scale(source)),
+            _signature(seq),
+        ]
+    )
+    return hashlib.sha1(sig.encode()).hexdigest()
+
+
+def _units_scale(space: str):
+    """Size of the units of `space` in nanometers along x/y/z.
+
+    Returns None if the units of `space` are unknown.
+    """
+    space = dict(ALIASES).get(str(space), str(space))
+    # Raw spaces are in (potentially anisotropic) voxels
+    if space.endswith("raw"):
+        if space[:-3] in VOXEL_SIZES:
+            return np.array(VOXEL_SIZES[space[:-3]], dtype=np.float64)
+        return None
+    if space in VOXEL_SIZES or (space.endswith("nm") and space not in template_meta):
+        return np.ones(3)
+    if space.endswith("um") and space not in template_meta:
+        return np.full(3, 1e3)
+    units = template_meta.get(space, {}).get("units", None)
+    units = units[0] if isinstance(units, list) else units
+    if units == "microns":
+        return np.full(3, 1e3)
+    if units == "nanometers":
+        return np.ones(3)
+    return None
+
+
+def xform_cached(func, points: np.ndarray, source, target, seq, affine_fallback):
+    """Run ``func(points)`` only for points not in the result cache.
+
+    Parameters
+    ----------
+    func :              callable
+                        Transforms an (N, 3) array.
+    points :            (N, 3) array
+                        Points to transform.
+    source, target :    str
+                        Source and target space.
+    seq :               TransformSequence
+                        The transforms that `func` runs.
+    affine_fallback :   bool
+                        Passed on to the transforms by `func`.
+
+    Returns
+    -------
+    (N, 3) array
+
+    """
+    if not RESULT_CACHE or not len(points):
+        return func(points)
+    # Without knowing the units we can't tell how to round coordinates
+    scale = _units_scale(source)
+    if scale is None:
+        return func(points)
+    disk = RESULT_CACHE == "disk"
+    plan = plan_key(source, target, seq, affine_fallback)
+
+    out = np.full(points.shape, np.nan)
+    valid = np.all(np.isfinite(points), axis=1)
+
+    # Quantize and deduplicate
+    tol = RESULT_TOLERANCE / scale
+    q = np.round(points[valid] / tol).astype(np.int64)
+    uq, first, inv = np.unique(q, axis=0, return_index=True, return_inverse=True)
+    keys = np.ascontiguousarray(uq).view("V24").ravel().tolist()
+
+    values, found = result_cache.lookup(plan, keys, disk=disk)
+    if not found.all():
+        miss = np.where(~found)[0]
+        values[miss] = func(points[valid][first[miss]])
+        result_cache.store(plan, [keys[i] for i in miss], values[miss], disk=disk)
+
+    out[valid] = values[inv.ravel()]
+    return out
@@ -13,9 +13,15 @@
 
 """Module constructing templatebrains"""
 
+import hashlib
 import json
 import navis
 import os
+import pathlib
+import threading
+import warnings
+
+import numpy as np
 
 import trimesh as tm
 
@@ -24,6 +30,9 @@ from textwrap import dedent
 from navis import transforms
 from navis.transforms.templates import TemplateBrain
 
+from .cache import get_cache_dir, _read_json, _write_json
+from .lazy import load_once
+
 
 __all__ = [
     "FCWB",
@@ -63,6 +72,7 @@ __all__ = [
     "BANC",
     "AEDES",
     "register_templates",
+    "build_mesh_cache",
 ]
 
 # Read in meta data
@@ -77,6 +87,134 @@ with open(meta_filepath, "r", encoding="utf-8") as f:
 # Index by short label
 template_meta = {e["label"]: e for e in template_meta}
 
+# Unless turned off (FLYBRAINS_MESH_CACHE=0), meshes are parsed only once and
+# then loaded from memory-mappable arrays in the cache directory
+MESH_CACHE = os.environ.get("FLYBRAINS_MESH_CACHE", "1").lower() not in (
+    "0",
+    "false",
+    "no",
+)
+
+# Content hashes of mesh files we have already seen in this process
+_MESH_HASHES = {}
+
+# Meshes shared between templates (see `scaled_mesh`)
+_SCALED_MESHES = {}
+
+
+def _mesh_cache_dir() -> pathlib.Path:
+    return pathlib.Path(get_cache_dir()) / "meshes"
+
+
+def _mesh_hash(fp: str) -> str:
+    """Content hash of a mesh file.
+
+    Hashes are stored in an index (keyed by path, size and mtime) so that we
+    don't have to read the file again.
+    """
+    fp = os.path.abspath(fp)
+    st = os.stat(fp)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if _MESH_HASHES.get(fp, [None])[:2] == stamp:
+        return _MESH_HASHES[fp][2]
+
+    index_fp = _mesh_cache_dir() / "index.json"
+    index = _read_json(index_fp) or {}
+    if index.get(fp, [None])[:2] != stamp:
+        with open(fp, "rb") as f:
+            index[fp] = stamp + [hashlib.sha1(f.read()).hexdigest()]
+        _write_json(index, index_fp)
+    _MESH_HASHES[fp] = index[fp]
+    return index[fp][2]
+
+
+def _save_array(arr: np.ndarray, fp: pathlib.Path):
+    """Atomically write array as .npy file."""
+    tmp = fp.with_name(f"{fp.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, fp)
+
+
+def load_mesh(fp: str) -> tm.Trimesh:
+    """Load mesh file (via the binary mesh cache).
+
+    On first use, the file is parsed with trimesh and its vertices and faces
+    are written to the cache directory under the hash of the file's content -
+    identical files hence share an entry. Loads then memory-map these arrays
+    instead of parsing the file. They are stored with the dtypes trimesh uses
+    internally (float64 and int64) so that the mesh keeps the mapped arrays
+    instead of copying them: vertices and faces of the returned mesh are
+    read-only (use ``mesh.copy()`` to modify them).
+    """
+    if not MESH_CACHE:
+        return tm.load_mesh(fp)
+
+    try:
+        key = _mesh_hash(fp)
+        vfp = _mesh_cache_dir() / f"{key}.vertices.npy"
+        ffp = _mesh_cache_dir() / f"{key}.faces.npy"
+        arrays = None
+        if vfp.is_file() and ffp.is_file():
+            arrays = np.load(vfp, mmap_mode="r"), np.load(ffp, mmap_mode="r")
+        # Entries written by earlier versions used smaller dtypes (which
+        # trimesh would copy)
+        if arrays is None or [a.dtype for a in arrays] != [np.float64, np.int64]:
+            mesh = tm.load_mesh(fp)
+            _save_array(np.asarray(mesh.vertices, dtype=np.float64), vfp)
+            _save_array(np.asarray(mesh.faces, dtype=np.int64), ffp)
+            arrays = np.load(vfp, mmap_mode="r"), np.load(ffp, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        warnings.warn(f"Unable to use mesh cache for {fp}: {e}")
+        return tm.load_mesh(fp)
+
+    return tm.Trimesh(vertices=arrays[0], faces=arrays[1], process=False)
+
+
+def build_mesh_cache(verbose: bool = False):
+    """Parse all template meshes and write them to the mesh cache.
+
+    Not strictly necessary (meshes are cached on first use) but this can be
+    run e.g. after installation or when setting up a new cache directory.
+    """
+    for fp in sorted(pathlib.Path(mesh_filepath).glob("*.ply")):
+        if verbose:
+            print(f"Caching {fp.name}")
+        load_mesh(str(fp))
+
+
+def scaled_mesh(files: tuple, scale: float = 1) -> tm.Trimesh:
+    """Load (and concatenate) template meshes with vertices multiplied by `scale`.
+
+    Cached: template variants that differ only in units (nanometers, microns,
+    voxels) share one mesh per combination of files and scale, and
+    concatenated meshes are built only once per process (also if several
+    threads ask for them at the same time). The returned mesh is shared and
+    should be treated as read-only (unscaled single meshes are in fact
+    read-only, see `load_mesh`).
+
+    Parameters
+    ----------
+    files :     tuple of str
+                Mesh file(s) in the meshes directory.
+    scale :     float
+                Factor for the vertex coordinates.
+
+    """
+    key = (tuple(files), scale)
+    label = "+".join(files) + (f" x{scale:g}" if scale != 1 else "")
+    return load_once(_SCALED_MESHES, key, lambda: _scale_mesh(*key), label=label)
+
+
+def _scale_mesh(files: tuple, scale: float) -> tm.Trimesh:
+    meshes = [load_mesh(os.path.join(mesh_filepath, f)) for f in files]
+    mesh = meshes[0] if len(meshes) == 1 else tm.util.concatenate(meshes)
+    if scale != 1:
+        mesh = tm.Trimesh(
+            vertices=np.asarray(mesh.vertices) * scale, faces=mesh.faces, process=False
+        )
+    return mesh
+
 
 class FlyTemplateBrain(TemplateBrain):
     """Base Class for fly template brains.
@@ -163,15 +301,15 @@ class FlyTemplateBrain(TemplateBrain):
     @property
     def mesh(self):
         """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            fp = os.path.join(mesh_filepath, f"{self.label}.ply")
+        return load_once(self, "_mesh", self._load_mesh)
 
-            if not os.path.isfile(fp):
-                raise ValueError(f"{self.label} does not appear to have a mesh")
+    def _load_mesh(self):
+        fp = os.path.join(mesh_filepath, f"{self.label}.ply")
 
-            self._mesh = tm.load_mesh(fp)
+        if not os.path.isfile(fp):
+            raise ValueError(f"{self.label} does not appear to have a mesh")
 
-        return self._mesh
+        return load_mesh(fp)
 
 
 class _FCWB(FlyTemplateBrain):
@@ -677,77 +815,35 @@ class _JRCFIB2018F(FlyTemplateBrain):
 
     """
 
+    # Size of a voxel of the raw meshes in the units of this template
+    _voxel_scale = 8
+
     @property
     def mesh(self):
         """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}raw.ply")
-            self._mesh = tm.load_mesh(fp)
-            # Convert voxels to nanometers
-            self._mesh.vertices *= 8
-        return self._mesh
+        # Raw mesh (voxels) scaled to the units of this template
+        return scaled_mesh(("JRCFIB2018Fraw.ply",), self._voxel_scale)
 
     @property
     def bbox(self):
         """On-demand loading of approximate bounding box."""
-        if not hasattr(self, "_mesh_bbox"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}raw_bbox.ply")
-            self._mesh_bbox = tm.load_mesh(fp)
-            # Convert voxels to nanometers
-            self._mesh_bbox.vertices *= 8
-        return self._mesh_bbox
+        return scaled_mesh(("JRCFIB2018Fraw_bbox.ply",), self._voxel_scale)
 
 
 JRCFIB2018F = _JRCFIB2018F(**template_meta["JRCFIB2018F"])
 
 
 class _JRCFIB2018Fum(_JRCFIB2018F):
-    @property
-    def mesh(self):
-        """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}raw.ply")
-            self._mesh = tm.load_mesh(fp)
-            # Convert voxels to microns
-            self._mesh.vertices *= 8 / 1000
-        return self._mesh
-
-    @property
-    def bbox(self):
-        """On-demand loading of approximate bounding box."""
-        if not hasattr(self, "_mesh_bbox"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}raw_bbox.ply")
-            self._mesh_bbox = tm.load_mesh(fp)
-            # Convert voxels to microns
-            self._mesh_bbox.vertices *= 8 / 1000
-        return self._mesh_bbox
+    # Convert voxels to microns
+    _voxel_scale = 8 / 1000
 
 
 JRCFIB2018Fum = _JRCFIB2018Fum(**template_meta["JRCFIB2018Fum"])
 
 
 class _JRCFIB2018Fraw(_JRCFIB2018F):
-    @property
-    def mesh(self):
-        """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}.ply")
-            self._mesh = tm.load_mesh(fp)
-        return self._mesh
-
-    @property
-    def bbox(self):
-        """On-demand loading of approximate bounding box."""
-        if not hasattr(self, "_mesh_bbox"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}_bbox.ply")
-            self._mesh_bbox = tm.load_mesh(fp)
-        return self._mesh_bbox
+    # Keep voxels
+    _voxel_scale = 1
 
 
 JRCFIB2018Fraw = _JRCFIB2018Fraw(**template_meta["JRCFIB2018Fraw"])
@@ -773,59 +869,33 @@ class _JRCFIB2022M(FlyTemplateBrain):
 
     """
 
+    # Scale of the meshes (nanometers) to the units of this template
+    _nm_scale = 1
+
     @property
     def mesh(self):
         """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp1 = os.path.join(mesh_filepath, "JRCFIB2022M_brain.ply")
-            fp2 = os.path.join(mesh_filepath, "JRCFIB2022M_vnc.ply")
-            self._mesh = tm.util.concatenate(tm.load_mesh(fp1), tm.load_mesh(fp2))
-        return self._mesh
+        return scaled_mesh(
+            ("JRCFIB2022M_brain.ply", "JRCFIB2022M_vnc.ply"), self._nm_scale
+        )
 
     @property
     def mesh_brain(self):
         """On-demand loading of brain surface mesh."""
-        if not hasattr(self, "_mesh_brain"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, "JRCFIB2022M_brain.ply")
-            self._mesh_brain = tm.load_mesh(fp)
-        return self._mesh_brain
+        return scaled_mesh(("JRCFIB2022M_brain.ply",), self._nm_scale)
 
     @property
     def mesh_vnc(self):
         """On-demand loading of VNC surface mesh."""
-        if not hasattr(self, "_mesh_vnc"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, "JRCFIB2022M_vnc.ply")
-            self._mesh_vnc = tm.load_mesh(fp)
-        return self._mesh_vnc
+        return scaled_mesh(("JRCFIB2022M_vnc.ply",), self._nm_scale)
 
 
 JRCFIB2022M = _JRCFIB2022M(**template_meta["JRCFIB2022M"])
 
 
 class _JRCFIB2022Mraw(_JRCFIB2022M):
-    @property
-    def mesh(self):
-        mesh = super().mesh.copy()
-        # Convert nanometers to voxels
-        mesh.vertices /= 8
-        return mesh
-
-    @property
-    def mesh_brain(self):
-        mesh = super().mesh_brain.copy()
-        # Convert nanometers to voxels
-        mesh.vertices /= 8
-        return mesh
-
-    @property
-    def mesh_vnc(self):
-        mesh = super().mesh_vnc.copy()
-        # Convert nanometers to voxels
-        mesh.vertices /= 8
-        return mesh
+    # Convert nanometers to voxels
+    _nm_scale = 1 / 8
 
 
 JRCFIB2022Mraw = _JRCFIB2022Mraw(**template_meta["JRCFIB2022Mraw"])
@@ -851,33 +921,23 @@ class _JRCFIB2022Mplot(_JRCFIB2022M):
 
     @property
     def mesh(self):
-        if not hasattr(self, "_mesh_xf"):
-            import navis
-
-            self._mesh_xf = navis.xform_brain(
-                super().mesh, source="JRCFIB2022M", target="JRCFIB2022Mplot"
-            )
-        return self._mesh_xf
+        return load_once(self, "_mesh_xf", lambda: self._xform_mesh("mesh"))
 
     @property
     def mesh_brain(self):
-        if not hasattr(self, "_mesh_brain_xf"):
-            import navis
-
-            self._mesh_brain_xf = navis.xform_brain(
-                super().mesh_brain, source="JRCFIB2022M", target="JRCFIB2022Mplot"
-            )
-        return self._mesh_brain_xf
+        return load_once(self, "_mesh_brain_xf", lambda: self._xform_mesh("mesh_brain"))
 
     @property
     def mesh_vnc(self):
-        if not hasattr(self, "_mesh_vnc_xf"):
-            import navis
+        return load_once(self, "_mesh_vnc_xf", lambda: self._xform_mesh("mesh_vnc"))
+
+    def _xform_mesh(self, attr):
+        """Transform JRCFIB2022M mesh (by attribute) into this space."""
+        import navis
 
-            self._mesh_vnc_xf = navis.xform_brain(
-                super().mesh_vnc, source="JRCFIB2022M", target="JRCFIB2022Mplot"
-            )
-        return self._mesh_vnc_xf
+        return navis.xform_brain(
+            getattr(super(), attr), source="JRCFIB2022M", target="JRCFIB2022Mplot"
+        )
 
 
 JRCFIB2022Mplot = _JRCFIB2022Mplot(**template_meta["JRCFIB2022M"])
@@ -1101,12 +1161,8 @@ class _FLYWIRE(FlyTemplateBrain):
     @property
     def mesh_whole_brain(self):
         """On-demand loading of whole brain mesh."""
-        if not hasattr(self, "_mesh_whole_brain"):
-            fp = os.path.join(mesh_filepath, f"{self.label}_whole_brain.ply")
-
-            self._mesh_whole_brain = tm.load_mesh(fp)
-
-        return self._mesh_whole_brain
+        fp = os.path.join(mesh_filepath, f"{self.label}_whole_brain.ply")
+        return load_once(self, "_mesh_whole_brain", lambda: load_mesh(fp))
 
 
 FLYWIRE = _FLYWIRE(**template_meta["FLYWIRE"])
@@ -1220,14 +1276,8 @@ class _MANC(FlyTemplateBrain):
     @property
     def mesh(self):
         """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, f"{self.label}raw.ply")
-            self._mesh = tm.load_mesh(fp)
-            # Convert voxels to nanometers
-            if self.units[0] == "nm":
-                self._mesh.vertices *= 8
-        return self._mesh
+        # Load the raw mesh (voxels) and convert to nanometers
+        return scaled_mesh(("MANCraw.ply",), 8 if self.units[0] == "nm" else 1)
 
 
 # MANC in nanometers
@@ -1278,40 +1328,23 @@ class _BANC(FlyTemplateBrain):
     @property
     def mesh_whole_brain(self):
         """On-demand loading of whole brain mesh."""
-        if not hasattr(self, "_mesh_whole_brain"):
-            fp = os.path.join(mesh_filepath, "BANC_whole_brain.ply")
-
-            self._mesh_whole_brain = tm.load_mesh(fp)
-
-        return self._mesh_whole_brain
+        fp = os.path.join(mesh_filepath, "BANC_whole_brain.ply")
+        return load_once(self, "_mesh_whole_brain", lambda: load_mesh(fp))
 
     @property
     def mesh(self):
         """On-demand loading of surface mesh."""
-        if not hasattr(self, "_mesh"):
-            # Load the raw mesh (voxels)
-            fp1 = os.path.join(mesh_filepath, "BANC_brain.ply")
-            fp2 = os.path.join(mesh_filepath, "BANC_vnc.ply")
-            self._mesh = tm.util.concatenate(tm.load_mesh(fp1), tm.load_mesh(fp2))
-        return self._mesh
+        return scaled_mesh(("BANC_brain.ply", "BANC_vnc.ply"))
 
     @property
     def mesh_brain(self):
         """On-demand loading of brain surface mesh."""
-        if not hasattr(self, "_mesh_brain"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, "BANC_brain.ply")
-            self._mesh_brain = tm.load_mesh(fp)
-        return self._mesh_brain
+        return scaled_mesh(("BANC_brain.ply",))
 
     @property
     def mesh_vnc(self):
         """On-demand loading of VNC surface mesh."""
-        if not hasattr(self, "_mesh_vnc"):
-            # Load the raw mesh (voxels)
-            fp = os.path.join(mesh_filepath, "BANC_vnc.ply")
-            self._mesh_vnc = tm.load_mesh(fp)
-        return self._mesh_vnc
+        return scaled_mesh(("BANC_vnc.ply",))
 
 
 BANC = _BANC(**template_meta["BANC"])
@@ -0,0 +1,556 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Landmark-based transforms used for the shipped mirror/bridging transforms."""
+
+import hashlib
+import os
+import pathlib
+import warnings
+
+from concurrent.futures import ThreadPoolExecutor
+from inspect import signature
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from scipy.sparse.linalg import cg
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+from navis import transforms
+from navis.transforms.base import BaseTransform
+
+from .cache import get_cache_dir
+from .lazy import load_once
+
+# Memory budget (in MB) for the kernel matrices of all chunks evaluated at once
+TPS_MEMORY_BUDGET = int(os.environ.get("FLYBRAINS_TPS_MEMORY", 256))
+
+# Number of threads used to evaluate chunks in parallel
+TPS_THREADS = int(os.environ.get("FLYBRAINS_THREADS", os.cpu_count() or 1))
+
+# `cg` renamed `tol` to `rtol` in scipy 1.12 (and dropped `tol` in 1.14)
+_CG_RTOL = "rtol" if "rtol" in signature(cg).parameters else "tol"
+
+
+def landmarks_hash(source: np.ndarray, target: np.ndarray) -> str:
+    """Generate hash for given set of landmarks."""
+    h = hashlib.sha1()
+    for lm in (source, target):
+        lm = np.ascontiguousarray(lm, dtype=np.float64)
+        h.update(str(lm.shape).encode())
+        h.update(lm.tobytes())
+    return h.hexdigest()[:20]
+
+
+def _coefs_file(key: str) -> pathlib.Path:
+    """File the coefficients for given key are cached in."""
+    return pathlib.Path(get_cache_dir()) / "tps" / f"{key}.npz"
+
+
+def _load_coefs(key: str, *names) -> tuple:
+    """Load cached coefficients. Returns None if not (validly) cached."""
+    try:
+        with np.load(_coefs_file(key)) as f:
+            return tuple(f[n] for n in names)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_coefs(key: str, **arrays):
+    """Save coefficients to cache."""
+    fp = _coefs_file(key)
+    try:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp = fp.with_name(f"{key}.{os.getpid()}.tmp.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, fp)
+    except OSError as e:
+        warnings.warn(f"Unable to cache TPS coefficients: {e}")
+
+
+def _parse_points(points) -> np.ndarray:
+    """Turn input into (N, 3) float array."""
+    if isinstance(points, pd.DataFrame):
+        if any(c not in points for c in ["x", "y", "z"]):
+            raise ValueError("DataFrame must have x/y/z columns.")
+        points = points[["x", "y", "z"]].values
+    return np.asarray(points, dtype=np.float64)
+
+
+def _run_chunks(func, points, size, n_threads, *args) -> np.ndarray:
+    """Run ``func(chunk, *args, out=out_chunk)`` over chunks of points."""
+    out = np.empty((points.shape[0], 3), dtype=np.float64)
+    chunks = [slice(i, i + size) for i in range(0, points.shape[0], size)]
+
+    n_threads = n_threads if n_threads else TPS_THREADS
+    n_threads = min(n_threads, len(chunks))
+    if n_threads <= 1:
+        for c in chunks:
+            func(points[c], *args, out=out[c])
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            futures = [
+                pool.submit(func, points[c], *args, out=out[c]) for c in chunks
+            ]
+            # This also raises any exceptions from the threads
+            for f in futures:
+                f.result()
+
+    return out
+
+
+def _tps_eval(points, source, W, A, out):
+    """Evaluate thin plate spline for given points and write to `out`.
+
+    Equivalent to ``P_matrix(points) @ A + K_matrix(points, source) @ W`` but
+    without any intermediates besides the (N, M) kernel matrix. Both `cdist`
+    and the BLAS calls release the GIL, so this can run in parallel threads.
+    """
+    # For 3D the TPS kernel is U(r) = r, i.e. just the distance matrix
+    U = cdist(points, source)
+
+    # Non-uniform part
+    np.matmul(U, W, out=out)
+    # Affine part (the first row in A is the translation)
+    out += points @ A[1:]
+    out += A[0]
+    return out
+
+
+class CachedTPStransform(transforms.TPStransform):
+    """Thin plate spline transform with coefficients cached on disk.
+
+    Solving for the TPS coefficients scales cubically with the number of
+    landmarks. This class stores the solved weights (`W`) and affine part (`A`)
+    in the flybrains cache directory, keyed by the hash of the landmarks, so
+    that they only ever need to be solved once.
+
+    Parameters
+    ----------
+    landmarks_source :  (M, 3) numpy array
+                        Source landmarks as x/y/z coordinates.
+    landmarks_target :  (M, 3) numpy array
+                        Target landmarks as x/y/z coordinates.
+    batch_size :        int, optional
+                        Maximum number of points per chunk. By default, the
+                        chunk size is determined by `memory_budget`.
+    memory_budget :     int, optional
+                        Memory budget (in MB) for the kernel matrices. The
+                        kernel matrix for a chunk of N points and M landmarks
+                        takes ``N * M * 8`` bytes. The budget is split between
+                        the threads, i.e. each chunk gets
+                        ``memory_budget / n_threads``. Defaults to
+                        ``TPS_MEMORY_BUDGET`` (set via the
+                        ``FLYBRAINS_TPS_MEMORY`` environment variable).
+    n_threads :         int, optional
+                        Number of threads to evaluate chunks with. Defaults to
+                        ``TPS_THREADS`` (set via ``FLYBRAINS_THREADS``).
+
+    """
+
+    def __init__(
+        self,
+        landmarks_source: np.ndarray,
+        landmarks_target: np.ndarray,
+        batch_size: int = None,
+        memory_budget: int = None,
+        n_threads: int = None,
+    ):
+        """Initialize class."""
+        super().__init__(landmarks_source, landmarks_target, batch_size=batch_size)
+        self.memory_budget = memory_budget
+        self.n_threads = n_threads
+
+    def __neg__(self) -> "CachedTPStransform":
+        """Invert direction."""
+        # Switch source and target
+        return self.__class__(
+            self.target,
+            self.source,
+            batch_size=self.batch_size,
+            memory_budget=self.memory_budget,
+            n_threads=self.n_threads,
+        )
+
+    @property
+    def key(self) -> str:
+        """Hash of the landmarks."""
+        if not hasattr(self, "_key"):
+            self._key = landmarks_hash(self.source, self.target)
+        return self._key
+
+    @property
+    def W(self):
+        return self._coefs[0]
+
+    @property
+    def A(self):
+        return self._coefs[1]
+
+    @property
+    def _coefs(self) -> tuple:
+        """``(W, A)`` - loaded from disk or solved on first use."""
+        # Only one thread calculates the coefficients, the others wait for it
+        return load_once(self, "_WA", self._fit_tps_coefs)
+
+    def _calc_tps_coefs(self):
+        self._coefs
+
+    def _fit_tps_coefs(self) -> tuple:
+        # Try loading the coefficients from disk
+        coefs = _load_coefs(self.key, "W", "A")
+        if coefs is not None:
+            return tuple(coefs)
+
+        # Calculate thinplate coefficients
+        super()._calc_tps_coefs()
+        W, A, self._W, self._A = self._W, self._A, None, None
+        _save_coefs(self.key, W=W, A=A)
+        return W, A
+
+    def copy(self) -> "CachedTPStransform":
+        """Make copy."""
+        x = self.__class__(self.source, self.target)
+
+        x.__dict__.update(self.__dict__)
+
+        return x
+
+    def _chunk_size(self) -> int:
+        """Number of points per chunk."""
+        budget = self.memory_budget if self.memory_budget else TPS_MEMORY_BUDGET
+        n_threads = self.n_threads if self.n_threads else TPS_THREADS
+        # One chunk per thread is in flight at any time
+        budget = int(budget * 1024**2) // max(1, n_threads)
+        # Kernel matrix is (N, M) float64
+        size = max(1, budget // (self.source.shape[0] * 8))
+        if self.batch_size:
+            size = min(size, self.batch_size)
+        return size
+
+    def xform(self, points: np.ndarray) -> np.ndarray:
+        """Transform points.
+
+        Points are processed in chunks small enough to stay within the memory
+        budget, and chunks are evaluated in parallel threads.
+
+        Parameters
+        ----------
+        points :    (N, 3) array
+                    Points to transform.
+
+        Returns
+        -------
+        pointsxf :  (N, 3) array
+                    Transformed points.
+
+        """
+        points = _parse_points(points)
+        source = np.ascontiguousarray(self.source, dtype=np.float64)
+        W, A = (np.asarray(c) for c in self._coefs)
+
+        return _run_chunks(
+            _tps_eval, points, self._chunk_size(), self.n_threads, source, W, A
+        )
+
+
+def _wendland(r: np.ndarray) -> np.ndarray:
+    """Wendland C2 kernel (positive definite in 3D) for ``r = dist / radius``."""
+    return (1 - r) ** 4 * (4 * r + 1)
+
+
+def _local_eval(points, tree, radius, C, A, out):
+    """Evaluate local RBF transform for given points and write to `out`."""
+    # Sparse (N, M) kernel matrix with only the landmarks within `radius`
+    d = cKDTree(points).sparse_distance_matrix(tree, radius, output_type="ndarray")
+    K = sparse.csr_matrix(
+        (_wendland(d["v"] / radius), (d["i"], d["j"])), shape=(len(points), len(C))
+    )
+
+    np.matmul(points, A[1:], out=out)
+    out += A[0]
+    out += K @ C
+    return out
+
+
+class LocalRBFtransform(BaseTransform):
+    """Landmark transform using compactly supported radial basis functions.
+
+    Local alternative to `TPStransform`: an affine transform is fitted to all
+    landmarks and the remaining displacements are interpolated using a Wendland
+    kernel that is zero beyond a given radius. Both solving (sparse conjugate
+    gradients) and evaluating (KD-tree neighbourhoods) hence scale roughly with
+    ``O(n log n)`` instead of ``O(n^3)`` and ``O(n * m)``, respectively. Like
+    the TPS, the transform maps each source landmark exactly onto its target
+    landmark; in between, results will be similar but not identical.
+
+    Parameters
+    ----------
+    landmarks_source :  (M, 3) numpy array
+                        Source landmarks as x/y/z coordinates.
+    landmarks_target :  (M, 3) numpy array
+                        Target landmarks as x/y/z coordinates.
+    k :                 int
+                        Used to determine the support radius (if not given
+                        explicitly): the radius is set such that most source
+                        landmarks have at least `k` neighbours within it.
+    radius :            float, optional
+                        Support radius (in the units of the landmarks).
+                        Points further away than that from all landmarks
+                        will only be transformed by the affine part.
+    batch_size :        int
+                        Number of points per chunk.
+    n_threads :         int, optional
+                        Number of threads to evaluate chunks with. Defaults to
+                        ``TPS_THREADS`` (set via ``FLYBRAINS_THREADS``).
+
+    """
+
+    def __init__(
+        self,
+        landmarks_source: np.ndarray,
+        landmarks_target: np.ndarray,
+        k: int = 32,
+        radius: float = None,
+        batch_size: int = 100_000,
+        n_threads: int = None,
+    ):
+        """Initialize class."""
+        self.source = np.asarray(landmarks_source, dtype=np.float64)
+        self.target = np.asarray(landmarks_target, dtype=np.float64)
+
+        if self.source.ndim != 2 or self.source.shape[1] != 3:
+            raise ValueError(f"Expected (N, 3) array, got {self.source.shape}")
+        if self.target.shape != self.source.shape:
+            raise ValueError(
+                "Number of source landmarks must match number of target landmarks."
+            )
+
+        self.k = k
+        self.radius = radius
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+
+    def __eq__(self, other) -> bool:
+        """Implement equality comparison."""
+        if not isinstance(other, LocalRBFtransform):
+            return False
+        if (self.k, self.radius) != (other.k, other.radius):
+            return False
+        if self.source.shape != other.source.shape:
+            return False
+        return np.all(self.source == other.source) and np.all(
+            self.target == other.target
+        )
+
+    def __neg__(self) -> "LocalRBFtransform":
+        """Invert direction."""
+        # Switch source and target
+        return self.__class__(
+            self.target,
+            self.source,
+            k=self.k,
+            radius=self.radius,
+            batch_size=self.batch_size,
+            n_threads=self.n_threads,
+        )
+
+    @property
+    def key(self) -> str:
+        """Hash of landmarks + parameters."""
+        if not hasattr(self, "_key"):
+            lm = landmarks_hash(self.source, self.target)
+            self._key = f"{lm}-local-{self.k}-{self.radius}"
+        return self._key
+
+    @property
+    def tree(self) -> cKDTree:
+        """KD-tree of the source landmarks."""
+        if not hasattr(self, "_tree"):
+            self._tree = cKDTree(self.source)
+        return self._tree
+
+    @property
+    def C(self):
+        return self._coefs[0]
+
+    @property
+    def A(self):
+        return self._coefs[1]
+
+    @property
+    def support_radius(self) -> float:
+        if self.radius is None:
+            return self._coefs[2]
+        return self.radius
+
+    @property
+    def matrix_affine(self):
+        """Return the affine transformation matrix."""
+        m = np.eye(4)
+        m[0:3, 0:3] = self.A[1:4, :].T
+        m[0:3, 3] = self.A[0, :]
+        return m
+
+    @property
+    def _coefs(self) -> tuple:
+        """``(C, A, radius)`` - loaded from disk or fitted on first use."""
+        # Only one thread calculates the coefficients, the others wait for it
+        return load_once(self, "_CAr", self._fit_coefs)
+
+    def _fit_coefs(self) -> tuple:
+        # Try loading the coefficients from disk
+        coefs = _load_coefs(self.key, "C", "A", "radius")
+        if coefs is not None:
+            C, A, radius = coefs
+            return C, A, float(radius)
+
+        # Fit the affine part (least squares) - the first row is the translation
+        P = np.column_stack((np.ones(len(self.source)), self.source))
+        A = np.linalg.lstsq(P, self.target, rcond=None)[0]
+
+        # Support radius such that the large majority of landmarks have at
+        # least `k` neighbours
+        if self.radius is None:
+            k = min(self.k + 1, len(self.source))
+            dist, _ = self.tree.query(self.source, k=k)
+            radius = float(np.percentile(dist[:, -1], 95))
+            if radius <= 0:
+                raise ValueError("Unable to determine support radius.")
+        else:
+            radius = float(self.radius)
+
+        # Interpolate the residuals with the sparse kernel matrix. The Wendland
+        # kernel is positive definite, so the system is solvable as long as
+        # landmarks are unique. Conjugate gradients are much faster than a
+        # direct solver here because of the fill-in for 3D neighbourhoods
+        d = self.tree.sparse_distance_matrix(self.tree, radius, output_type="ndarray")
+        K = sparse.csr_matrix(
+            (_wendland(d["v"] / radius), (d["i"], d["j"])),
+            shape=(len(self.source), len(self.source)),
+        )
+        R = self.target - P @ A
+        C = np.empty_like(R)
+        for i in range(3):
+            C[:, i], info = cg(K, R[:, i], maxiter=10 * len(R), **{_CG_RTOL: 1e-10})
+            if info > 0:
+                warnings.warn(
+                    "Local RBF transform did not converge - consider using "
+                    "a smaller `k` or `radius`."
+                )
+
+        _save_coefs(self.key, C=C, A=A, radius=radius)
+        return C, A, radius
+
+    def copy(self) -> "LocalRBFtransform":
+        """Make copy."""
+        x = self.__class__(self.source, self.target)
+
+        x.__dict__.update(self.__dict__)
+
+        return x
+
+    def xform(self, points: np.ndarray) -> np.ndarray:
+        """Transform points.
+
+        Parameters
+        ----------
+        points :    (N, 3) array
+                    Points to transform.
+
+        Returns
+        -------
+        pointsxf :  (N, 3) array
+                    Transformed points.
+
+        """
+        points = _parse_points(points)
+        C, A, radius = self._coefs
+
+        return _run_chunks(
+            _local_eval,
+            points,
+            self.batch_size if self.batch_size else max(len(points), 1),
+            self.n_threads,
+            self.tree,
+            radius,
+            C,
+            A,
+        )
+
+
+class ScaledTransform(BaseTransform):
+    """Apply a transform in a uniformly scaled coordinate space.
+
+    Computes ``transform(points * scale) / scale``. This is useful to re-use
+    a transform defined in e.g. nanometers for voxel space without having to
+    re-fit it. For thin plate splines (3D kernel ``U(r) = r``) this is
+    exactly equivalent to fitting a new transform to landmarks divided by
+    `scale`.
+
+    Parameters
+    ----------
+    transform : BaseTransform
+                The transform to wrap.
+    scale :     float
+                Factor to go from this space into the space of `transform`.
+
+    """
+
+    def __init__(self, transform: BaseTransform, scale: float):
+        """Initialize."""
+        self.transform = transform
+        self.scale = scale
+
+    def __eq__(self, other) -> bool:
+        """Check if the same."""
+        if not isinstance(other, ScaledTransform):
+            return False
+        return self.scale == other.scale and self.transform == other.transform
+
+    def __neg__(self) -> "ScaledTransform":
+        """Invert direction."""
+        return ScaledTransform(-self.transform, self.scale)
+
+    def copy(self) -> "ScaledTransform":
+        """Return copy."""
+        return ScaledTransform(self.transform.copy(), self.scale)
+
+    def xform(
+        self, points: np.ndarray, affine_fallback: bool = True, **kwargs
+    ) -> np.ndarray:
+        """Xform data.
+
+        Parameters
+        ----------
+        points :            (N, 3) numpy array
+                            Points to xform.
+        affine_fallback :   bool
+                            Passed through to the wrapped transform if it
+                            supports it.
+        **kwargs
+                            Passed through to the wrapped transform.
+
+        Returns
+        -------
+        pointsxf :      (N, 3) numpy array
+                        Transformed points.
+
+        """
+        if "affine_fallback" in signature(self.transform.xform).parameters:
+            kwargs["affine_fallback"] = affine_fallback
+        points = np.asarray(points) * self.scale
+        return self.transform.xform(points, **kwargs) / self.scale
@@ -0,0 +1,96 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Record streamxform results for CMTK registrations.
+
+Copies the given registrations to ``cmtk/`` next to this script and writes
+``cmtk_streamxform.csv`` with forward and inverse results, which is used by
+``tests/test_cmtk.py`` to validate the native evaluator. Requires CMTK's
+`streamxform`. Pick a few real affine and warp registrations, e.g. from the
+jefferislab BridgingRegistrations/MirrorRegistrations repositories:
+
+    python tests/data/record_cmtk.py JFRC2_FCWB.list IS2_JFRC2.list ...
+"""
+
+import argparse
+import pathlib
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from flybrains.cmtk import (
+    NativeCMTKtransform,
+    _SplineWarpReg,
+    _streamxform_once,
+    read_registration,
+)
+
+HERE = pathlib.Path(__file__).parent
+
+N_POINTS = 200
+
+
+def sample_points(reg, n: int, bbox, seed: int = 0) -> np.ndarray:
+    """Points across the warp's domain (including outside) or given bbox."""
+    rng = np.random.default_rng(seed)
+    if isinstance(reg, _SplineWarpReg):
+        lower = reg.origin - 0.1 * reg.domain
+        upper = reg.origin + 1.1 * reg.domain
+    else:
+        lower, upper = np.asarray(bbox[:3]), np.asarray(bbox[3:])
+    return lower + rng.random((n, 3)) * (upper - lower)
+
+
+def streamxform(reg: pathlib.Path, points: np.ndarray, direction: str) -> np.ndarray:
+    """Run streamxform on points."""
+    args = NativeCMTKtransform(str(reg), directions=direction).make_args()
+    return _streamxform_once(args, points)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("regs", nargs="+", type=pathlib.Path)
+    parser.add_argument(
+        "--bbox",
+        nargs=6,
+        type=float,
+        default=[0, 0, 0, 600, 300, 200],
+        help="xmin ymin zmin xmax ymax zmax for affine registrations",
+    )
+    args = parser.parse_args()
+
+    tables = []
+    for i, src in enumerate(args.regs):
+        reg = HERE / "cmtk" / src.name
+        if reg.exists():
+            shutil.rmtree(reg)
+        shutil.copytree(src, reg)
+
+        points = sample_points(read_registration(str(reg)), N_POINTS, args.bbox, i)
+        for direction in ("forward", "inverse"):
+            xf = streamxform(reg, points, direction)
+            df = pd.DataFrame(
+                np.hstack([points, xf]), columns=["x", "y", "z", "x_xf", "y_xf", "z_xf"]
+            )
+            df.insert(0, "direction", direction)
+            df.insert(0, "reg", reg.name)
+            tables.append(df)
+
+    out = HERE / "cmtk_streamxform.csv"
+    pd.concat(tables).to_csv(out, index=False, float_format="%.6f")
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
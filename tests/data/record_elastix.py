@@ -0,0 +1,104 @@
+#    This script is part of navis (http://www.github.com/schlegelp/navis-flybrains).
+#    Copyright (C) 2020 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Record transformix results for the shipped Elastix parameter files.
+
+Writes ``elastix_transformix.csv`` next to this script, which is used by
+``tests/test_elastix.py`` to validate the native evaluator. Requires the
+``itk-elastix`` package (not a dependency of flybrains). Usage:
+
+    python tests/data/record_elastix.py
+"""
+
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import itk
+
+from flybrains.elastix import parse_chain, _BSplineStep
+
+DATA = pathlib.Path(__file__).parents[2] / "flybrains" / "data"
+
+# Last file of each shipped chain (initial transforms are followed)
+FILES = [
+    "FANC_JRCVNC2018F/TransformParameters.FixedTemplate.Bspline.txt",
+    "BANC_JRC2018F/2_elastix_Bspline_coarse.txt",
+    "BANC_JRCVNC2018F/2_elastix_Bspline_coarse.txt",
+]
+
+N_POINTS = 200
+
+
+def transformix(fp: pathlib.Path, points: np.ndarray) -> np.ndarray:
+    """Run transformix (via itk-elastix) on points."""
+    image = itk.image_from_array(np.zeros((4, 4, 4), dtype=np.float32))
+    params = itk.ParameterObject.New()
+    params.ReadParameterFile(str(fp))
+    with tempfile.TemporaryDirectory() as tempdir:
+        tempdir = pathlib.Path(tempdir)
+        with open(tempdir / "inputpoints.txt", "w") as f:
+            f.write(f"point\n{len(points)}\n")
+            for p in points:
+                f.write(" ".join(repr(float(x)) for x in p) + "\n")
+
+        # Like the binary, initial transforms are looked up in the working dir
+        cwd = os.getcwd()
+        os.chdir(fp.parent)
+        try:
+            tf = itk.TransformixFilter.New(Input=image, TransformParameterObject=params)
+            tf.SetFixedPointSetFileName(str(tempdir / "inputpoints.txt"))
+            tf.SetOutputDirectory(str(tempdir))
+            tf.SetLogToConsole(False)
+            tf.Update()
+        finally:
+            os.chdir(cwd)
+
+        out = []
+        with open(tempdir / "outputpoints.txt") as f:
+            for line in f:
+                xyz = line.split("OutputPoint = [")[1].split("]")[0]
+                out.append([float(v) for v in xyz.split()])
+    return np.array(out)
+
+
+def sample_points(fp: pathlib.Path, n: int, seed: int = 0) -> np.ndarray:
+    """Points across the B-spline grid, including its (invalid) border."""
+    rng = np.random.default_rng(seed)
+    bspline = [s for s, _ in parse_chain(fp) if isinstance(s, _BSplineStep)][0]
+    extent = np.linalg.inv(bspline.to_index) @ (bspline.size - 1)
+    lower = bspline.origin - 0.1 * extent
+    upper = bspline.origin + 1.1 * extent
+    return lower + rng.random((n, 3)) * (upper - lower)
+
+
+def main():
+    tables = []
+    for i, f in enumerate(FILES):
+        points = sample_points(DATA / f, N_POINTS, seed=i)
+        xf = transformix(DATA / f, points)
+        df = pd.DataFrame(
+            np.hstack([points, xf]), columns=["x", "y", "z", "x_xf", "y_xf", "z_xf"]
+        )
+        df.insert(0, "file", f)
+        tables.append(df)
+    out = pathlib.Path(__file__).parent / "elastix_transformix.csv"
+    pd.concat(tables).to_csv(out, index=False, float_format="%.6f")
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Validate the native CMTK evaluator against streamxform.
+
+Reference results are recorded by ``tests/data/record_cmtk.py``.
+"""
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flybrains.cmtk import _SplineWarpReg, read_registration
+
+DATA = pathlib.Path(__file__).parent / "data"
+FIXTURE = DATA / "cmtk_streamxform.csv"
+
+if FIXTURE.is_file():
+    REFERENCE = pd.read_csv(FIXTURE)
+    CASES = list(REFERENCE.groupby(["reg", "direction"]).groups)
+else:
+    REFERENCE, CASES = None, []
+
+requires_fixture = pytest.mark.skipif(
+    REFERENCE is None,
+    reason="No streamxform recording - run tests/data/record_cmtk.py",
+)
+
+
+@requires_fixture
+@pytest.mark.parametrize("reg, direction", CASES)
+def test_native_matches_streamxform(reg, direction):
+    ref = REFERENCE[(REFERENCE.reg == reg) & (REFERENCE.direction == direction)]
+    r = read_registration(str(DATA / "cmtk" / reg))
+
+    points = ref[["x", "y", "z"]].values
+    xf = r.forward(points) if direction == "forward" else r.inverse(points)
+    expected = ref[["x_xf", "y_xf", "z_xf"]].values
+
+    # Same points fail (e.g. outside the warp's domain)...
+    np.testing.assert_array_equal(np.isnan(xf), np.isnan(expected))
+    # ... and the others agree
+    np.testing.assert_allclose(xf, expected, rtol=0, atol=1e-3)
+
+
+@requires_fixture
+@pytest.mark.parametrize("reg", sorted({reg for reg, _ in CASES}))
+def test_fixture_covers_domain_border(reg):
+    # Warps must be checked on both sides of their domain
+    r = read_registration(str(DATA / "cmtk" / reg))
+    if not isinstance(r, _SplineWarpReg):
+        pytest.skip("Affine registration")
+    points = REFERENCE[REFERENCE.reg == reg][["x", "y", "z"]].values
+    inside = r.in_domain(points)
+    assert inside.any() and not inside.all()
+
+
+def test_spline_inverse_roundtrip():
+    # Smooth synthetic warp: control points on a jittered regular grid
+    dims, domain = np.array([7, 6, 5]), np.array([120.0, 100.0, 80.0])
+    spacing = domain / (dims - 3)
+    idx = np.stack(np.meshgrid(*[np.arange(d) for d in dims], indexing="ij"), -1)
+    grid = (idx.transpose(2, 1, 0, 3) - 1) * spacing
+    rng = np.random.default_rng(0)
+    coefs = grid + rng.normal(scale=0.05 * spacing.min(), size=grid.shape)
+    r = _SplineWarpReg({"dims": dims, "domain": domain, "coefficients": coefs.ravel()})
+
+    points = rng.random((100, 3)) * domain * 0.8 + domain * 0.1
+    back = r.inverse(r.forward(points))
+    np.testing.assert_allclose(back, points, rtol=0, atol=1e-4)
@@ -0,0 +1,38 @@
+"""Validate the native Elastix evaluator against transformix.
+
+Reference results are recorded by ``tests/data/record_elastix.py``.
+"""
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flybrains.elastix import NativeElastixTransform, parse_chain
+
+DATA = pathlib.Path(__file__).parents[1] / "flybrains" / "data"
+FIXTURE = pathlib.Path(__file__).parent / "data" / "elastix_transformix.csv"
+
+REFERENCE = pd.read_csv(FIXTURE)
+
+
+@pytest.mark.parametrize("file", REFERENCE.file.unique())
+def test_native_matches_transformix(file):
+    ref = REFERENCE[REFERENCE.file == file]
+    tr = NativeElastixTransform(str(DATA / file))
+    assert tr.chain is not None
+
+    xf = tr._native(ref[["x", "y", "z"]].values)
+    expected = ref[["x_xf", "y_xf", "z_xf"]].values
+    np.testing.assert_allclose(xf, expected, rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize("file", REFERENCE.file.unique())
+def test_fixture_covers_grid_border(file):
+    # Make sure the fixture exercises points on both sides of the valid region
+    ref = REFERENCE[REFERENCE.file == file]
+    step = parse_chain(DATA / file)[-1][0]
+    cindex = (ref[["x", "y", "z"]].values - step.origin) @ step.to_index.T
+    valid = np.all((cindex >= 1) & (cindex < step.size - 2), axis=1)
+    assert valid.any() and not valid.all()
@@ -0,0 +1,34 @@
+"""Chunk-parallel H5 transforms must match serial results exactly."""
+
+import h5py
+import numpy as np
+import pytest
+
+from flybrains import h5, parallel
+
+
+@pytest.fixture
+def h5_transform(tmp_path):
+    """Small H5 transform with a random deformation field."""
+    rng = np.random.default_rng(0)
+    fp = tmp_path / "random.h5"
+    with h5py.File(fp, "w") as f:
+        ds = f.create_dataset(
+            "dfield", data=rng.integers(-100, 100, (16, 32, 32, 3)), chunks=(8, 8, 8, 3)
+        )
+        ds.attrs["spacing"] = np.ones(3)
+        ds.attrs["quantization_multiplier"] = 0.01
+    return h5.H5transform(str(fp))
+
+
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_parallel_h5_identical(h5_transform, pool, monkeypatch):
+    points = np.random.default_rng(1).uniform(-2, 34, size=(1000, 3))
+    monkeypatch.setattr(parallel, "N_WORKERS", 1)
+    expected = h5_transform.xform(points)
+
+    monkeypatch.setattr(parallel, "N_WORKERS", 3)
+    monkeypatch.setattr(parallel, "CHUNK_SIZE", 150)
+    monkeypatch.setattr(parallel, "POOL", pool)
+    h5.chunk_cache.clear()
+    np.testing.assert_array_equal(h5_transform.xform(points), expected)
@@ -0,0 +1,44 @@
+"""Signatures and on-disk storage of the transform result cache."""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from navis.transforms import AffineTransform
+
+from flybrains import results
+from flybrains.lazy import LazyTransform
+
+
+def _affine(fname):
+    return AffineTransform(np.eye(4))
+
+
+def test_lazy_signature_tracks_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, "data_filepath", str(tmp_path))
+    fp = tmp_path / "landmarks.csv"
+    fp.write_text("x,y,z\n")
+    tr = LazyTransform(_affine, "landmarks.csv")
+    before = results._signature(tr)
+
+    # Replace the file without touching the arguments
+    st = os.stat(fp)
+    os.utime(fp, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert results._signature(tr) != before
+
+
+def test_disk_cache_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLYBRAINS_CACHE", str(tmp_path))
+    cache = results.ResultCache(max_points=100, max_disk_mb=1)
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        keys = [rng.bytes(12) for _ in range(10_000)]
+        cache.store(f"plan{i}", keys, rng.random((10_000, 3)), disk=True)
+
+    con = sqlite3.connect(cache.db_file)
+    assert cache._db_bytes(con) <= 2**20
+    # Least recently written plans go first
+    plans = [p for (p,) in con.execute("SELECT DISTINCT plan FROM results")]
+    assert plans == ["plan4"]
+    con.close()
@@ -0,0 +1,140 @@
+"""Stress test lazy loading of template meshes and transforms from threads."""
+
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from navis.transforms import AffineTransform
+
+import flybrains
+from flybrains import templates
+from flybrains.lazy import LazyTransform, load_once
+
+N_THREADS = 16
+
+
+def _hammer(funcs: dict) -> dict:
+    """Call each function from `N_THREADS` threads at (roughly) the same time."""
+    barrier = threading.Barrier(N_THREADS)
+
+    def worker(_):
+        barrier.wait()
+        return {name: f() for name, f in funcs.items()}
+
+    with ThreadPoolExecutor(N_THREADS) as pool:
+        results = list(pool.map(worker, range(N_THREADS)))
+
+    return {name: [r[name] for r in results] for name in funcs}
+
+
+@pytest.fixture
+def fresh_meshes(monkeypatch):
+    """Drop loaded meshes and count (slowed down) calls to `load_mesh`."""
+    for tmp in (flybrains.FLYWIRE, flybrains.BANC, flybrains.JRCFIB2022Mraw):
+        for attr in [a for a in vars(tmp) if a.startswith("_mesh")]:
+            delattr(tmp, attr)
+    monkeypatch.setattr(templates, "_SCALED_MESHES", {})
+
+    calls = Counter()
+    lock = threading.Lock()
+    load_mesh = templates.load_mesh
+
+    def counting_load_mesh(fp):
+        with lock:
+            calls[fp.split("/")[-1]] += 1
+        time.sleep(0.05)
+        return load_mesh(fp)
+
+    monkeypatch.setattr(templates, "load_mesh", counting_load_mesh)
+    return calls
+
+
+def test_concurrent_lazy_loading(fresh_meshes):
+    calls = Counter()
+    lock = threading.Lock()
+
+    def factory(m):
+        with lock:
+            calls["transform"] += 1
+        time.sleep(0.05)
+        return AffineTransform(m)
+
+    lazy = LazyTransform(factory, np.eye(4))
+    copies = [lazy.copy() for _ in range(N_THREADS)]
+    it = iter(copies)
+
+    results = _hammer(
+        {
+            "flywire": lambda: flybrains.FLYWIRE.mesh_whole_brain,
+            "banc": lambda: flybrains.BANC.mesh,
+            "malecns": lambda: flybrains.JRCFIB2022Mraw.mesh_vnc,
+            "lazy": lambda: lazy.transform,
+            "copy": lambda: next(it).transform,
+        }
+    )
+
+    # Each loader ran exactly once...
+    assert calls == {"transform": 1}
+    assert fresh_meshes == {
+        "FLYWIRE_whole_brain.ply": 1,
+        "BANC_brain.ply": 1,
+        "BANC_vnc.ply": 1,
+        "JRCFIB2022M_vnc.ply": 1,
+    }
+
+    # ... and every thread got the very same object
+    for name, values in results.items():
+        assert all(v is values[0] for v in values), name
+    assert results["lazy"][0] is results["copy"][0]
+
+
+def test_load_once_retries_after_failure():
+    store = {}
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            raise ValueError("first call fails")
+        return "value"
+
+    with pytest.raises(ValueError):
+        load_once(store, "key", func)
+    assert "key" not in store
+
+    assert load_once(store, "key", func) == "value"
+    assert load_once(store, "key", func) == "value"
+    assert len(calls) == 2
+
+
+def test_load_once_concurrent_failure():
+    # Threads waiting on a failing loader retry rather than seeing a value
+    store = {}
+    calls = []
+    lock = threading.Lock()
+
+    def func():
+        with lock:
+            calls.append(None)
+            n = len(calls)
+        time.sleep(0.01)
+        if n == 1:
+            raise ValueError("first call fails")
+        return object()
+
+    def get():
+        try:
+            return load_once(store, "key", func)
+        except ValueError:
+            return None
+
+    values = _hammer({"value": get})["value"]
+    assert values.count(None) == 1
+    found = [v for v in values if v is not None]
+    assert all(v is found[0] for v in found)
+    assert len(calls) == 2